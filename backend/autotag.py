@@ -0,0 +1,208 @@
+'''
+Bulk tagging of the untagged "Transcriptions (group xxx)" folders.
+Every utterance is cleaned with util.preprocess_sentence_from_cha and tagged with the spanglish-upos SequenceTagger, and
+the transcript is written to the matching "Tagged Transcriptions (group xxx)" folder with a %pos tier after each utterance.
+Files are tagged many at a time in worker processes, and finished files are recorded in a checkpoint so an interrupted
+run picks up where it left off. Eg:
+    python autotag.py --data-dir transcriptions --workers 4
+'''
+import os, sys, json, argparse, datetime
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from util import get_cha_files_in_dir, iter_cha_records, preprocess_sentence_from_cha
+
+MODEL_NAME = 'benevanoff/spanglish-upos'
+UNTAGGED_PREFIX = "Transcriptions"
+TAGGED_PREFIX = "Tagged "
+CHECKPOINT_NAME = ".autotag_checkpoint.json"
+TAGGED_COMMENT = "@Comment: %pos tags were generated using the"
+# average size of an utterance with its timestamp in the transcriptions, to size the batches
+BYTES_PER_UTTERANCE = 80
+
+# the SequenceTagger of this process, loaded on first use by flair_tag_batch
+_tagger = None
+
+def flair_tag_batch(sentences: list, model: str=MODEL_NAME, mini_batch_size: int=32, threads: int=None):
+    '''
+    Tag cleaned sentences with a single model invocation
+    Inputs:
+        - sentences: list of strings, tokenized by flair
+        - model: name or path of the SequenceTagger
+        - mini_batch_size: sentences per forward pass
+        - threads: (optional) torch threads of this process, so that worker processes do not oversubscribe the cores
+    Outputs:
+        - one list of (token, tag) per sentence
+    '''
+    global _tagger
+    from flair.data import Sentence
+    if _tagger is None:
+        from flair.models import SequenceTagger
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        _tagger = SequenceTagger.load(model)
+    flair_sentences = [Sentence(sentence) for sentence in sentences]
+    _tagger.predict(flair_sentences, mini_batch_size=mini_batch_size)
+    return [[(token.text, token.tag) for token in flair_sentence] for flair_sentence in flair_sentences]
+
+def find_untagged_files(data_dir: str):
+    '''
+    Paths of the .cha files in the untagged folders, relative to data_dir, in a stable order
+    '''
+    files = []
+    for folder in sorted(os.listdir(data_dir)):
+        if folder.startswith(UNTAGGED_PREFIX) and os.path.isdir(os.path.join(data_dir, folder)):
+            files += [os.path.relpath(file, data_dir) for file in get_cha_files_in_dir(os.path.join(data_dir, folder))]
+    return sorted(files)
+
+def tagged_path(file: str):
+    '''
+    Where the tagged version of an untagged transcript goes, relative to the output folder
+    '''
+    folder, rest = file.split(os.sep, 1)
+    return os.path.join(TAGGED_PREFIX + folder, rest)
+
+def read_transcript(filepath: str):
+    '''
+    Returns the transcript's records, minus any earlier tagging, and the cleaned text of each utterance (None if
+    nothing is left to tag)
+    '''
+    records = [record for record in iter_cha_records(filepath) if record.kind != "pos" and not record.text.startswith(TAGGED_COMMENT)]
+    sentences = []
+    for record in records:
+        if record.kind == "utterance":
+            sentence = preprocess_sentence_from_cha(record.text)
+            sentences.append(sentence if sentence and sentence.strip() else None)
+        else:
+            sentences.append(None)
+    return records, sentences
+
+def format_tagged(records: list, tags: list, model: str, timestamp: str):
+    '''
+    Text of the tagged transcript, the %pos tier follows the utterance it tags
+    '''
+    lines = []
+    for record, tagged in zip(records, tags):
+        lines.append(record.text if record.text.endswith("\n") else record.text + "\n")
+        if tagged:
+            lines.append("%pos: " + " ".join(f'{token}.{tag}' for token, tag in tagged) + "\n")
+    lines.append(f'{TAGGED_COMMENT} {model} model on {timestamp}')
+    return "".join(lines)
+
+def write_atomically(path: str, text: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+def fingerprint(filepath: str):
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def load_checkpoint(path: str, model: str):
+    '''
+    {file: fingerprint} of the files already tagged with this model, empty if there is no checkpoint or it is for another model
+    '''
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if checkpoint.get("model") != model:
+        return {}
+    return checkpoint.get("files", {})
+
+def tag_job(tag_batch, data_dir: str, out_dir: str, files: list, model: str):
+    '''
+    Tag a group of transcripts with one tag_batch call and write them, returns the files done
+    '''
+    transcripts = [read_transcript(os.path.join(data_dir, file)) for file in files]
+    sentences = [sentence for _, file_sentences in transcripts for sentence in file_sentences if sentence is not None]
+    tagged = iter(tag_batch(sentences) if sentences else [])
+    timestamp = str(datetime.datetime.now())
+    for file, (records, file_sentences) in zip(files, transcripts):
+        tags = [None if sentence is None else next(tagged) for sentence in file_sentences]
+        write_atomically(os.path.join(out_dir, tagged_path(file)), format_tagged(records, tags, model, timestamp))
+    return files
+
+def make_jobs(data_dir: str, files: list, batch_size: int):
+    '''
+    Groups of whole files holding about batch_size utterances each, estimated from the file sizes so that the
+    files are only read once, by the worker tagging them
+    '''
+    job, job_bytes = [], 0
+    for file in files:
+        job.append(file)
+        job_bytes += os.path.getsize(os.path.join(data_dir, file))
+        if job_bytes >= batch_size * BYTES_PER_UTTERANCE:
+            yield job
+            job, job_bytes = [], 0
+    if job:
+        yield job
+
+def autotag(data_dir: str, out_dir: str=None, workers: int=1, batch_size: int=2048, model: str=MODEL_NAME, mini_batch_size: int=32, restart: bool=False, tag_batch=None):
+    '''
+    Tag every untagged transcript under data_dir that is not in the checkpoint yet
+    Inputs:
+        - data_dir: folder containing the "Transcriptions (group xxx)" folders
+        - out_dir: (optional) where the "Tagged Transcriptions (group xxx)" folders are written, data_dir by default
+        - workers: number of tagging processes, tagging happens in this process when 0
+        - batch_size: about how many utterances are tagged per model invocation
+        - model: name or path of the SequenceTagger
+        - mini_batch_size: sentences per forward pass
+        - restart: ignore the checkpoint and tag everything again
+        - tag_batch: (optional) function tagging a list of sentences, flair_tag_batch by default
+    Outputs:
+        - the number of files tagged
+    '''
+    out_dir = out_dir or data_dir
+    if tag_batch is None:
+        threads = max(1, (os.cpu_count() or 1) // workers) if workers > 0 else None
+        tag_batch = partial(flair_tag_batch, model=model, mini_batch_size=mini_batch_size, threads=threads)
+    checkpoint_path = os.path.join(out_dir, CHECKPOINT_NAME)
+    done = {} if restart else load_checkpoint(checkpoint_path, model)
+    files = find_untagged_files(data_dir)
+    todo = [file for file in files if done.get(file) != fingerprint(os.path.join(data_dir, file))
+            or not os.path.exists(os.path.join(out_dir, tagged_path(file)))]
+    print(f'{len(files) - len(todo)} of {len(files)} files already tagged with {model}')
+
+    def finished(job_files):
+        for file in job_files:
+            done[file] = fingerprint(os.path.join(data_dir, file))
+        write_atomically(checkpoint_path, json.dumps({"model": model, "files": done}))
+        print(f'{len(done)} of {len(files)} files tagged')
+
+    jobs = make_jobs(data_dir, todo, batch_size)
+    if workers == 0:
+        for job in jobs:
+            finished(tag_job(tag_batch, data_dir, out_dir, job, model))
+        return len(todo)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # a couple of jobs per worker in flight, the rest of the files are only listed
+        running = set()
+        for job in jobs:
+            running.add(executor.submit(tag_job, tag_batch, data_dir, out_dir, job, model))
+            if len(running) >= 2 * workers:
+                completed, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    finished(future.result())
+        for future in running:
+            finished(future.result())
+    return len(todo)
+
+def main():
+    parser = argparse.ArgumentParser(description="Tag the untagged transcriptions with %pos tiers")
+    parser.add_argument("--data-dir", default="transcriptions", help='folder containing the "Transcriptions (group xxx)" folders')
+    parser.add_argument("--out-dir", help="where the tagged folders are written, the data dir by default")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="tagging processes, 0 tags in this process")
+    parser.add_argument("--batch-size", type=int, default=2048, help="about how many utterances are tagged at a time")
+    parser.add_argument("--mini-batch-size", type=int, default=32, help="sentences per forward pass")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and tag every file again")
+    args = parser.parse_args()
+    tagged = autotag(args.data_dir, args.out_dir, args.workers, args.batch_size, args.model, args.mini_batch_size, args.restart)
+    print(f'tagged {tagged} files', file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+'''
+Benchmarks for corpus loading, the visualizations, the lexical diversity report and the tagger, run on synthetic
+corpora that are 1x, 10x, 100x, ... the size of the real one. Eg:
+    python benchmark.py --scales 1 10 100 --repeat 3 --out benchmark.json
+'''
+import os, sys, json, time, random, argparse, platform, tempfile, statistics
+from contextlib import redirect_stdout
+from corpus_tool import Corpus, Visualizer
+from concordance import Concordancer
+
+# the real corpus has 424 .cha files, half of them tagged
+FILES_PER_SCALE = 212
+# (group, main language) of the transcripts, groups 300/400 only narrated in english and 600/700 only in spanish
+GROUP_LANGS = [(100, "eng"), (100, "spa"), (200, "eng"), (200, "spa"), (300, "eng"), (400, "eng"), (500, "eng"), (500, "spa"), (600, "spa"), (700, "spa")]
+VOCABULARY = {
+    "eng": [("the", "DET"), ("and", "CCONJ"), ("she", "PRON"), ("to", "ADP"), ("wolf", "NOUN"), ("was", "AUX"), ("her", "PRON"), ("little", "ADJ"),
+            ("red", "ADJ"), ("grandma", "NOUN"), ("went", "VERB"), ("house", "NOUN"), ("in", "ADP"), ("girl", "NOUN"), ("forest", "NOUN"), ("said", "VERB"),
+            ("eat", "VERB"), ("then", "ADV"), ("basket", "NOUN"), ("walking", "VERB"), ("big", "ADJ"), ("very", "ADV"), ("flowers", "NOUN"), ("okay", "INTJ")],
+    "spa": [("la", "DET"), ("y", "CCONJ"), ("el", "DET"), ("a", "ADP"), ("lobo", "NOUN"), ("está", "AUX"), ("su", "DET"), ("niña", "NOUN"),
+            ("abuela", "NOUN"), ("va", "VERB"), ("casa", "NOUN"), ("en", "ADP"), ("ella", "PRON"), ("bosque", "NOUN"), ("dice", "VERB"), ("lo", "PRON"),
+            ("come", "VERB"), ("entonces", "ADV"), ("canasta", "NOUN"), ("roja", "ADJ"), ("grande", "ADJ"), ("muy", "ADV"), ("flores", "NOUN"), ("bueno", "INTJ")]
+}
+SYLLABLES = ["ba", "ce", "di", "fo", "gu", "la", "me", "ni", "po", "ra", "so", "ti", "vu", "za", "ch", "ar", "en", "ol"]
+SECONDARY_LANG = {"eng": "spa", "spa": "eng"}
+LANG_NAMES = {"eng": "english", "spa": "spanish"}
+
+def _extend_vocabulary(rng: random.Random, size: int=300):
+    '''
+    Pad the common words with rarer made up content words so type counts keep growing with the text
+    '''
+    vocabulary = {}
+    for lang, words in VOCABULARY.items():
+        seen = set(word for word, _ in words)
+        extended = list(words)
+        while len(extended) < len(words) + size:
+            word = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+            if word not in seen:
+                seen.add(word)
+                extended.append((word, rng.choice(["NOUN", "VERB", "ADJ"])))
+        vocabulary[lang] = (extended, [1 / (rank + 1) for rank in range(len(extended))]) # zipf like
+    return vocabulary
+
+def _wrap(line: str, width: int=70):
+    '''
+    Break a long tier the way CLAN does, continuation lines start with a tab
+    '''
+    lines = []
+    while len(line) > width and " " in line[:width]:
+        cut = line.rindex(" ", 0, width)
+        lines.append(line[:cut])
+        line = "\t" + line[cut + 1:]
+    lines.append(line)
+    return "\n".join(lines)
+
+def generate_transcript(rng: random.Random, vocabulary: dict, participant_id: int, main_lang: str, tagged: bool=True):
+    '''
+    Returns the text of a synthetic .cha transcript
+    '''
+    secondary_lang = SECONDARY_LANG[main_lang]
+    lines = [
+        "@UTF8",
+        "@Begin",
+        f"@Languages:\t{main_lang},{secondary_lang}",
+        f"@Participants:\tPAR {participant_id} Speaker",
+        f"@ID:\t{main_lang}|narratives|PAR||female|||Speaker|||",
+        f"@Media:\t{participant_id}_{LANG_NAMES[main_lang]}, audio"
+    ]
+    time_ms = 0
+    for _ in range(rng.randint(15, 45)):
+        switched_utterance = rng.random() < 0.03
+        par, pos = [f"[- {secondary_lang}]"] if switched_utterance else [], []
+        for _ in range(rng.randint(3, 14)):
+            lang = secondary_lang if switched_utterance or rng.random() < 0.08 else main_lang
+            words, weights = vocabulary[lang]
+            word, part_of_speech = rng.choices(words, weights)[0]
+            if rng.random() < 0.1:
+                par.append(rng.choice(["(.)", "(..)", "&-uh", "&-um"]))
+            par.append(f"{word}@s" if lang != main_lang and not switched_utterance else word)
+            pos.append(f"{word}.{part_of_speech}")
+            if rng.random() < 0.05:
+                par.append(",")
+                pos.append(",.PUNCT")
+        duration = rng.randint(1000, 12000)
+        lines.append(_wrap(f"*PAR:\t{' '.join(par)} . {time_ms}_{time_ms + duration}"))
+        if tagged:
+            lines.append(f"%pos: {' '.join(pos)}")
+        time_ms += duration
+    lines.append("@End")
+    return "\n".join(lines) + "\n"
+
+def generate_corpus(out_dir: str, scale: float=1, seed: int=0):
+    '''
+    Write a synthetic corpus of round(424 * scale) .cha files into out_dir, as "Tagged Transcriptions (group xxx)" folders
+    plus the same transcripts without %pos tiers in "Transcriptions (group xxx)" folders.
+    Participant ids stay within their group's [group, group + 100) range, larger scales reuse them.
+    Returns the number of files written
+    '''
+    rng = random.Random(seed)
+    vocabulary = _extend_vocabulary(rng)
+    n_transcripts = max(1, round(FILES_PER_SCALE * scale))
+    for i in range(n_transcripts):
+        group, main_lang = GROUP_LANGS[i % len(GROUP_LANGS)]
+        nth = i // len(GROUP_LANGS)
+        participant_id = group + nth % 100
+        filename = f'{participant_id}_{LANG_NAMES[main_lang]}{"" if nth < 100 else f"_{nth // 100}"}.cha'
+        state = rng.getstate()
+        for folder, tagged in [(f'Tagged Transcriptions (group {group})', True), (f'Transcriptions (group {group})', False)]:
+            rng.setstate(state) # the untagged copy has the same utterances
+            os.makedirs(os.path.join(out_dir, folder), exist_ok=True)
+            with open(os.path.join(out_dir, folder, filename), 'w', encoding='utf-8') as f:
+                f.write(generate_transcript(rng, vocabulary, participant_id, main_lang, tagged))
+    return 2 * n_transcripts
+
+def timed(function, repeat: int=3, setup=None):
+    '''
+    Returns the seconds each of repeat calls to function took, setup() runs untimed before every call
+    '''
+    seconds = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+def _reset_lexical_diversity(corpus: Corpus):
+    for transcript in corpus.transcripts:
+        transcript.lexical_diversity = None
+        transcript.diversity_memo.clear()
+
+def benchmark_corpus(corpus_dir: str, repeat: int=3, workers: int=None):
+    '''
+    Returns {benchmark name: [seconds per run]} for the corpus in corpus_dir
+    '''
+    results = {}
+    results["corpus_load"] = timed(lambda: Corpus(corpus_dir), repeat)
+    if workers and workers > 1:
+        results["corpus_load_parallel"] = timed(lambda: Corpus(corpus_dir, workers=workers), repeat)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_path = os.path.join(tmp_dir, "corpus.snapshot")
+        Corpus(corpus_dir, snapshot_path=snapshot_path)
+        results["corpus_load_snapshot"] = timed(lambda: Corpus(corpus_dir, snapshot_path=snapshot_path), repeat)
+
+        corpus = Corpus(corpus_dir, snapshot_path=snapshot_path)
+        visualizer = Visualizer(corpus)
+        reset = lambda: _reset_lexical_diversity(corpus)
+        results["measure_lexical_diversity"] = timed(lambda: [transcript.measure_lexical_diversity() for transcript in corpus.transcripts], repeat, reset)
+        results["lexical_diversity_table"] = timed(corpus.lexical_diversity_table, repeat, reset)
+        results["word_freq_barchart_group"] = timed(lambda: visualizer.word_freq_barchart_group([100, 200, 300, 400, 500, 600, 700], top_N_most_frequent=50), repeat)
+        results["mtld_boxplot"] = timed(lambda: visualizer.mtld_boxplot(target_lang="eng"), repeat, reset)
+        results["mtld_boxplot_memoized"] = timed(lambda: visualizer.mtld_boxplot(target_lang="eng"), repeat)
+        results["mattr_boxplot"] = timed(lambda: visualizer.mattr_boxplot(target_lang="spa"), repeat, reset)
+        results["gen_word_cloud"] = timed(lambda: visualizer.gen_word_cloud([100, 200]), repeat)
+        results["chart_summaries"] = timed(lambda: visualizer.chart_summaries(Visualizer.CHART_KINDS, [100, 200, 500]), repeat, reset)
+        results["gen_word_boxplots"] = timed(lambda: visualizer.gen_word_boxplots(["the", "wolf"], None, "eng"), repeat)
+        results["gen_dispersion"] = timed(lambda: visualizer.gen_dispersion("lobo", "500", "spa", None, "blue", os.path.join(tmp_dir, "dispersion.png")), repeat)
+        results["code_switching_data"] = timed(lambda: visualizer.code_switching_data(), repeat)
+        results["concordance"] = timed(lambda: Concordancer(corpus).concordance("the.DET *.NOUN", limit=100), repeat)
+    return results
+
+def benchmark_tagger(repeat: int=3):
+    '''
+    Seconds per tag_sentence call, None when the tagger can not be loaded here (eg flair is not installed)
+    '''
+    try:
+        from main import tag_sentence, get_tagger
+        get_tagger()
+    except ImportError as e:
+        print(f'skipping tag_sentence: {e}')
+        return None
+    return timed(lambda: tag_sentence("the little girl went to her abuela's casa con la canasta"), repeat)
+
+def summarize(seconds: list):
+    return {
+        'runs': [round(x, 6) for x in seconds],
+        'min': round(min(seconds), 6),
+        'median': round(statistics.median(seconds), 6)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backend on synthetic corpora")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10, 100], help="corpus sizes relative to the real corpus")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes for the parallel corpus load benchmark")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "bilingual-corpus-benchmark"), help="where generated corpora are kept between runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-tagger", action="store_true", help="skip the tag_sentence benchmark")
+    parser.add_argument("--out", help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'corpora': []
+    }
+    for scale in args.scales:
+        corpus_dir = os.path.join(args.data_dir, f'scale_{scale:g}_seed_{args.seed}')
+        if not os.path.isdir(corpus_dir):
+            print(f'generating {scale:g}x corpus in {corpus_dir}', file=sys.stderr)
+            generate_corpus(corpus_dir, scale, args.seed)
+        print(f'benchmarking {scale:g}x corpus', file=sys.stderr)
+        corpus = Corpus(corpus_dir)
+        with redirect_stdout(sys.stderr): # keep stdout for the report
+            results = benchmark_corpus(corpus_dir, args.repeat, args.workers)
+        report['corpora'].append({
+            'scale': scale,
+            'transcripts': len(corpus.transcripts),
+            'tokens': len(corpus.token_store),
+            'benchmarks': {name: summarize(seconds) for name, seconds in results.items()}
+        })
+    if not args.no_tagger:
+        with redirect_stdout(sys.stderr):
+            seconds = benchmark_tagger(args.repeat)
+        report['tag_sentence'] = None if seconds is None else summarize(seconds)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
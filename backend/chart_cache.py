@@ -0,0 +1,87 @@
+import hashlib, threading
+from collections import OrderedDict
+
+class ChartCache:
+    '''
+    LRU cache of encoded charts keyed by the normalized visualization request.
+    Entries are evicted least recently used first once the cached payloads exceed max_bytes.
+    '''
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> (etag, payload)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(kind: str, groups: list=None, target_language: str=None, part_of_speech_filter: list=None, N_most_frequent: int=None):
+        '''
+        Requests that only differ in the order of their groups or POS tags map to the same key
+        '''
+        return (
+            kind,
+            tuple(sorted(set(int(g) for g in groups))) if groups else (),
+            target_language,
+            None if part_of_speech_filter is None else tuple(sorted(set(part_of_speech_filter))),
+            N_most_frequent
+        )
+
+    @staticmethod
+    def make_etag(payload):
+        data = payload if isinstance(payload, bytes) else str(payload).encode()
+        return f'"{hashlib.blake2b(data, digest_size=12).hexdigest()}"'
+
+    def get(self, key):
+        '''
+        Returns (etag, payload) or None on a miss
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, payload):
+        entry = (self.make_etag(payload), payload)
+        payload_size = len(payload) if payload is not None else 0
+        if payload_size > self.max_bytes:
+            return entry # would evict everything else and still not fit
+        with self.lock:
+            if key in self.entries:
+                self.size -= self._entry_size(self.entries.pop(key))
+            self.entries[key] = entry
+            self.size += payload_size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self._entry_size(evicted)
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        '''
+        Drop every entry, eg after the corpus was reloaded
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': 0 if lookups == 0 else round(self.hits / lookups, 3)
+            }
+
+    def _entry_size(self, entry):
+        return len(entry[1]) if entry[1] is not None else 0
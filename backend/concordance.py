@@ -0,0 +1,180 @@
+'''
+Keyword in context search over the tokens of a Corpus.
+A pattern is a sequence of space separated terms matching consecutive tokens of an utterance, each term is
+"word.POS.lang" where any part can be left out or be a "*" wildcard and words and tags can be alternatives
+separated by "|", eg:
+    lo.PRON            every "lo" tagged PRON
+    DET NOUN           a determiner followed by a noun (a bare term is a POS when it is one of the corpus's tags)
+    a.DET *.NOUN.eng   "a" followed by an english noun
+    el|la *            "el" or "la" followed by any token
+Candidates come from the TokenIndex postings of the term with the fewest hits, the other terms are checked for all the
+candidates at once on the TokenStore arrays, so a search costs in proportion to the rarest term rather than to the corpus.
+'''
+import os, threading
+import numpy as np
+from collections import OrderedDict, namedtuple
+from corpus_tool import Corpus
+
+# words, POS and lang are lists of alternatives, None matches anything
+Term = namedtuple("Term", ["words", "POS", "lang"])
+
+MAX_TERMS = 8
+
+def _alternatives(part: str):
+    if part in ["", "*"]:
+        return None
+    return [x for x in part.split("|") if x]
+
+def parse_pattern(pattern: str, tags=()):
+    '''
+    Inputs:
+        - pattern: space separated terms, see the module docstring
+        - tags: the part of speech tags of the corpus, a bare term made of tags is read as a POS instead of a word
+    Outputs:
+        - one Term per token of the pattern
+    '''
+    terms = []
+    for item in pattern.split():
+        parts = item.split(".")
+        if len(parts) > 3:
+            raise ValueError(f'Invalid term {item}, expected word.POS.lang')
+        if len(parts) == 1 and parts[0] != "*" and all(x in tags for x in parts[0].split("|")):
+            parts = ["*"] + parts
+        parts += ["*"] * (3 - len(parts))
+        terms.append(Term(*[_alternatives(part) for part in parts]))
+    if not terms:
+        raise ValueError("Empty pattern")
+    if len(terms) > MAX_TERMS:
+        raise ValueError(f'Patterns are limited to {MAX_TERMS} terms')
+    return terms
+
+class Concordancer:
+    '''
+    Finds the matches of patterns in a corpus and formats them as keyword in context lines.
+    The matches of the last max_cached searches are kept so that paging through results does not search again.
+    '''
+    def __init__(self, corpus: Corpus, max_cached: int=32):
+        self.corpus = corpus
+        store = corpus.token_store
+        self.store = store
+        self.index = corpus.index
+        self.max_cached = max_cached
+        self.cache = OrderedDict() # (pattern, groups, main_lang) -> token rows of the first token of every match
+        self.lock = threading.Lock()
+        # first token of every utterance (and the end of the last one) and first utterance of every transcript
+        self.utt_offsets = np.searchsorted(store.utterance, np.arange(store.n_utterances + 1))
+        self.transcript_utt_offsets = np.searchsorted(store.utt_transcript, np.arange(store.n_transcripts))
+        self.files = [os.path.relpath(transcript.filename, corpus.dir) for transcript in corpus.transcripts]
+
+    def _vocabulary_mask(self, vocabulary, items):
+        if items is None:
+            return None
+        mask = np.zeros(len(vocabulary), dtype=bool)
+        mask[vocabulary.ids_of(items)] = True
+        return mask
+
+    def _term_masks(self, term: Term):
+        store = self.store
+        return [(store.word, self._vocabulary_mask(store.words, term.words)),
+                (store.pos, self._vocabulary_mask(store.parts_of_speech, term.POS)),
+                (store.lang, self._vocabulary_mask(store.langs, term.lang))]
+
+    def _anchor(self, terms: list):
+        '''
+        (position in the pattern, index lookup arguments) of the term with the fewest postings, None when every term is a wildcard
+        '''
+        best, best_count = None, None
+        for i, term in enumerate(terms):
+            if term == Term(None, None, None):
+                continue
+            lookup = {"words": term.words, "POS": term.POS, "lang": term.lang[0] if term.lang and len(term.lang) == 1 else None}
+            count = self.index.count(**lookup)
+            if best is None or count < best_count:
+                best, best_count = (i, lookup), count
+        return best
+
+    def matches(self, terms: list, groups: list=None, main_lang: str=None):
+        '''
+        Token rows (in corpus order) of the first token of every match of the terms within a single utterance,
+        optionally restricted to transcripts of some groups or main language
+        '''
+        store = self.store
+        n = len(terms)
+        anchor = self._anchor(terms)
+        if anchor is None:
+            position = None
+            starts = np.arange(max(len(store) - n + 1, 0))
+        else:
+            # the postings are put in corpus order once the candidates are filtered
+            position, lookup = anchor
+            starts = self.index.lookup(**lookup, ordered=False) - position
+            starts = starts[(starts >= 0) & (starts + n <= len(store))]
+        if len(starts) == 0:
+            return starts.astype(np.int64)
+        # tokens of an utterance are contiguous, so a match stays in one utterance when its first and last tokens do
+        starts = starts[store.utterance[starts] == store.utterance[starts + n - 1]]
+        if groups or main_lang:
+            starts = starts[store.select_transcripts(groups, main_lang)[store.transcript[starts]]]
+        for i, term in enumerate(terms):
+            if i == position: # the postings of the anchor already match its words and POS
+                term = Term(None, None, None if lookup["lang"] is not None else term.lang)
+            for column, mask in self._term_masks(term):
+                if mask is not None:
+                    starts = starts[mask[column[starts + i]]]
+        return np.sort(starts).astype(np.int64) if anchor is not None else starts.astype(np.int64)
+
+    def search(self, pattern: str, groups: list=None, main_lang: str=None):
+        '''
+        matches() of a pattern string, cached
+        '''
+        key = (" ".join(pattern.split()), tuple(sorted(set(groups))) if groups else None, main_lang)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        result = self.matches(parse_pattern(pattern, self.store.parts_of_speech), groups, main_lang)
+        with self.lock:
+            self.cache[key] = result
+            while len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+        return result
+
+    def kwic(self, start: int, length: int, context: int=5):
+        '''
+        Keyword in context line of the match of length tokens starting at token row start, with up to context words
+        of the utterance on each side
+        '''
+        store = self.store
+        words = store.words.as_array()
+        utterance = int(store.utterance[start])
+        transcript = int(store.transcript[start])
+        utt_start, utt_end = self.utt_offsets[utterance], self.utt_offsets[utterance + 1]
+        end = start + length
+        return {
+            "transcript": self.files[transcript],
+            "participant_id": int(store.participant_id[transcript]),
+            "utterance": utterance - int(self.transcript_utt_offsets[transcript]),
+            "position": int(store.position[start]),
+            "time_start": int(store.utt_start[utterance]),
+            "time_end": int(store.utt_end[utterance]),
+            "left": " ".join(words[store.word[max(utt_start, start - context):start]]),
+            "match": " ".join(words[store.word[start:end]]),
+            "right": " ".join(words[store.word[end:min(utt_end, end + context)]]),
+            "tokens": [f'{words[w]}.{store.parts_of_speech[p]}.{store.langs[l]}' for w, p, l in zip(store.word[start:end], store.pos[start:end], store.lang[start:end])]
+        }
+
+    def concordance(self, pattern: str, groups: list=None, main_lang: str=None, offset: int=0, limit: int=100, context: int=5):
+        '''
+        Inputs:
+            - pattern: space separated word.POS.lang terms, see the module docstring
+            - groups: (optional) participant groups, eg [100, 500]
+            - main_lang: (optional) main language of the transcripts searched
+            - offset, limit: the page of matches returned, in corpus order
+            - context: words of the utterance shown on each side of a match
+        Outputs:
+            - (total number of matches, iterator over the kwic() lines of the page)
+        '''
+        length = len(parse_pattern(pattern, self.store.parts_of_speech))
+        starts = self.search(pattern, groups, main_lang)
+        page = starts[offset:offset + limit].tolist()
+        return len(starts), (self.kwic(start, length, context) for start in page)
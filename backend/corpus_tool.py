@@ -1,64 +1,309 @@
-import re, io, gc
+import os, re, io, gc, csv
 import json, base64
-from util import get_cha_files_in_dir
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from util import get_cha_files_in_dir, iter_cha_records
+from token_store import TokenStore, TokenIndex, GroupFrequencies, top_n
+from snapshot import CorpusSnapshot
+from metrics import stage
 from wordcloud import WordCloud
-from lexical_diversity import lex_div as ld
+import diversity, group_stats
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.stats import f_oneway, ttest_ind
 
 matplotlib.use('Agg')
 
+PARTICIPANT_ID_PATTERN = re.compile(r'[0-9]+')
+CODE_SWITCH_MARK_PATTERN = re.compile(r'@s')
+CONTENT_POS = {'NOUN', 'VERB', 'ADJ', 'ADV'}
+WORD_CLOUD_MAX_WORDS = 1000
+# groups compared by the boxplots, the monolingual groups only narrated in one language
+BOXPLOT_GROUPS = {None: [100, 200, 300, 400, 500, 600, 700], "eng": [100, 200, 300, 400, 500], "spa": [100, 200, 500, 600, 700]}
+CLITICS = ['lo', 'los', 'la', 'las', 'le', 'les']
+# columns of the csv written by extract_enclitic.py
+CLITICS_HEADER = ['participant_id', 'file', 'utterance', 'clitic', 'token']
+CLITICS_PATH = 'clitics.csv'
+
 def calc_ratio(numerator: float, denominator: float):
     if denominator == 0:
         return 0
     else:
         return round(float(numerator) / float(denominator),3)
 
+def boxplot_stats(values: list, whis: float=1.5):
+    '''
+    The numbers matplotlib draws for one box of a boxplot, without matplotlib
+    Inputs:
+        - values: the data of the box
+        - whis: whiskers reach the furthest values within whis * IQR of the quartiles
+    Outputs:
+        - dict of n, mean, median, q1, q3, whislo, whishi and fliers (outliers), None when there is no data
+    '''
+    x = np.asarray(values, dtype=float)
+    if len(x) == 0:
+        return None
+    q1, median, q3 = np.percentile(x, [25, 50, 75])
+    iqr = q3 - q1
+    upper = x[x <= q3 + whis * iqr]
+    lower = x[x >= q1 - whis * iqr]
+    whishi = q3 if len(upper) == 0 or upper.max() < q3 else upper.max()
+    whislo = q1 if len(lower) == 0 or lower.min() > q1 else lower.min()
+    return {
+        'n': len(x),
+        'mean': float(x.mean()),
+        'median': float(median),
+        'q1': float(q1),
+        'q3': float(q3),
+        'whislo': float(whislo),
+        'whishi': float(whishi),
+        'fliers': np.concatenate([x[x < whislo], x[x > whishi]]).tolist()
+    }
+
+def load_clitics(path: str):
+    '''
+    Inputs:
+        - path: csv written by extract_enclitic.py, older runs wrote headerless "participant_id, clitic" lines
+    Outputs:
+        - {participant_id: {clitic: count}}
+    '''
+    index = {}
+    with open(path, 'r', encoding='utf-8', errors="ignore", newline='') as f:
+        lines = [line for line in csv.reader(f) if line]
+    if lines and lines[0][0] == CLITICS_HEADER[0]:
+        clitic_column = CLITICS_HEADER.index('clitic')
+        lines = [[line[0], line[clitic_column]] for line in lines[1:]]
+    for line in lines:
+        counts = index.setdefault(int(line[0]), {})
+        clitic = line[1].strip()
+        counts[clitic] = counts.get(clitic, 0) + 1
+    return index
+
+def boxplot_all_groups(data: list, groups: list):
+    '''
+    Boxplot data of some groups spread over a box per group of the corpus, empty for the groups that are not there
+    '''
+    return [data[groups.index(g)] if g in groups else [] for g in BOXPLOT_GROUPS[None]]
+
+def group_tests(data: list, groups: list):
+    '''
+    ANOVA of the per group data, and Student's t-tests of the pairs of groups that differ significantly when the ANOVA is significant
+    '''
+    X = np.concatenate([np.asarray(x, dtype=float) for x in data])
+    labels = np.repeat(groups, [len(x) for x in data])
+    anova = group_stats.anova(X, labels, groups)
+    anova = group_stats.AnovaResult(float(anova.statistic[0]), float(anova.pvalue[0]))
+    significant = []
+    if anova.pvalue < 0.05:
+        pairs, ttests = group_stats.pairwise_ttests(X, labels, groups)
+        for p, (group_i, group_j) in enumerate(pairs):
+            if ttests.pvalue[p, 0] < 0.05:
+                significant.append((group_i, group_j, group_stats.TTestResult(float(ttests.statistic[p, 0]), float(ttests.pvalue[p, 0]), float(ttests.df[p, 0]))))
+    return anova, significant
+
+def boxplot_results(data: list, groups: list, detailed: bool=False):
+    '''
+    The statistics reported with a boxplot of per group data: means, standard deviations, ANOVA and significant t-tests,
+    and with detailed also the medians, ranges and IQRs
+    '''
+    anova, significant = group_tests(data, groups)
+    if not detailed:
+        return {
+            "data": data,
+            "means": [np.mean(x) for x in data],
+            "standard_deviations": [np.std(x) for x in data],
+            "ANOVA": anova,
+            "significant_t-tests": significant
+        }
+    return {
+        "data": data,
+        "means": [np.mean(x) for x in data],
+        "medians": [np.median(x) for x in data],
+        "ranges": [(min(x), max(x)) for x in data],
+        "standard_deviations": [np.std(x) for x in data],
+        "ANOVA": anova,
+        "significant_t-tests": significant,
+        "IQRs": [np.quantile(x, [0.25, 0.75]) for x in data]
+    }
+
+def parse_transcript(file: str):
+    '''
+    The Transcript of the file, None when the file was removed in the meantime
+    '''
+    try:
+        return Transcript(file)
+    except FileNotFoundError:
+        return None
+
 class Corpus:
-    def __init__(self, dir_path: str):
+    def __init__(self, dir_path: str, snapshot_path: str=None, workers: int=None, chunksize: int=None, previous=None):
+        '''
+        Inputs:
+            - dir_path: folder containing the "Tagged Transcriptions (group xxx)" folders
+            - snapshot_path: (optional) file used to cache parsed transcripts between runs
+            - workers: (optional) number of processes used to parse transcripts, parsing is serial when unset or 1
+            - chunksize: (optional) number of files handed to a worker process at a time
+            - previous: (optional) an older Corpus of the same folder whose transcripts are reused for files that did not change
+        '''
         self.dir = dir_path
-        self.transcripts = self._parse_transcripts()
-
-    def _parse_transcripts(self):
-        result = []
-        for file in get_cha_files_in_dir(self.dir):
-            if "Tagged Transcriptions" not in file:
-                continue
-            result.append(Transcript(file))
+        self.snapshot_path = snapshot_path
+        self.workers = workers
+        self.chunksize = chunksize
+        self.files = self._list_files()
+        self.file_stats = {file: self._file_stat(file) for file in self.files}
+        self.files = [file for file in self.files if self.file_stats[file] is not None] # removed since the folder was listed
+        self.transcripts = self._parse_transcripts(previous)
+        self.token_store = TokenStore.merge([transcript.token_store for transcript in self.transcripts])
+        self.index = TokenIndex(self.token_store)
+        # token rows (in the corpus store) of the code switches of every transcript
+        self.switch_points = np.concatenate([transcript.switch_points + offset for transcript, offset in zip(self.transcripts, self.token_store.offsets)] + [np.zeros(0, dtype=np.int64)])
+        self.frequencies = GroupFrequencies(self.token_store)
+        self.clitics = None # (path, file stat, load_clitics(path)) of the last clitic_index call
+
+    def occurrences(self, words: list=None, POS: list=None, lang: str=None, groups: list=None, main_lang: str=None):
+        '''
+        Postings (transcript, utterance, position, time) of every token of the given words/POS/lang,
+        optionally restricted to transcripts of some groups or main language
+        '''
+        rows = self.index.lookup(words, POS, lang)
+        if groups or main_lang:
+            rows = rows[self.token_store.select_transcripts(groups, main_lang)[self.token_store.transcript[rows]]]
+        return self.index.postings_of(rows)
+
+    def lexical_diversity_table(self, outfile: str=None):
+        '''
+        Inputs:
+            - outfile: (optional) path of a csv file to also write the table to
+        Outputs:
+            - structured array with the participant id and every measure_lexical_diversity() stat, one row per transcript
+        '''
+        reports = [transcript.measure_lexical_diversity() for transcript in self.transcripts]
+        stats = list(reports[0]) if reports else []
+        dtype = [('participant_id', np.int64)] + [(stat, np.float64 if stat.endswith(('ratio', 'ttr', 'mattr', 'mtld')) else np.int64) for stat in stats]
+        table = np.array([(transcript.participant_id, *report.values()) for transcript, report in zip(self.transcripts, reports)], dtype=dtype)
+        if outfile:
+            np.savetxt(outfile, table, delimiter=',', header=','.join(table.dtype.names), comments='', fmt=['%d' if table.dtype[i].kind == 'i' else '%.3f' for i in range(len(dtype))])
+        return table
+
+    def clitic_index(self, path: str=CLITICS_PATH):
+        '''
+        {participant_id: {clitic: count}} of the clitics extracted by extract_enclitic.py, only read again once the file changes
+        '''
+        stat = self._file_stat(path)
+        if self.clitics is None or self.clitics[:2] != (path, stat):
+            self.clitics = (path, stat, load_clitics(path))
+        return self.clitics[2]
+
+    def changes(self):
+        '''
+        Files added, changed and removed on disk since the corpus was loaded, as {"added": [...], "changed": [...], "removed": [...]}
+        '''
+        files = self._list_files()
+        loaded, on_disk = set(self.files), set(files)
+        return {
+            'added': [file for file in files if file not in loaded],
+            'changed': [file for file in files if file in loaded and self._file_stat(file) != self.file_stats[file]],
+            'removed': [file for file in self.files if file not in on_disk]
+        }
+
+    def reload(self):
+        '''
+        A new Corpus of the folder's current contents, only files that were added or changed get parsed.
+        The corpus itself is left untouched so it can keep serving until the new one replaces it
+        '''
+        return Corpus(self.dir, self.snapshot_path, self.workers, self.chunksize, previous=self)
+
+    def _list_files(self):
+        return [file for file in get_cha_files_in_dir(self.dir) if "Tagged Transcriptions" in file]
+
+    def _file_stat(self, file: str):
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None # removed in the meantime
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def _parse_transcripts(self, previous=None):
+        files = self.files
+        reusable = {}
+        if previous is not None:
+            reusable = {file: transcript for file, transcript in zip(previous.files, previous.transcripts) if previous.file_stats[file] == self.file_stats.get(file)}
+        # the snapshot is not even opened when a reload finds nothing added, changed or removed
+        snapshot = None
+        if self.snapshot_path and (len(reusable) < len(files) or previous is not None and len(previous.files) != len(reusable)):
+            snapshot = CorpusSnapshot(self.snapshot_path)
+        cached = [reusable.get(file) or (snapshot.get(file) if snapshot else None) for file in files]
+        missing = [file for file, transcript in zip(files, cached) if transcript is None]
+        parsed = dict(zip(missing, self._load_transcripts(missing)))
+        result = [parsed[file] if transcript is None else transcript for file, transcript in zip(files, cached)]
+        if any(transcript is None for transcript in result):
+            # files removed while the corpus was loading
+            self.files = [file for file, transcript in zip(files, result) if transcript is not None]
+            result = [transcript for transcript in result if transcript is not None]
+        if snapshot:
+            for file in missing:
+                if parsed[file] is not None:
+                    snapshot.put(file, parsed[file])
+            snapshot.retain(self.files)
+            if snapshot.dirty:
+                snapshot.save()
         return result
 
+    def _load_transcripts(self, files: list):
+        '''
+        Parse the files into Transcripts, in the same order as the input list (None for files removed in the meantime)
+        '''
+        if not self.workers or self.workers < 2 or len(files) < 2:
+            return [parse_transcript(file) for file in files]
+        chunksize = self.chunksize or max(1, len(files) // (self.workers * 4))
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                return list(pool.map(parse_transcript, files, chunksize=chunksize))
+        except (OSError, BrokenProcessPool):
+            # eg no semaphore support in a sandboxed container, or a worker was killed
+            return [parse_transcript(file) for file in files]
+
 class Transcript:
-    def __init__(self, cha_file_path):
+    def __init__(self, cha_file_path, use_mmap: bool=False):
         self.filename = cha_file_path
-        self.participant_id = self.detect_participant_id()
-        langs = self.detect_languages()
-        self.main_lang = langs[0]
-        self.secondary_lang = None if len(langs) < 2 else langs[1]
-        self.utterances = self.parse_utterances()
-        self.types_tokens = self.count_types_tokens()
+        self.participant_id = None
+        self.main_lang = None
+        self.secondary_lang = None
+        self.utterances = self.parse_cha_file(use_mmap)
+        assert self.participant_id is not None
         self.duration = 0 if len(self.utterances) < 1 else int(self.utterances[-1]['time_end'])
+        self.token_store = TokenStore.from_transcript(self)
+        self.switch_points = self.token_store.switch_points() # token rows of the code switches
+        self.types_tokens = self.count_types_tokens()
+        self.diversity_memo = {} # (measure, language, POS filter) -> score
+        self.lexical_diversity = None # measure_lexical_diversity() report, filled in on first use
 
-    def detect_participant_id(self):
-        participant_id = None
-        with open(self.filename, 'r', encoding='utf-8', errors="ignore") as f:
-            for line in f:
-                if re.search(r'@Participants:', line):
-                    participant_id = re.search(r'[0-9]+', line).group(0)
-        assert participant_id is not None
-        return int(participant_id)
-
-    def detect_languages(self):
-        with open(self.filename, 'r', encoding='utf-8', errors="ignore") as f:
-            secondary_lang = None
-            for line in f:
-                if re.search(r'Languages:', line):
-                    langs = [x.replace(' ', '').replace('\t', '').replace('\n', '') for x in line.split(":")[-1].split(',')]
-                    main_lang = langs[0].strip(" ")
-                    if len(langs) > 1:
-                        secondary_lang = langs[1]
-        return [main_lang, secondary_lang]
+    def parse_cha_file(self, use_mmap: bool=False):
+        '''
+        Reads the headers and utterances of the transcript in a single pass over the file
+        '''
+        utterances = []
+        par_line = None
+        timestamp = None
+        for record in iter_cha_records(self.filename, use_mmap):
+            if record.kind == "pos":
+                if par_line is not None:
+                    utterances.append(self.parse_pos_tier(record.text, par_line, timestamp))
+            elif record.kind == "utterance":
+                par_line = record.text
+                timestamp = record.timestamp
+            elif record.kind == "header":
+                self.read_header(record.text)
+        return utterances
+
+    def read_header(self, line: str):
+        if '@Participants:' in line:
+            self.participant_id = int(PARTICIPANT_ID_PATTERN.search(line).group(0))
+        elif 'Languages:' in line:
+            langs = [x.replace(' ', '').replace('\t', '').replace('\n', '') for x in line.split(":")[-1].split(',')]
+            self.main_lang = langs[0].strip(" ")
+            if len(langs) > 1:
+                self.secondary_lang = langs[1]
 
     def __str__(self):
         return json.dumps({
@@ -69,191 +314,129 @@ class Transcript:
             'duration': self.duration
         })
 
+    def _filtered_word_ids(self, utterances: list, language:str=None, POS_filter:list=None):
+        store = self.token_store if utterances is self.utterances else TokenStore.from_utterances(utterances)
+        return store.word[store.mask(lang=language, POS=POS_filter)]
+
+    def _calc_diversity(self, measure, utterances: list, language:str=None, POS_filter:list=None):
+        if utterances is not self.utterances:
+            return round(measure(self._filtered_word_ids(utterances, language, POS_filter)),3)
+        key = (measure.__name__, language, None if POS_filter is None else tuple(sorted(set(POS_filter))))
+        if key not in self.diversity_memo:
+            self.diversity_memo[key] = round(measure(self._filtered_word_ids(utterances, language, POS_filter)),3)
+        return self.diversity_memo[key]
+
     def calc_mtld(self, utterances: list, language:str=None, POS_filter:list=None):
-            text = []
-            for utterance in utterances:
-                for token in utterance['tokens']:
-                    word = token.split(".")[0]
-                    lang_id = token.split(".")[2]
-                    pos_tag  = token.split(".")[1]
-                    if (language == None or language == lang_id) and (POS_filter == None or pos_tag in POS_filter):
-                        text.append(word)
-            return round(ld.mtld(text),3)
+        return self._calc_diversity(diversity.mtld, utterances, language, POS_filter)
 
     def calc_mattr(self, utterances: list, language:str=None, POS_filter:list=None):
-        text = []
-        for utterance in utterances:
-            for token in utterance['tokens']:
-                word = token.split(".")[0]
-                lang_id = token.split(".")[2]
-                pos_tag  = token.split(".")[1]
-                if (language == None or language == lang_id) and (POS_filter == None or pos_tag in POS_filter):
-                    text.append(word)
-        return round(ld.mattr(text),3)
+        return self._calc_diversity(diversity.mattr, utterances, language, POS_filter)
 
     def measure_lexical_diversity(self):
-        # get stats for whole narrative, including both languages
-        # initialize overall/bilingual type counts
-        total_types = 0
-        total_content_types = 0 
-        total_functional_types = 0
-        # initialize english type counts
-        english_types = 0
-        english_content_types = 0
-        english_functional_types = 0
-        # initialize spanish type counts
-        spanish_types = 0
-        spanish_content_types = 0
-        spanish_functional_types = 0
-        # initialize overall token counts
-        total_tokens = 0 
-        total_content_tokens = 0 
-        total_functional_tokens = 0 
-        # initialize english token counts
-        english_tokens = 0
-        english_content_tokens = 0
-        english_functional_tokens = 0 
-        # initialize spanish token counts
-        spanish_tokens = 0 
-        spanish_content_tokens = 0 
-        spanish_functional_tokens = 0
-        words_seen = []
+        '''
+        Type/token, content/functional and MATTR/MTLD stats for both languages combined and for each language,
+        computed once and cached on the transcript
+        '''
+        if self.lexical_diversity is None:
+            self.lexical_diversity = self._lexical_diversity_report()
+        return self.lexical_diversity
+
+    def _lexical_diversity_report(self):
+        # (types, tokens) per scope, scopes are "total", "english", "spanish" and their _content/_functional parts
+        counts = {f'{scope}{part}': [0, 0] for scope in ["total", "english", "spanish"] for part in ["", "_content", "_functional"]}
+        lang_scopes = {"eng": "english", "spa": "spanish"}
+        words_seen = set()
         for lang in self.types_tokens:
-            for token_type in self.types_tokens[lang]:
-                word = token_type.split(".")[0]
-                part_of_speech = token_type.split(".")[1]
+            lang_scope = lang_scopes.get(lang)
+            for token_type, token_freq in self.types_tokens[lang].items():
+                word, part_of_speech = token_type.split(".")[:2]
                 if word in words_seen:
                     continue # only count homonyms once
-                words_seen.append(word)
-                token_freq = self.types_tokens[lang][token_type]
-                total_types += 1
-                total_tokens += token_freq
-                if lang == "eng":
-                    english_types += 1
-                    english_tokens += token_freq
-                    if part_of_speech in ['NOUN', 'VERB', 'ADJ', 'ADV']:
-                        english_content_types += 1
-                        english_content_tokens += token_freq
-                        total_content_types += 1
-                        total_content_tokens += token_freq
-                    else:
-                        english_functional_types += 1
-                        english_functional_tokens += token_freq
-                        total_functional_types += 1
-                        total_functional_tokens += token_freq
-                elif lang == "spa":
-                    spanish_types += 1
-                    spanish_tokens += token_freq
-                    if part_of_speech in ['NOUN', 'VERB', 'ADJ', 'ADV']:
-                        spanish_content_types += 1
-                        spanish_content_tokens += token_freq
-                        total_content_types += 1
-                        total_content_tokens += token_freq
-                    else:
-                        spanish_functional_types += 1
-                        spanish_functional_tokens += token_freq
-                        total_functional_types += 1
-                        total_functional_tokens += token_freq
-
-        return {
-            # overall/bilingual stats
-            'total_types': total_types,
-            'total_tokens': total_tokens,
-            'total_type_token_ratio': calc_ratio(total_types, total_tokens),
-            'total_mattr': self.calc_mattr(self.utterances),
-            'total_mtld': self.calc_mtld(self.utterances),
-            'total_content_tokens': total_content_tokens,
-            'total_content_types': total_content_types,
-            'total_content_ttr': calc_ratio(total_content_types, total_content_tokens),
-            'total_functional_tokens': total_functional_tokens,
-            'total_functional_types': total_functional_types,
-            'total_functional_ttr': calc_ratio(total_functional_types, total_functional_tokens),
-            # english only stats
-            'english_types': english_types,
-            'english_tokens': english_tokens,
-            'english_type_token_ratio': calc_ratio(english_types, english_tokens),
-            'english_mattr': self.calc_mattr(self.utterances, "eng"),
-            'english_mtld': self.calc_mtld(self.utterances, "eng"),
-            'english_content_tokens': english_content_tokens,
-            'english_content_types': english_content_types,
-            'english_content_ttr': calc_ratio(english_content_types, english_content_tokens),
-            'english_functional_tokens': english_functional_tokens,
-            'english_functional_types': english_functional_types,
-            'english_functional_ttr': calc_ratio(english_functional_types, english_functional_tokens),
-            # spanish only stats
-            'spanish_types': spanish_types,
-            'spanish_tokens': spanish_tokens,
-            'spanish_type_token_ratio': calc_ratio(spanish_types, spanish_tokens),
-            'spanish_mattr': self.calc_mattr(self.utterances, "spa"),
-            'spanish_mtld': self.calc_mtld(self.utterances, "spa"),
-            'spanish_content_tokens': spanish_content_tokens,
-            'spanish_content_types': spanish_content_types,
-            'spanish_content_ttr': calc_ratio(spanish_content_types, spanish_content_tokens),
-            'spanish_functional_tokens': spanish_functional_tokens,
-            'spanish_functional_types': spanish_functional_types,
-            'spanish_functional_ttr': calc_ratio(spanish_functional_types, spanish_functional_tokens),
-        }
-
-    def _is_code_switched(self, participant_line: str, word: str):
+                words_seen.add(word)
+                scopes = ["total"]
+                if lang_scope is not None:
+                    part = "_content" if part_of_speech in CONTENT_POS else "_functional"
+                    scopes += [lang_scope, f'total{part}', f'{lang_scope}{part}']
+                for scope in scopes:
+                    counts[scope][0] += 1
+                    counts[scope][1] += token_freq
+
+        report = {}
+        for scope, language in [("total", None), ("english", "eng"), ("spanish", "spa")]:
+            types, tokens = counts[scope]
+            report[f'{scope}_types'] = types
+            report[f'{scope}_tokens'] = tokens
+            report[f'{scope}_type_token_ratio'] = calc_ratio(types, tokens)
+            report[f'{scope}_mattr'] = self.calc_mattr(self.utterances, language)
+            report[f'{scope}_mtld'] = self.calc_mtld(self.utterances, language)
+            for part in ["content", "functional"]:
+                types, tokens = counts[f'{scope}_{part}']
+                report[f'{scope}_{part}_tokens'] = tokens
+                report[f'{scope}_{part}_types'] = types
+                report[f'{scope}_{part}_ttr'] = calc_ratio(types, tokens)
+        return report
+
+    def _code_switch_test(self, participant_line: str):
         '''
         We can use the annotations from the original annotation layer marked *PAR:
         to tell if a word from the POS tagged layer is code switched. The annotations are:
             a) either [-eng] or [-spa] at the beginning of the line
             b) @s appended to the end of the word
+        Returns a function telling whether a word of the line is code switched. The line is searched once, then a word
+        is code switched when the text before one of its @s marks ends with the word
         '''
-        return '[- eng]' in participant_line or '[- spa]' in participant_line or f'{word}@s' in participant_line
-    
-    def _enhanced_token_w_lang(self, participant_line, token):
-        '''
-        Returns the input token with the language appended
-        Eg: a.DET -> a.DET.eng
-        '''
-        if self._is_code_switched(participant_line, token.split(".")[0]):
-            return f'{token}.{self.secondary_lang}'
-        else:
-            return f'{token}.{self.main_lang}'
-
-    def parse_utterances(self):
-        with open(self.filename, 'r', encoding='utf-8', errors="ignore") as cha_file:
-            utterances = []
-            timestamp = None
-            for line in cha_file:
-                if "%pos:" in line:
-                    line_type = "%pos"
-                    pos_line = line
-                    tokens = []
-                    tokens_raw = [x.strip("\n") for x in line.split(" ") if x.strip("\n").replace('.', '').isalpha()]
-                    for token in tokens_raw:
-                        token = self._enhanced_token_w_lang(par_line, token)
-                        if token.split(".")[1] in ['SYM', 'X', 'PUNCT'] or token.split(".")[0] in ['xxx']:
-                            continue # ignore non word tokens
-                        tokens.append(token)
-                    utterances.append({'transcription': par_line,'tokens': tokens, 'time_start': timestamp.split("_")[0], 'time_end': timestamp.split("_")[1]})
-                elif "*PAR:" in line:
-                    line_type = "*PAR"
-                    if re.search(r'[0-9]+_[0-9]+', line):
-                            par_line = line
-                            timestamp = re.search(r'[0-9]+_[0-9]+', line).group(0)
-                    else:
-                        par_line = line
-                        while not re.search(r'[0-9]+_[0-9]+', par_line): # CLAN forces a new line on long utterances, the timestamp is at the end of all utterances
-                            par_line += cha_file.readline()
-                        timestamp = re.search(r'[0-9]+_[0-9]+', par_line).group(0)
-        return utterances
+        if '[- eng]' in participant_line or '[- spa]' in participant_line:
+            return lambda word: True
+        marks = [match.start() for match in CODE_SWITCH_MARK_PATTERN.finditer(participant_line)]
+        return lambda word: any(participant_line.endswith(word, 0, mark) for mark in marks)
+
+    def parse_pos_tier(self, pos_line: str, par_line: str, timestamp: str):
+        tokens = []
+        tokens_raw = [x.strip("\n") for x in pos_line.split(" ") if x.strip("\n").replace('.', '').isalpha()]
+        is_code_switched = self._code_switch_test(par_line)
+        for token in tokens_raw:
+            word = token.split(".")[0]
+            token = f'{token}.{self.secondary_lang if is_code_switched(word) else self.main_lang}' # eg a.DET -> a.DET.eng
+            if token.split(".")[1] in ['SYM', 'X', 'PUNCT'] or word in ['xxx']:
+                continue # ignore non word tokens
+            tokens.append(token)
+        time_start, time_end = timestamp.split("_")
+        return {'transcription': par_line,'tokens': tokens, 'time_start': time_start, 'time_end': time_end}
 
     def count_types_tokens(self):
+        '''
+        Returns {lang: {"word.POS": count}} with the types of each language in order of first occurrence
+        '''
+        store = self.token_store
         types_tokens = {"eng": {}, "spa": {}}
-        for utterance in self.utterances:
-            for token in utterance['tokens']:
-                language_tag = token.split(".")[2]
-                token_basic = f'{token.split(".")[0]}.{token.split(".")[1]}'
-                if token_basic not in types_tokens[language_tag]:
-                    types_tokens[language_tag][token_basic] = 1
-                else:
-                    types_tokens[language_tag][token_basic] += 1
+        n_words, n_pos = len(store.words), len(store.parts_of_speech)
+        keys = (store.lang.astype(np.int64) * n_pos + store.pos) * n_words + store.word
+        unique_keys, first_idx, counts = np.unique(keys, return_index=True, return_counts=True)
+        for i in np.argsort(first_idx, kind="stable"):
+            key = int(unique_keys[i])
+            lang_pos, word = divmod(key, n_words)
+            lang, pos = divmod(lang_pos, n_pos)
+            lang_types = types_tokens.setdefault(store.langs[lang], {})
+            lang_types[f'{store.words[word]}.{store.parts_of_speech[pos]}'] = int(counts[i])
         return types_tokens
 
+class CorpusView:
+    '''
+    The transcripts and tokens picked by one set of visualization filters, computed once and shared by every chart drawn for them
+    '''
+    def __init__(self, corpus: Corpus, groups: list=None, target_lang: str=None, POS_filter: list=None):
+        store = corpus.token_store
+        self.groups = groups
+        self.target_lang = target_lang
+        self.POS_filter = POS_filter
+        with stage("filter"):
+            self.selected = store.select_transcripts(groups, target_lang)
+            self.transcripts = [corpus.transcripts[i] for i in np.flatnonzero(self.selected)]
+            self.token_mask = store.mask(transcripts=self.selected, POS=POS_filter)
+
 class Visualizer:
+    CHART_KINDS = ["barchart", "mtld_boxplot", "mattr_boxplot", "word_cloud"]
+
     def __init__(self, corpus: Corpus):
         self.corpus = corpus
 
@@ -270,17 +453,11 @@ class Visualizer:
         allowed_groups = [100, 200, 300, 400, 500, 600, 700]
         if group not in allowed_groups:
             raise Exception(f'{group} not in {allowed_groups}')
-        tokens = []
-        for transcript in self.corpus.transcripts:
-            id_diff = transcript.participant_id-group
-            if id_diff >=0 and id_diff < 100: # eg id 543 with group 500 gives id_diff 43
-                if (language == None) or (language == transcript.main_lang):
-                    for utterance in transcript.utterances:
-                        for token in utterance['tokens']:
-                            tokens.append(token)
-        if len(tokens) < 1:
+        store = self.corpus.token_store
+        lang_counts = store.lang_counts(store.mask(transcripts=store.select_transcripts([group], language)))
+        if sum(lang_counts.values()) < 1:
             return
-        percentages = self._calc_language_percentage(tokens)
+        percentages = self._calc_language_percentage(lang_counts)
         fig, ax = plt.subplots()
         ax.pie([percentages['english'], percentages['spanish']], labels=["English", "Spanish"],autopct='%1.1f%%')
         if language:
@@ -292,28 +469,20 @@ class Visualizer:
         """
         Generate pie charts of tokens in English vs tokens in Spanish
         """
-        tokens = []
-        for utterance in transcript.utterances:
-            for token in utterance['tokens']:
-                tokens.append(token)
-        if len(tokens) < 1:
+        lang_counts = transcript.token_store.lang_counts()
+        if sum(lang_counts.values()) < 1:
             return
-        percentages = self._calc_language_percentage(tokens)
+        percentages = self._calc_language_percentage(lang_counts)
         fig, ax = plt.subplots()
         ax.pie([percentages['english'], percentages['spanish']], labels=["English", "Spanish"],autopct='%1.1f%%')
         plt.savefig(f'{output_dir}/{transcript.participant_id}_{transcript.main_lang}')
 
-    def _calc_language_percentage(self, tokens):
-            english_tokens = 0
-            spanish_tokens = 0
-            for token in tokens:
-                language = token.split(".")[2]
-                if language == "eng":
-                    english_tokens += 1
-                elif language == "spa":
-                    spanish_tokens += 1
-                else:
-                    raise f'Unexpected language tag:{language}'
+    def _calc_language_percentage(self, lang_counts: dict):
+            for language in lang_counts:
+                if language not in ["eng", "spa"]:
+                    raise Exception(f'Unexpected language tag:{language}')
+            english_tokens = lang_counts.get("eng", 0)
+            spanish_tokens = lang_counts.get("spa", 0)
             total_tokens = english_tokens + spanish_tokens
             return {
                 'english': calc_ratio(english_tokens, total_tokens),
@@ -326,116 +495,103 @@ class Visualizer:
             if group and id_diff >=0 and id_diff < 100:
                 return True
         return False
-        
+
+    def find_occurrences(self, words: list, POS: list=None, lang: str=None, groups: list=None, main_lang: str=None):
+        '''
+        Where does word W with POS P in language L occur? See Corpus.occurrences
+        '''
+        return self.corpus.occurrences(words, POS, lang, groups, main_lang)
+
+    def _word_ids(self, words):
+        '''
+        Vocabulary ids of the words, a single word may be given as a string
+        '''
+        return self.corpus.token_store.words.ids_of([words] if isinstance(words, str) else words)
 
     def mtld_boxplot(self, outfile:str=None, target_lang:str=None, POS_filter:list=None, group_filter:list=None):
-        data = [[],[],[],[],[],[],[]]
-        for transcript in self.corpus.transcripts:
-            if (target_lang and transcript.main_lang != target_lang) or (group_filter and not self.is_in_group(group_filter, transcript.participant_id)):
-                continue
-            group_index = int(str(transcript.participant_id)[0])-1
-            diversity = transcript.calc_mtld(transcript.utterances, target_lang, POS_filter)
-            if diversity == 0:
-                print(transcript.participant_id)
-                continue
-            data[group_index].append(diversity)
-        return self.render_boxplot(data, outfile)
+        return self.render_boxplot(self.diversity_data(CorpusView(self.corpus, group_filter, target_lang, POS_filter), "mtld"), outfile)
 
     def mattr_boxplot(self, outfile:str=None, target_lang:str=None, POS_filter:list=None, group_filter:list=None):
+        return self.render_boxplot(self.diversity_data(CorpusView(self.corpus, group_filter, target_lang, POS_filter), "mattr"), outfile)
+
+    def diversity_data(self, view: CorpusView, measure: str):
+        '''
+        MTLD or MATTR of every transcript in the view, one list per group
+        '''
         data = [[],[],[],[],[],[],[]]
-        for transcript in self.corpus.transcripts:
-            if (target_lang and transcript.main_lang != target_lang) or (group_filter and not self.is_in_group(group_filter, transcript.participant_id)):
-                continue
-            group_index = int(str(transcript.participant_id)[0])-1
-            diversity = transcript.calc_mattr(transcript.utterances, target_lang, POS_filter)
-            if diversity == 0:
-                print(transcript.participant_id)
-                continue
-            data[group_index].append(diversity)
-        return self.render_boxplot(data, outfile)
+        with stage("aggregate"):
+            for transcript in view.transcripts:
+                group_index = int(str(transcript.participant_id)[0])-1
+                if measure == "mtld":
+                    diversity = transcript.calc_mtld(transcript.utterances, view.target_lang, view.POS_filter)
+                else:
+                    diversity = transcript.calc_mattr(transcript.utterances, view.target_lang, view.POS_filter)
+                if diversity == 0:
+                    continue # no words left after the filters
+                data[group_index].append(diversity)
+        return data
 
     def render_boxplot(self, data, outfile:str=None):
-        fig, ax = plt.subplots()
-        ax.boxplot(data)
+        with stage("plot"):
+            fig, ax = plt.subplots()
+            ax.boxplot(data)
+        chart = None
         if outfile:
             plt.savefig(outfile)
         else:
-            return self.get_fig_encoding()
+            chart = self.get_fig_encoding()
+        plt.close(fig)
+        return chart
 
     
+    def top_words(self, groups:list=None, target_lang:str=None, top_N_most_frequent:int=400, POS_filter:list=None):
+        '''
+        The N most frequent words of the selected groups' narratives in target_lang, most frequent first.
+        Returns a list of (word, english count, other language count)
+        '''
+        frequencies = self.corpus.frequencies
+        POS_filter = POS_filter or None
+        with stage("aggregate"):
+            total_counts = frequencies.counts(groups, target_lang, POS=POS_filter)
+            eng_counts = frequencies.counts(groups, target_lang, lang="eng", POS=POS_filter)
+            return [(self.corpus.token_store.words[word_id], int(eng_counts[word_id]), int(total_counts[word_id] - eng_counts[word_id])) for word_id in top_n(total_counts, top_N_most_frequent)]
+
     def word_freq_barchart_group(self, groups:list=None, outfile:str=None, target_lang:str=None, top_N_most_frequent:int=None, POS_filter:list=None):
-        data = {}
+        x, y, colors, width = self.barchart_data(CorpusView(self.corpus, groups, target_lang, POS_filter), top_N_most_frequent)
+        return self.render_barchart(x, y, colors, outfile, width=width)
+
+    def barchart_data(self, view: CorpusView, top_N_most_frequent:int=None):
+        '''
+        Bar labels, lengths, colors and the figure width of the group word frequency barchart
+        '''
         if not top_N_most_frequent:
             top_N_most_frequent = 400
-        for transcript in self.corpus.transcripts:
-            if target_lang and transcript.main_lang != target_lang:
-                    continue
-            for lang in transcript.types_tokens:
-                for group in groups:
-                    group = int(group)
-                    id_diff = None if not group else transcript.participant_id-group
-                    if (group == None) or (group and id_diff >=0 and id_diff < 100):
-                        for token in transcript.types_tokens[lang]:
-                            word = token.split(".")[0]
-                            part_of_speech = token.split(".")[1]
-                            if POS_filter and part_of_speech not in POS_filter:
-                                continue
-                            if word not in data:
-                                data[word] = {lang: transcript.types_tokens[lang][token]}
-                            elif word in data and lang not in data[word]:
-                                data[word][lang] = transcript.types_tokens[lang][token]
-                            else:
-                                data[word][lang] += transcript.types_tokens[lang][token]
-        if top_N_most_frequent:
-            most_freq = [(None, 0) for x in range(top_N_most_frequent)]
-            for word in data:
-                freq = 0
-                for lang in data[word]:
-                    freq += data[word][lang]
-                for i in range(len(most_freq)):
-                    if freq > most_freq[i][1]:
-                        most_freq[i] = (word, freq)
-                        break
         x = []
         y = []
         colors = []
-        for word in data.keys():
-            counts = [0, 0]
-            for lang in data[word]:
-                if lang == "eng":
-                    counts[0] += data[word][lang]
-                else:
-                    counts[1] += data[word][lang]
-            def draw_counts(counts):
-                # first append bigger one so it is drawn in background
-                    if counts[0] > counts[1]:
-                        x.append(word)
-                        y.append(counts[0])
-                        colors.append((0.5,0.1,0.3))
-                        x.append(word)
-                        y.append(counts[1])
-                        colors.append((0.3,0.1,0.5))
-                    else:
-                        x.append(word)
-                        y.append(counts[1])
-                        colors.append((0.3,0.1,0.5))
-                        x.append(word)
-                        y.append(counts[0])
-                        colors.append((0.5,0.1,0.3))
-
-            if top_N_most_frequent:
-                if word in [x[0] for x in most_freq]:
-                    draw_counts(counts)
+        for word, eng_count, other_count in self.top_words(view.groups, view.target_lang, top_N_most_frequent, view.POS_filter):
+            # first append bigger one so it is drawn in background
+            if eng_count > other_count:
+                x.append(word)
+                y.append(eng_count)
+                colors.append((0.5,0.1,0.3))
+                x.append(word)
+                y.append(other_count)
+                colors.append((0.3,0.1,0.5))
             else:
-                if sum(counts) > 3:
-                    draw_counts(counts)
-        
-        if group and target_lang:
-            return self.render_barchart(x, y, colors, outfile, width=50)
-        elif group:
-            return self.render_barchart(x, y, colors, outfile, width=70)
+                x.append(word)
+                y.append(other_count)
+                colors.append((0.3,0.1,0.5))
+                x.append(word)
+                y.append(eng_count)
+                colors.append((0.5,0.1,0.3))
+
+        if view.groups and view.target_lang:
+            return x, y, colors, 50
+        elif view.groups:
+            return x, y, colors, 70
         else:
-            return self.render_barchart(x, y, colors, outfile, width=120)
+            return x, y, colors, 120
 
     def word_freq_barchart_transcript(self, transcript: Transcript):
         words = []
@@ -453,19 +609,22 @@ class Visualizer:
 
     def get_fig_encoding(self):
         img_bytes = io.BytesIO()
-        plt.savefig(img_bytes, format='png', bbox_inches="tight")
+        with stage("png"): # matplotlib only rasterizes the figure when it is saved
+            plt.savefig(img_bytes, format='png', bbox_inches="tight")
         img_bytes.seek(0)
-        return base64.b64encode(img_bytes.read()).decode()
+        with stage("base64"):
+            return base64.b64encode(img_bytes.read()).decode()
 
     def render_barchart(self, X, Y, colors:list=None,outfile:str=None, width=50):
-        plt.figure(figsize=(50, len(X)/2))
-        X = X[::-1]
-        Y = Y[::-1]
-        colors = colors if colors == None else colors[::-1]
-        plt.barh(X, Y, color=colors)
-        plt.xticks(fontsize=44)
-        plt.yticks(fontsize=44)
-        plt.margins(x=0, y=0, tight=True)
+        with stage("plot"):
+            plt.figure(figsize=(50, len(X)/2))
+            X = X[::-1]
+            Y = Y[::-1]
+            colors = colors if colors == None else colors[::-1]
+            plt.barh(X, Y, color=colors)
+            plt.xticks(fontsize=44)
+            plt.yticks(fontsize=44)
+            plt.margins(x=0, y=0, tight=True)
         chart = None
         if outfile:
             plt.savefig(outfile)
@@ -484,112 +643,150 @@ class Visualizer:
         plt.close()
 
     def gen_word_cloud(self, group_filter:list=None, target_lang_filter:str=None, POS_filter:list=None, max_words:int=None):
-        freqs = {}
-        for transcript in self.corpus.transcripts:
-            if target_lang_filter and transcript.main_lang != target_lang_filter:
-                continue
-            for utterance in transcript.utterances:
-                for token in utterance['tokens']:
-                    word = token.split(".")[0]
-                    part_of_speech = token.split(".")[1]
-                    if part_of_speech not in POS_filter:
-                        continue
-                    if word not in freqs:
-                        freqs[word] = 1
-                    else:
-                        freqs[word] += 1
-        return self.render_word_cloud(freqs)
+        return self.render_word_cloud(self.word_cloud_data(CorpusView(self.corpus, group_filter, target_lang_filter, POS_filter)))
+
+    def word_cloud_data(self, view: CorpusView):
+        '''
+        {word: frequency} of the tokens in the view
+        '''
+        store = self.corpus.token_store
+        with stage("aggregate"):
+            counts = store.count_by_word(view.token_mask)
+            return {store.words[word_id]: int(counts[word_id]) for word_id in np.flatnonzero(counts)}
+
+    def chart_data(self, kinds: list, groups:list=None, target_lang:str=None, POS_filter:list=None, top_N_most_frequent:int=None):
+        '''
+        Aggregate the data of several charts (see CHART_KINDS) for the same filters, filtering the corpus only once.
+        Returns {kind: data}, the data can be drawn with render_chart
+        '''
+        view = CorpusView(self.corpus, groups, target_lang, POS_filter)
+        data = {}
+        for kind in kinds:
+            if kind == "barchart":
+                data[kind] = self.barchart_data(view, top_N_most_frequent)
+            elif kind in ["mtld_boxplot", "mattr_boxplot"]:
+                data[kind] = self.diversity_data(view, kind.split("_")[0])
+            elif kind == "word_cloud":
+                data[kind] = self.word_cloud_data(view)
+            else:
+                raise ValueError(f'unknown chart kind {kind}')
+        return data
+
+    def chart_summaries(self, kinds: list, groups:list=None, target_lang:str=None, POS_filter:list=None, top_N_most_frequent:int=None):
+        '''
+        The aggregated series behind several charts as JSON-able data, so clients can draw them. Returns {kind: summary}:
+            - barchart: {"words": [...], "eng": [...], "other": [...]} counts per language, most frequent word first
+            - mtld_boxplot/mattr_boxplot: {"100": boxplot_stats, ..., "700": boxplot_stats}
+            - word_cloud: {word: frequency} of the (at most) WORD_CLOUD_MAX_WORDS words the cloud shows
+        '''
+        view = CorpusView(self.corpus, groups, target_lang, POS_filter)
+        summaries = {}
+        for kind in kinds:
+            if kind == "barchart":
+                top_words = self.top_words(view.groups, view.target_lang, top_N_most_frequent or 400, view.POS_filter)
+                summaries[kind] = {
+                    "words": [word for word, _, _ in top_words],
+                    "eng": [eng_count for _, eng_count, _ in top_words],
+                    "other": [other_count for _, _, other_count in top_words]
+                }
+            elif kind in ["mtld_boxplot", "mattr_boxplot"]:
+                data = self.diversity_data(view, kind.split("_")[0])
+                summaries[kind] = {str((i + 1) * 100): boxplot_stats(values) for i, values in enumerate(data)}
+            elif kind == "word_cloud":
+                freqs = self.word_cloud_data(view)
+                summaries[kind] = dict(sorted(freqs.items(), key=lambda item: -item[1])[:WORD_CLOUD_MAX_WORDS])
+            else:
+                raise ValueError(f'unknown chart kind {kind}')
+        return summaries
+
+    def render_chart(self, kind: str, data):
+        if kind == "barchart":
+            x, y, colors, width = data
+            return self.render_barchart(x, y, colors, width=width)
+        elif kind in ["mtld_boxplot", "mattr_boxplot"]:
+            return self.render_boxplot(data)
+        elif kind == "word_cloud":
+            return self.render_word_cloud(data)
+        raise ValueError(f'unknown chart kind {kind}')
+
+    def charts(self, kinds: list, groups:list=None, target_lang:str=None, POS_filter:list=None, top_N_most_frequent:int=None):
+        '''
+        Render several charts for the same filters, returns {kind: base64 png}
+        '''
+        data = self.chart_data(kinds, groups, target_lang, POS_filter, top_N_most_frequent)
+        return {kind: self.render_chart(kind, data[kind]) for kind in data}
 
     def render_word_cloud(self, data):
-        wc = WordCloud(background_color="white", max_words=1000)
-        wc.generate_from_frequencies(data)
-        plt.imshow(wc, interpolation="bilinear")
-        plt.axis("off")
-        return self.get_fig_encoding()
+        with stage("plot"):
+            wc = WordCloud(background_color="white", max_words=WORD_CLOUD_MAX_WORDS)
+            wc.generate_from_frequencies(data)
+            fig = plt.figure()
+            plt.imshow(wc, interpolation="bilinear")
+            plt.axis("off")
+        chart = self.get_fig_encoding()
+        plt.close(fig)
+        return chart
+
+    def word_count_matrix(self, features: list, target_lang: str=None):
+        '''
+        Inputs:
+            - features: list of (words, POS filter) pairs, eg [(['el', 'la'], "DET"), (['lo'], "PRON")]
+            - target_lang: (optional) only count transcripts with this main language
+        Outputs:
+            - (transcript x feature) matrix of how often each transcript uses the words of each feature
+            - the group (100, 200, ...) of each transcript
+        Transcripts with fewer than 2 utterances are left out
+        '''
+        kept = [i for i, transcript in enumerate(self.corpus.transcripts) if len(transcript.utterances) >= 2 and (not target_lang or target_lang == transcript.main_lang)]
+        counts = np.zeros((len(kept), len(features)), dtype=np.int64)
+        for column, (words, POS) in enumerate(features):
+            counts[:, column] = self.corpus.token_store.count_by_transcript(self.corpus.index.lookup(self._word_ids(words), POS))[kept]
+        groups = np.array([int(str(self.corpus.transcripts[i].participant_id)[0] + '00') for i in kept], dtype=np.int64)
+        return counts, groups
+
+    def compare_word_groups(self, features: list, target_lang: str=None, **kwargs):
+        '''
+        group_stats.compare_groups of the word_count_matrix of many features at once, kwargs are passed along
+        (eg correction, permutations, bootstrap_samples)
+        '''
+        counts, groups = self.word_count_matrix(features, target_lang)
+        return group_stats.compare_groups(counts, groups, BOXPLOT_GROUPS[target_lang], **kwargs)
+
+    def word_boxplot_data(self, words: list, pos_filter: str, target_lang: str):
+        '''
+        How often each transcript uses the words, one list per group of BOXPLOT_GROUPS[target_lang]
+        '''
+        counts, transcript_groups = self.word_count_matrix([(words, pos_filter)], target_lang)
+        return [counts[transcript_groups == group, 0].tolist() for group in BOXPLOT_GROUPS[target_lang]]
 
     def gen_word_boxplots(self, words: list, pos_filter: str, target_lang:str, outfile=None):
         '''
         Generate boxplots for the distribution of word frequencies per transcript, grouped by codes 100,200,etc
         '''
-        data = [[] for x in range(5)] if target_lang else [[] for x in range(7)] # 2 (monolingual) groups fewer if filtering lang
-        if not target_lang:
-            map_group_to_data_idx = {100: 0, 200: 1, 300: 2, 400: 3, 500: 4, 600: 5, 700: 6}
-            map_data_idx_to_group = {0: 100, 1: 200, 2: 300, 3: 400, 4: 500, 5: 600, 6: 700}
-        elif target_lang == "eng":
-             map_group_to_data_idx = {100: 0, 200: 1, 300: 2, 400: 3, 500: 4}
-             map_data_idx_to_group = {0: 100, 1: 200, 2: 300, 3: 400, 4: 500}
-        elif target_lang == "spa":
-            map_group_to_data_idx = {100: 0, 200: 1, 500: 2, 600: 3, 700: 4}
-            map_data_idx_to_group = {0: 100, 1: 200, 2: 500, 3: 600, 4: 700}
-        for transcript in self.corpus.transcripts:
-            if len(transcript.utterances) < 2:
-                continue
-            if target_lang and target_lang != transcript.main_lang:
-                continue
-            group_idx = map_group_to_data_idx[int(str(transcript.participant_id)[0] + '00')]
-            counter = 0
-            for utterance in transcript.utterances:
-                for token in utterance['tokens']:
-                    word = token.split(".")[0]
-                    pos = token.split(".")[1]
-                    if (word in words) and (pos_filter == None or pos == pos_filter):
-                        counter += 1
-            data[group_idx].append(counter)
-        result_dict = {
-            "data": data,
-            "means": [np.mean(x) for x in data],
-            "standard_deviations": [np.std(x) for x in data],
-            "ANOVA": f_oneway(*data),
-            "significant_t-tests": []
-        }
-        #print("ANOVA degrees freedom within groups", sum([len(x) for x in data]) - len(data))
-        if result_dict["ANOVA"].pvalue < 0.05:
-            pairs_found = []
-            for i, data_i, in enumerate(data):
-                for j, data_j in enumerate(data):
-                    if ttest_ind(data_i, data_j).pvalue < 0.05:
-                        group_i = map_data_idx_to_group[i]
-                        group_j = map_data_idx_to_group[j]
-                        if (group_i, group_j) not in pairs_found:
-                            pairs_found.append((group_i, group_j))
-                            pairs_found.append((group_j, group_i))
-                            result_dict['significant_t-tests'].append((group_i, group_j, ttest_ind(data_i, data_j)))
-        if len(data) < 7:
-            formatted_data = [[] for x in range(7)]
-            for i, g in enumerate([100, 200, 300, 400, 500, 600, 700]):
-                if g in map_group_to_data_idx:
-                    formatted_data[i] = data[map_group_to_data_idx[g]]
-                else:
-                    formatted_data[i] = []
-            data = formatted_data
-        self.render_boxplot(data, outfile)
-        return result_dict
+        groups = BOXPLOT_GROUPS[target_lang] # 2 (monolingual) groups fewer if filtering lang
+        data = self.word_boxplot_data(words, pos_filter, target_lang)
+        self.render_boxplot(boxplot_all_groups(data, groups), outfile)
+        return boxplot_results(data, groups)
 
-    def gen_clitic_boxplots(self, with_non_clitic_pronoun=False, outfile=None):
+    def clitic_boxplot_data(self, with_non_clitic_pronoun=False, clitics_path: str=CLITICS_PATH):
+        '''
+        Clitics (and with_non_clitic_pronoun the lo/los/la/las/le/les pronouns) per participant, one list per spanish group
+        '''
         data_map = {}
         for transcript in self.corpus.transcripts:
             if transcript.main_lang == "spa":
                 data_map[transcript.participant_id] = 0
-        with open ('clitics.csv', 'r') as csv:
-            for line in csv:
-                participant_id = line.split(",")[0]
-                if participant_id in data_map:
-                    data_map[participant_id] += 1
-                else:
-                    data_map[participant_id] = 1
-            
+        for participant_id, counts in self.corpus.clitic_index(clitics_path).items():
+            data_map[participant_id] = data_map.get(participant_id, 0) + sum(counts.values())
+
         if with_non_clitic_pronoun:
-            for transcript in self.corpus.transcripts:
+            store = self.corpus.token_store
+            pronoun_counts = store.count_by_transcript(self.corpus.index.lookup(CLITICS, "PRON"))
+            for transcript_idx, transcript in enumerate(self.corpus.transcripts):
                 if transcript.main_lang != "spa":
                     continue
                 participant_id = transcript.participant_id
-                counter = 0
-                for utterance in transcript.utterances:
-                    for token in utterance['tokens']:
-                        word = token.split(".")[0]
-                        pos = token.split(".")[1]
-                        if (word in ['lo', 'los', 'la', 'las', 'le', 'les']) and (pos == "PRON"):
-                            counter += 1
+                counter = int(pronoun_counts[transcript_idx])
                 if participant_id in data_map:
                     data_map[participant_id] += counter
                 else:
@@ -600,49 +797,161 @@ class Visualizer:
             if group_idx > 1:
                 group_idx -= 2
             data[group_idx].append(data_map[participant_id])
-        result_dict = {
-            "data": data,
-            "means": [np.mean(x) for x in data],
-            "medians": [np.median(x) for x in data],
-            "ranges": [(min(x), max(x)) for x in data],
-            "standard_deviations": [np.std(x) for x in data],
-            "ANOVA": f_oneway(*data),
-            "significant_t-tests": [],
-            "IQRs": [np.quantile(x, [0.25, 0.75]) for x in data]
-        }
-        self.render_boxplot(data[0:2] + [[], []] + data[2:], outfile=outfile)
-        if result_dict["ANOVA"].pvalue < 0.05:
-            map_data_idx_to_group = {0: 100, 1: 200, 2: 500, 3: 600, 4: 700}
-            pairs_found = []
-            for i, data_i, in enumerate(data):
-                for j, data_j in enumerate(data):
-                    if ttest_ind(data_i, data_j).pvalue < 0.05:
-                        group_i = map_data_idx_to_group[i]
-                        group_j = map_data_idx_to_group[j]
-                        if (group_i, group_j) not in pairs_found:
-                            pairs_found.append((group_i, group_j))
-                            pairs_found.append((group_j, group_i))
-                            result_dict['significant_t-tests'].append((group_i, group_j, ttest_ind(data_i, data_j)))
-        #print("ANOVA degrees freedom within groups", sum([len(x) for x in data]) - len(data))
-        return result_dict
+        return data
+
+    def gen_clitic_boxplots(self, with_non_clitic_pronoun=False, outfile=None, clitics_path: str=CLITICS_PATH):
+        data = self.clitic_boxplot_data(with_non_clitic_pronoun, clitics_path)
+        self.render_boxplot(boxplot_all_groups(data, BOXPLOT_GROUPS["spa"]), outfile=outfile)
+        return boxplot_results(data, BOXPLOT_GROUPS["spa"], detailed=True)
+
+    def dispersion_histograms(self, series: list, groups: list=None, bins: int=None):
+        '''
+        Histograms of when words were said, for many series and groups at once
+        Inputs:
+            - series: list of (words, POS filter, main language) tuples, the words of transcripts of that main language
+              are counted, a single word may be given as a string
+            - groups: (optional) groups of participants (100, 200, ...), every group by default
+            - bins: (optional) number of equal bins of the transcript's duration, by default 101 bins of whole
+              percentages (0-100), the utterance midpoint being rounded to the nearest percent
+        Outputs:
+            - (series x group x bin) array of token counts
+        '''
+        store = self.corpus.token_store
+        groups = BOXPLOT_GROUPS[None] if groups is None else [int(group) for group in groups]
+        if bins is None:
+            utterance_bin = store.utterance_time_percent()
+            n_bins = 101
+        else:
+            utterance_bin = np.minimum((store.utterance_time_fraction() * bins).astype(np.int64), bins - 1)
+            n_bins = bins
+        # group index of every transcript, -1 for transcripts outside the groups
+        group_index = np.full(store.n_transcripts, -1, dtype=np.int64)
+        for g, group in enumerate(groups):
+            group_index[store.group == group] = g
+        keys = []
+        for s, (words, POS, lang) in enumerate(series):
+            rows = self.corpus.index.lookup(self._word_ids(words), POS or None)
+            transcript = store.transcript[rows]
+            rows = rows[(group_index[transcript] >= 0) & (store.main_lang[transcript] == store.langs.get(lang))]
+            keys.append((s * len(groups) + group_index[store.transcript[rows]]) * n_bins + utterance_bin[store.utterance[rows]])
+        counts = np.bincount(np.concatenate(keys + [np.zeros(0, dtype=np.int64)]), minlength=len(series) * len(groups) * n_bins)
+        return counts.reshape(len(series), len(groups), n_bins)
+
+    def dispersion_data(self, target_word: list, group: str, target_lang: str, pos_filter: str, bins: int=None):
+        '''
+        Occurrences of the words by when they were said, as a whole percentage (0-100) of the transcript's duration
+        '''
+        return self.dispersion_histograms([(target_word, pos_filter, target_lang)], [group], bins)[0, 0].tolist()
 
     def gen_dispersion(self, target_word:str, group: str, target_lang:str, pos_filter:str, color, outfile=None):
-        data = {}
-        for x in range(101):
-            data[x] = 0
-        for transcript in self.corpus.transcripts:
-            if str(transcript.participant_id)[0] != group[0]:
-                continue
-            if target_lang != transcript.main_lang:
-                continue
-            for utterance in transcript.utterances:
-                mid_time = (int(utterance['time_start']) + int(utterance['time_end'])) / 2
-                time_percent = int(round(float(mid_time) / float(transcript.duration),2) * 100)
-                for token in utterance['tokens']:
-                    word = token.split(".")[0]
-                    pos = token.split(".")[1]
-                    if pos_filter and pos != pos_filter:
-                        continue
-                    if word in target_word:
-                        data[time_percent] += 1
-        self.render_barchart_vertical(data.keys(), data.values(), [color for x in range(len(data.keys()))], outfile)
\ No newline at end of file
+        data = self.dispersion_data(target_word, group, target_lang, pos_filter)
+        self.render_barchart_vertical(range(len(data)), data, [color for x in range(len(data))], outfile)
+
+    def gen_dispersion_grid(self, series: list, groups: list=None, bins: int=None, colors: list=None, outfile: str=None):
+        '''
+        One figure of the dispersion_histograms, a row per group and a column per series
+        Inputs:
+            - series, groups, bins: see dispersion_histograms
+            - colors: (optional) color of each series
+            - outfile: (optional) file to write the figure to, a base64 png is returned otherwise
+        Outputs:
+            - the histograms, and the base64 png when there is no outfile
+        '''
+        groups = BOXPLOT_GROUPS[None] if groups is None else [int(group) for group in groups]
+        with stage("aggregate"):
+            histograms = self.dispersion_histograms(series, groups, bins)
+        return histograms, self.render_dispersion_grid(histograms, series, groups, colors, outfile)
+
+    def render_dispersion_grid(self, histograms, series: list, groups: list, colors: list=None, outfile: str=None):
+        with stage("plot"):
+            n_series, n_groups, n_bins = histograms.shape
+            fig, axes = plt.subplots(n_groups, n_series, figsize=(4 * n_series, 2 * n_groups), sharex=True, squeeze=False)
+            for s, (words, POS, lang) in enumerate(series):
+                label = "/".join([words] if isinstance(words, str) else words) + (f'.{POS}' if POS else '') + f' ({lang})'
+                axes[0][s].set_title(label)
+                for g, group in enumerate(groups):
+                    axes[g][s].bar(range(n_bins), histograms[s, g], color=colors[s] if colors else None)
+                    axes[g][0].set_ylabel(str(group))
+            for ax in axes[-1]:
+                ax.set_xlabel("% of transcript" if n_bins == 101 else f"transcript, in {n_bins} parts")
+            fig.tight_layout()
+        chart = None
+        if outfile:
+            plt.savefig(outfile)
+        else:
+            chart = self.get_fig_encoding()
+        plt.close(fig)
+        return chart
+
+    def code_switching_data(self, groups: list=None, target_lang: str=None, POS_filter: list=None, top_N_most_frequent: int=None):
+        '''
+        Code switching statistics per group, from the switch points computed when the transcripts were parsed
+        Inputs:
+            - groups: (optional) groups of participants (100, 200, ...), the groups of the selected transcripts by default
+            - target_lang: (optional) only transcripts with this main language
+            - POS_filter: (optional) only count switches whose first switched token has one of these parts of speech
+            - top_N_most_frequent: (optional) number of (POS before, POS after) boundaries reported, all by default
+        Outputs:
+            - {group: dict} with the group's transcript, token and utterance counts, the number of switches (and of those
+              within an utterance), switches per 100 tokens, the ratio of utterances switching language mid-utterance,
+              switch counts by direction (eg "eng->spa") and by POS before and after the switch, the most frequent POS
+              boundaries and quartiles of the distance in tokens between consecutive switches of a transcript
+        '''
+        store = self.corpus.token_store
+        with stage("aggregate"):
+            selected = store.select_transcripts(groups, target_lang)
+            groups = sorted(set(int(group) // 100 * 100 for group in groups if group)) if groups else np.unique(store.group[selected]).tolist()
+            group_index = np.full(store.n_transcripts, -1, dtype=np.int64)
+            for g, group in enumerate(groups):
+                group_index[selected & (store.group == group)] = g
+            n_groups, n_langs, n_pos = len(groups), len(store.langs), len(store.parts_of_speech)
+            in_group = group_index >= 0
+            transcripts = np.bincount(group_index[in_group], minlength=n_groups)
+            tokens = np.bincount(group_index[in_group], weights=np.diff(store.offsets)[in_group], minlength=n_groups)
+            utt_group = group_index[store.utt_transcript]
+            utterances = np.bincount(utt_group[utt_group >= 0], minlength=n_groups)
+
+            points = self.corpus.switch_points
+            point_transcript = store.transcript[points]
+            kept = group_index[point_transcript] >= 0
+            if POS_filter:
+                kept &= np.isin(store.pos[points], store.parts_of_speech.ids_of(POS_filter))
+            points, point_transcript = points[kept], point_transcript[kept]
+            point_group = group_index[point_transcript]
+            intra = store.position[points] > 0
+            switches = np.bincount(point_group, minlength=n_groups)
+            intra_switches = np.bincount(point_group[intra], minlength=n_groups)
+            switched = np.zeros(store.n_utterances, dtype=bool)
+            switched[store.utterance[points[intra]]] = True
+            switched_utterances = np.bincount(utt_group[switched], minlength=n_groups)
+            lang_before, lang_after = store.lang[points - 1], store.lang[points]
+            pos_before, pos_after = store.pos[points - 1], store.pos[points]
+            directions = np.bincount((point_group * n_langs + lang_before) * n_langs + lang_after, minlength=n_groups * n_langs * n_langs).reshape(n_groups, n_langs, n_langs)
+            before = np.bincount(point_group * n_pos + pos_before, minlength=n_groups * n_pos).reshape(n_groups, n_pos)
+            after = np.bincount(point_group * n_pos + pos_after, minlength=n_groups * n_pos).reshape(n_groups, n_pos)
+            boundaries = np.bincount((point_group * n_pos + pos_before) * n_pos + pos_after, minlength=n_groups * n_pos * n_pos).reshape(n_groups, n_pos * n_pos)
+            # distances between consecutive switches of the same transcript, counted in the group of the transcript
+            same_transcript = point_transcript[1:] == point_transcript[:-1]
+            distances = np.diff(points)[same_transcript]
+            distance_group = point_group[1:][same_transcript]
+
+            data = {}
+            for g, group in enumerate(groups):
+                distance = boxplot_stats(distances[distance_group == g])
+                if distance is not None:
+                    del distance['fliers']
+                data[group] = {
+                    "transcripts": int(transcripts[g]),
+                    "tokens": int(tokens[g]),
+                    "utterances": int(utterances[g]),
+                    "switches": int(switches[g]),
+                    "intra_utterance_switches": int(intra_switches[g]),
+                    "switches_per_100_tokens": calc_ratio(100 * switches[g], tokens[g]),
+                    "switched_utterance_ratio": calc_ratio(switched_utterances[g], utterances[g]),
+                    "directions": {f'{store.langs[a]}->{store.langs[b]}': int(directions[g, a, b]) for a, b in zip(*np.nonzero(directions[g]))},
+                    "pos_before": {store.parts_of_speech[p]: int(before[g, p]) for p in np.flatnonzero(before[g])},
+                    "pos_after": {store.parts_of_speech[p]: int(after[g, p]) for p in np.flatnonzero(after[g])},
+                    "boundaries": [(store.parts_of_speech[k // n_pos], store.parts_of_speech[k % n_pos], int(boundaries[g, k])) for k in top_n(boundaries[g], top_N_most_frequent or n_pos * n_pos)],
+                    "distance": distance
+                }
+        return data
@@ -0,0 +1,68 @@
+'''
+Lexical diversity measures on integer word id arrays.
+The results are identical to lexical_diversity's ld.mattr and ld.mtld on the corresponding word lists,
+without re-slicing and re-hashing the text for every window or factor.
+'''
+import numpy as np
+
+MTLD_THRESHOLD = .72
+
+def mattr(ids, window_length: int=50):
+    '''
+    Moving average type token ratio
+    Inputs:
+        - ids: word ids (or any hashable tokens) in text order
+        - window_length: number of tokens per window
+    Outputs:
+        - average type token ratio over every full window, the plain type token ratio for texts that are not longer than a window
+    '''
+    ids = np.asarray(ids)
+    n = len(ids)
+    if n == 0:
+        return 0
+    if n < window_length + 1:
+        return len(np.unique(ids)) / n
+    windows = n - window_length + 1
+    # token j is the first occurrence of its type in every window starting after its previous occurrence
+    order = np.argsort(ids, kind='stable')
+    previous = np.full(n, -1, dtype=np.int64)
+    same = ids[order[1:]] == ids[order[:-1]]
+    previous[order[1:][same]] = order[:-1][same]
+    positions = np.arange(n)
+    first = np.maximum(previous + 1, positions - window_length + 1)
+    last = np.minimum(positions, windows - 1)
+    valid = first <= last
+    delta = np.zeros(windows + 1, dtype=np.int64)
+    np.add.at(delta, first[valid], 1)
+    np.add.at(delta, last[valid] + 1, -1)
+    types_per_window = np.cumsum(delta[:-1])
+    # cumsum adds up the window ratios in the same order as the reference implementation
+    return float(np.cumsum(types_per_window / float(window_length))[-1]) / windows
+
+def _mtld_factors(tokens: list, min_length: int):
+    factor = 0
+    factor_lengths = 0
+    types = set()
+    length = 0
+    for x, token in enumerate(tokens):
+        types.add(token)
+        length += 1
+        if x + 1 == len(tokens):
+            factor += (1 - len(types) / length) / (1 - MTLD_THRESHOLD)
+            factor_lengths += length
+        elif len(types) / length < MTLD_THRESHOLD and length >= min_length:
+            factor += 1
+            factor_lengths += length
+            types = set()
+            length = 0
+    return 0 if factor == 0 else factor_lengths / factor
+
+def mtld(ids, min_length: int=10):
+    '''
+    Measure of textual lexical diversity, averaged over a forward and a backward pass
+    Inputs:
+        - ids: word ids (or any hashable tokens) in text order
+        - min_length: minimum number of tokens in a full factor
+    '''
+    tokens = ids.tolist() if isinstance(ids, np.ndarray) else list(ids)
+    return (_mtld_factors(tokens, min_length) + _mtld_factors(tokens[::-1], min_length)) / 2
@@ -1,33 +1,147 @@
-from corpus_tool import Corpus, Transcript
-from trankit import Pipeline
-
-def thing():
-        corpus = Corpus('transcriptions')
-        pipeline = Pipeline("spanish")
-        with open('clitics.csv', 'w') as file:
-                data = {}
-                for transcript in corpus.transcripts:
-                        print(transcript.participant_id, transcript.main_lang)
-                        if transcript.main_lang != "spa":
-                                continue
-                        group_id = str(transcript.participant_id)[0]
-                        try:
-                                for utterance in transcript.utterances:
-                                        eng_toks = [x for x in utterance['tokens'] if x.split(".")[2] == "eng"]
-                                        spa_toks = [x.split(".")[0] for x in utterance['tokens'] if x.split(".")[2] == "spa"]
-                                        utt_lang = "eng" if len(eng_toks) > len(spa_toks) else "spa"
-                                        if utt_lang == "spa":
-                                                tokens = pipeline.tokenize(" ".join(spa_toks), is_sent=True)['tokens']
-                                                for token in tokens:
-                                                        if "expanded" in token:
-                                                                print(token['text'], token['expanded'])
-                                                                exp_tok_text = token['expanded'][1]['text']
-                                                                if exp_tok_text in ['lo', 'los', 'la', 'las', 'le', 'les']:
-                                                                        print(token)
-                                                                        file.write(f"{transcript.participant_id}, {token['expanded'][1]['text']}")
-                                                                        file.write("\n")
-                        except:
-                                print("error!!", transcript.participant_id)
+'''
+Finds the lo/los/la/las/le/les enclitics (eg the lo of "cómelo") in the Spanish utterances of the corpus with trankit's
+multi-word token expansion and writes them to a csv with one row per clitic, which Corpus.clitic_index reads back.
+Utterances are tokenized many at a time, in several processes, and the result of every utterance is cached by the hash of
+its text so that re-running after corpus edits only tokenizes the new or changed utterances. Eg:
+    python extract_enclitic.py --data-dir transcriptions --out clitics.csv --workers 2
+'''
+import os, sys, csv, json, bisect, hashlib, argparse
+from concurrent.futures import ProcessPoolExecutor
+from corpus_tool import Corpus, CLITICS, CLITICS_HEADER
+
+# bump when the extraction changes so that cached results are not reused
+CACHE_VERSION = 1
+UTTERANCE_SEPARATOR = "\n\n"
+
+# the trankit Pipeline of this process, loaded on first use by extract_clitics
+_pipeline = None
+
+def text_digest(text: str):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+def spanish_utterances(transcript):
+    '''
+    (utterance index, text of its spanish words) of the mostly spanish utterances of a spanish transcript
+    '''
+    result = []
+    if transcript.main_lang != "spa":
+        return result
+    for i, utterance in enumerate(transcript.utterances):
+        eng_toks = [x for x in utterance['tokens'] if x.split(".")[2] == "eng"]
+        spa_toks = [x.split(".")[0] for x in utterance['tokens'] if x.split(".")[2] == "spa"]
+        if spa_toks and len(eng_toks) <= len(spa_toks):
+            result.append((i, " ".join(spa_toks)))
+    return result
+
+def _clitics_of_tokens(tokens: list):
+    return [[token['text'], token['expanded'][1]['text']] for token in tokens if "expanded" in token and token['expanded'][1]['text'] in CLITICS]
+
+def extract_clitics(texts: list):
+    '''
+    Tokenize many utterances with a single call to the tokenizer
+    Inputs:
+        - texts: spanish utterances
+    Outputs:
+        - one list of [multi-word token, clitic] per utterance
+    '''
+    global _pipeline
+    if _pipeline is None:
+        from trankit import Pipeline
+        _pipeline = Pipeline("spanish")
+    # the utterances are tokenized as the paragraphs of one document, every token is mapped back to its
+    # utterance by its character offset since the sentence splitter does not have to respect utterance boundaries
+    starts = []
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text) + len(UTTERANCE_SEPARATOR)
+    result = [[] for _ in texts]
+    try:
+        document = _pipeline.tokenize(UTTERANCE_SEPARATOR.join(texts))
+    except Exception as e:
+        print("error tokenizing a batch, falling back to one utterance at a time:", e, file=sys.stderr)
+        for i, text in enumerate(texts):
+            try:
+                result[i] = _clitics_of_tokens(_pipeline.tokenize(text, is_sent=True)['tokens'])
+            except Exception:
+                print("error!!", text, file=sys.stderr)
+        return result
+    for sentence in document['sentences']:
+        for token in sentence['tokens']:
+            clitics = _clitics_of_tokens([token])
+            if clitics:
+                result[bisect.bisect_right(starts, token['dspan'][0]) - 1] += clitics
+    return result
+
+def load_cache(path: str):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache.get("utterances", {}) if cache.get("version") == CACHE_VERSION else {}
+
+def save_cache(path: str, cache: dict):
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump({"version": CACHE_VERSION, "utterances": cache}, f)
+    os.replace(tmp_path, path)
+
+def extract(corpus: Corpus, cache_path: str=None, workers: int=1, batch_size: int=256, extract_batch=extract_clitics):
+    '''
+    Inputs:
+        - corpus: the tagged corpus
+        - cache_path: (optional) json file with the clitics of the utterances tokenized by earlier runs
+        - workers: number of tokenizer processes, each loads its own trankit pipeline
+        - batch_size: utterances per tokenizer call
+        - extract_batch: function returning the [token, clitic] pairs of each of a list of utterances
+    Outputs:
+        - (participant id, file, utterance index, clitic, token) of every clitic, in corpus order
+    '''
+    cache = load_cache(cache_path) if cache_path else {}
+    utterances = [(transcript, i, text, text_digest(text)) for transcript in corpus.transcripts for i, text in spanish_utterances(transcript)]
+    missing = {}
+    for _, _, text, digest in utterances:
+        if digest not in cache:
+            missing[digest] = text
+    print(f'{len(utterances)} spanish utterances, {len(missing)} to tokenize', file=sys.stderr)
+    digests, texts = list(missing), list(missing.values())
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+
+    def store(results):
+        for start, batch_result in zip(range(0, len(texts), batch_size), results):
+            for digest, clitics in zip(digests[start:start + batch_size], batch_result):
+                cache[digest] = clitics
+            if cache_path:
+                save_cache(cache_path, cache) # progress survives an interrupted run
+    if workers < 2 or len(batches) < 2:
+        store(map(extract_batch, batches))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            store(executor.map(extract_batch, batches))
+    rows = []
+    for transcript, i, _, digest in utterances:
+        for token, clitic in cache[digest]:
+            rows.append((transcript.participant_id, transcript.filename, i, clitic, token))
+    return rows
+
+def write_clitics(rows: list, outfile: str):
+    with open(outfile, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(CLITICS_HEADER)
+        writer.writerows(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract the enclitics of the spanish utterances")
+    parser.add_argument("--data-dir", default="transcriptions", help='folder containing the "Tagged Transcriptions (group xxx)" folders')
+    parser.add_argument("--out", default="clitics.csv")
+    parser.add_argument("--cache", default="clitics_cache.json", help="tokenizer results of earlier runs, by utterance")
+    parser.add_argument("--workers", type=int, default=1, help="tokenizer processes, each needs about a GB of memory")
+    parser.add_argument("--batch-size", type=int, default=256, help="utterances per tokenizer call")
+    args = parser.parse_args()
+    rows = extract(Corpus(args.data_dir), args.cache, args.workers, args.batch_size)
+    write_clitics(rows, args.out)
+    print(f'{len(rows)} clitics written to {args.out}', file=sys.stderr)
 
 if __name__ == "__main__":
-        thing()
\ No newline at end of file
+    main()
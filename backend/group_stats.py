@@ -0,0 +1,278 @@
+'''
+Statistics comparing groups of participants on many features at once, eg the counts of hundreds of word.POS types per
+transcript. Every function takes a (participant x feature) matrix and the group label of each participant, and tests all
+the feature columns together with array operations instead of one scipy call per column and group pair.
+The ANOVA and t-tests give the same results as scipy's f_oneway and ttest_ind.
+'''
+from collections import namedtuple
+import numpy as np
+from scipy.stats import f as f_distribution, t as t_distribution
+
+AnovaResult = namedtuple('AnovaResult', ['statistic', 'pvalue'])
+TTestResult = namedtuple('TTestResult', ['statistic', 'pvalue', 'df'])
+
+CORRECTIONS = ['bonferroni', 'holm', 'fdr_bh']
+# relative tolerance for a resampled statistic to count as equal to the observed one, as in scipy.stats.permutation_test
+TIE_TOLERANCE = 1e-14
+
+def _prepare(X, labels, groups: list=None):
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X[:, None]
+    labels = np.asarray(labels)
+    if len(labels) != len(X):
+        raise ValueError(f'{len(labels)} group labels for {len(X)} rows')
+    if groups is None:
+        groups = np.unique(labels).tolist()
+    masks = np.array([labels == group for group in groups], dtype=bool).reshape(len(groups), len(X))
+    return X, list(groups), masks
+
+def _group_moments(X, masks):
+    '''
+    Size, mean and sum of squared deviations from the mean of every group, (g,), (g, k) and (g, k)
+    '''
+    n = masks.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (masks @ X) / n[:, None]
+    squares = np.zeros_like(means)
+    for g, mask in enumerate(masks): # deviations from the group mean, not sums of squares, to avoid cancellation
+        squares[g] = ((X[mask] - means[g]) ** 2).sum(axis=0)
+    return n, means, squares
+
+def anova(X, labels, groups: list=None):
+    '''
+    One way ANOVA of every feature column
+    Inputs:
+        - X: (participant x feature) matrix, or a vector for a single feature
+        - labels: group of each participant
+        - groups: (optional) the groups to compare, in order, all labels by default. A group without participants
+          makes every result nan, like scipy's f_oneway
+    Outputs:
+        - AnovaResult of (k,) arrays
+    '''
+    X, groups, masks = _prepare(X, labels, groups)
+    n, means, squares = _group_moments(X, masks)
+    total = n.sum()
+    grand_mean = X[masks.any(axis=0)].mean(axis=0) if total else np.full(X.shape[1], np.nan)
+    between = (n[:, None] * (means - grand_mean) ** 2).sum(axis=0)
+    within = squares.sum(axis=0)
+    df_between, df_within = len(groups) - 1, total - len(groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        statistic = (between / df_between) / (within / df_within)
+    # constant groups: inf when their means differ, nan when everything is equal
+    statistic = np.where(within == 0, np.where(between == 0, np.nan, np.inf), statistic)
+    if (n == 0).any() or df_within <= 0:
+        statistic = np.full(X.shape[1], np.nan)
+    pvalue = f_distribution.sf(statistic, df_between, df_within) if df_within > 0 else statistic
+    return AnovaResult(statistic, pvalue)
+
+def _t_statistics(n_i, n_j, mean_i, mean_j, squares_i, squares_j, equal_var: bool):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if equal_var:
+            df = np.broadcast_to(n_i + n_j - 2.0, np.shape(mean_i)).astype(float)
+            pooled = (squares_i + squares_j) / df
+            standard_error = np.sqrt(pooled * (1.0 / n_i + 1.0 / n_j))
+        else:
+            var_i, var_j = squares_i / (n_i - 1) / n_i, squares_j / (n_j - 1) / n_j
+            df = (var_i + var_j) ** 2 / (var_i ** 2 / (n_i - 1) + var_j ** 2 / (n_j - 1))
+            standard_error = np.sqrt(var_i + var_j)
+        statistic = (mean_i - mean_j) / standard_error
+    return statistic, df
+
+def pairwise_ttests(X, labels, groups: list=None, equal_var: bool=True):
+    '''
+    Independent samples t-tests between every unordered pair of groups, for every feature column
+    Inputs:
+        - X, labels, groups: see anova
+        - equal_var: Student's t-test when True, Welch's otherwise
+    Outputs:
+        - list of (group_i, group_j) pairs, in the order (0, 1), (0, 2), ..., (1, 2), ...
+        - TTestResult of (pairs x k) arrays
+    '''
+    X, groups, masks = _prepare(X, labels, groups)
+    n, means, squares = _group_moments(X, masks)
+    i, j = np.triu_indices(len(groups), 1)
+    n_i, n_j = n[i][:, None].astype(float), n[j][:, None].astype(float)
+    statistic, df = _t_statistics(n_i, n_j, means[i], means[j], squares[i], squares[j], equal_var)
+    pvalue = 2 * t_distribution.sf(np.abs(statistic), df)
+    return [(groups[a], groups[b]) for a, b in zip(i, j)], TTestResult(statistic, pvalue, df)
+
+def adjust_pvalues(pvalues, method: str='holm', axis: int=None):
+    '''
+    Multiple comparison correction
+    Inputs:
+        - pvalues: array of p-values, nan p-values are left out of the family and stay nan
+        - method: bonferroni, holm (Holm-Bonferroni) or fdr_bh (Benjamini-Hochberg false discovery rate)
+        - axis: (optional) correct every slice along this axis as its own family, the whole array is one family by default
+    Outputs:
+        - adjusted p-values, same shape as the input
+    '''
+    if method not in CORRECTIONS:
+        raise ValueError(f'Unknown correction {method}, expected one of {CORRECTIONS}')
+    pvalues = np.asarray(pvalues, dtype=float)
+    shape = pvalues.shape
+    p = pvalues.reshape(-1, 1) if axis is None else np.moveaxis(pvalues, axis, 0).reshape(pvalues.shape[axis], -1)
+    m = (~np.isnan(p)).sum(axis=0)
+    order = np.argsort(p, axis=0) # nan sorts last
+    ranked = np.take_along_axis(p, order, axis=0)
+    rank = np.arange(len(p))[:, None]
+    if method == 'bonferroni':
+        adjusted = ranked * m
+    elif method == 'holm':
+        adjusted = np.maximum.accumulate(np.where(np.isnan(ranked), -np.inf, ranked * (m - rank)), axis=0)
+    else:
+        scaled = np.where(np.isnan(ranked), np.inf, ranked * m / (rank + 1))
+        adjusted = np.minimum.accumulate(scaled[::-1], axis=0)[::-1]
+    adjusted = np.where(np.isnan(ranked), np.nan, np.minimum(adjusted, 1))
+    result = np.empty_like(p)
+    np.put_along_axis(result, order, adjusted, axis=0)
+    if axis is None:
+        return result.reshape(shape)
+    return np.moveaxis(result.reshape((shape[axis],) + tuple(np.delete(shape, axis))), 0, axis)
+
+def _permuted_masks(rng, labels_index, n_groups: int, n_resamples: int):
+    '''
+    (g x resamples x participants) float masks of the groups after shuffling the labels, one permutation per row
+    '''
+    permutations = rng.permuted(np.broadcast_to(labels_index, (n_resamples, len(labels_index))), axis=1)
+    return np.array([permutations == g for g in range(n_groups)], dtype=float)
+
+def permutation_pvalues(X, labels, groups: list=None, n_resamples: int=9999, equal_var: bool=True, seed=None, batch_size: int=1000):
+    '''
+    Permutation p-values of the ANOVA and of the pairwise t-tests, shuffling the group labels
+    Inputs:
+        - X, labels, groups, equal_var: see anova and pairwise_ttests
+        - n_resamples: number of random permutations
+        - seed: (optional) seed of the random generator
+        - batch_size: permutations evaluated together, bounds the memory used
+    Outputs:
+        - (k,) ANOVA p-values and (pairs x k) t-test p-values, with pairs in pairwise_ttests order
+    '''
+    X, groups, masks = _prepare(X, labels, groups)
+    rng = np.random.default_rng(seed)
+    k = X.shape[1]
+    n = masks.sum(axis=1)
+    # the F statistic grows with sum_g S_g^2 / n_g (S_g the sum of the group) since the total sum of squares does
+    # not change under permutation, so that is all that needs to be compared
+    selected = masks.any(axis=0)
+    X_selected, labels_index = X[selected], masks[:, selected].argmax(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        observed_between = ((masks @ X) ** 2 / n[:, None]).sum(axis=0)
+    anova_hits = np.zeros(k)
+    pairs = list(zip(*np.triu_indices(len(groups), 1)))
+    observed_t = np.abs(pairwise_ttests(X, labels, groups, equal_var)[1].statistic)
+    pair_hits = np.zeros((len(pairs), k))
+    pair_data = []
+    for a, b in pairs:
+        pair_mask = masks[a] | masks[b]
+        X_pair = X[pair_mask]
+        pair_data.append((X_pair, X_pair.sum(axis=0), (X_pair ** 2).sum(axis=0), masks[a][pair_mask], n[a], n[b]))
+    done = 0
+    while done < n_resamples:
+        batch = min(batch_size, n_resamples - done)
+        sums = np.einsum('grn,nk->grk', _permuted_masks(rng, labels_index, len(groups), batch), X_selected)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            between = (sums ** 2 / n[:, None, None]).sum(axis=0)
+        anova_hits += (between >= observed_between - TIE_TOLERANCE * np.abs(observed_between)).sum(axis=0)
+        for p, (X_pair, total, total_squares, in_a, n_a, n_b) in enumerate(pair_data):
+            in_a = rng.permuted(np.broadcast_to(in_a, (batch, len(in_a))), axis=1).astype(float)
+            sum_a, squares_a = in_a @ X_pair, in_a @ X_pair ** 2
+            sum_b, squares_b = total - sum_a, total_squares - squares_a
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean_a, mean_b = sum_a / n_a, sum_b / n_b
+                statistic, _ = _t_statistics(float(n_a), float(n_b), mean_a, mean_b, squares_a - sum_a * mean_a, squares_b - sum_b * mean_b, equal_var)
+            pair_hits[p] += (np.abs(statistic) >= observed_t[p] - TIE_TOLERANCE * observed_t[p]).sum(axis=0)
+        done += batch
+    anova_p = (anova_hits + 1) / (n_resamples + 1)
+    pair_p = (pair_hits + 1) / (n_resamples + 1)
+    anova_p[np.isnan(observed_between)] = np.nan
+    pair_p[np.isnan(observed_t)] = np.nan
+    return anova_p, pair_p
+
+def bootstrap(X, labels, groups: list=None, n_resamples: int=9999, confidence: float=0.95, seed=None):
+    '''
+    Percentile bootstrap of the group means and of the pairwise differences of means, resampling participants
+    within each group
+    Inputs:
+        - X, labels, groups: see anova
+        - n_resamples: number of bootstrap samples
+        - confidence: level of the confidence intervals
+        - seed: (optional) seed of the random generator
+    Outputs:
+        dict of
+        - mean_low, mean_high: (g x k) confidence interval of each group mean
+        - difference_low, difference_high: (pairs x k) confidence interval of mean_i - mean_j
+        - difference_pvalue: (pairs x k) two sided bootstrap p-value of the difference being 0
+    '''
+    X, groups, masks = _prepare(X, labels, groups)
+    rng = np.random.default_rng(seed)
+    resampled = np.full((len(groups), n_resamples, X.shape[1]), np.nan)
+    for g, mask in enumerate(masks):
+        n = int(mask.sum())
+        if n:
+            # how often each participant is drawn in each resample
+            weights = rng.multinomial(n, np.full(n, 1 / n), size=n_resamples)
+            resampled[g] = weights @ X[mask] / n
+    i, j = np.triu_indices(len(groups), 1)
+    differences = resampled[i] - resampled[j]
+    tail = (1 - confidence) / 2 * 100
+    with np.errstate(invalid='ignore'):
+        below, above = (differences <= 0).mean(axis=1), (differences >= 0).mean(axis=1)
+    pvalue = np.minimum(1, 2 * np.minimum(below, above))
+    pvalue[np.isnan(differences).any(axis=1)] = np.nan
+    return {
+        'mean_low': np.percentile(resampled, tail, axis=1),
+        'mean_high': np.percentile(resampled, 100 - tail, axis=1),
+        'difference_low': np.percentile(differences, tail, axis=1),
+        'difference_high': np.percentile(differences, 100 - tail, axis=1),
+        'difference_pvalue': pvalue
+    }
+
+def descriptives(X, labels, groups: list=None):
+    '''
+    dict of n (g,) and mean, std (population, like np.std), median, q1, q3, min and max (g x k) of every group,
+    nan for groups without participants
+    '''
+    X, groups, masks = _prepare(X, labels, groups)
+    n, means, squares = _group_moments(X, masks)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(squares / n[:, None])
+    quantiles = np.array([np.percentile(X[mask], [0, 25, 50, 75, 100], axis=0) if mask.any() else np.full((5, X.shape[1]), np.nan) for mask in masks])
+    return {
+        'n': n,
+        'mean': means,
+        'std': std,
+        'min': quantiles[:, 0],
+        'q1': quantiles[:, 1],
+        'median': quantiles[:, 2],
+        'q3': quantiles[:, 3],
+        'max': quantiles[:, 4]
+    }
+
+def compare_groups(X, labels, groups: list=None, equal_var: bool=True, correction: str='holm', permutations: int=0, bootstrap_samples: int=0, confidence: float=0.95, seed=None):
+    '''
+    Everything above in one go
+    Inputs:
+        - X, labels, groups, equal_var: see anova and pairwise_ttests
+        - correction: multiple comparison correction of the t-tests, over all pairs and features
+        - permutations: (optional) number of permutations for permutation p-values, none by default
+        - bootstrap_samples: (optional) number of bootstrap samples for confidence intervals, none by default
+        - confidence, seed: see bootstrap
+    Outputs:
+        dict of groups, pairs, descriptives, anova (AnovaResult), ttests (TTestResult), adjusted_pvalues and, when
+        requested, permutation_anova_pvalues, permutation_ttest_pvalues and bootstrap
+    '''
+    pairs, ttests = pairwise_ttests(X, labels, groups, equal_var)
+    result = {
+        'groups': groups if groups is not None else np.unique(labels).tolist(),
+        'pairs': pairs,
+        'descriptives': descriptives(X, labels, groups),
+        'anova': anova(X, labels, groups),
+        'ttests': ttests,
+        'adjusted_pvalues': adjust_pvalues(ttests.pvalue, correction)
+    }
+    if permutations:
+        result['permutation_anova_pvalues'], result['permutation_ttest_pvalues'] = permutation_pvalues(X, labels, groups, permutations, equal_var, seed)
+    if bootstrap_samples:
+        result['bootstrap'] = bootstrap(X, labels, groups, bootstrap_samples, confidence, seed)
+    return result
@@ -1,13 +1,129 @@
-import os
-from fastapi import FastAPI, Request
+import os, json, time, asyncio, secrets, threading
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, APIRouter, Request, Response, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Optional
-from flair.models import SequenceTagger
-from flair.data import Sentence
 from fastapi.middleware.cors import CORSMiddleware
 from corpus_tool import Corpus, Transcript, Visualizer
+from chart_cache import ChartCache
+from render_pool import RenderPool, RenderPoolSaturated
+from tag_batcher import TagBatcher
+from concordance import Concordancer
+import metrics
 
-app = FastAPI()
+# "all" serves everything, "viz" only the /viz_xxx endpoints (and never imports torch), "tagger" only the /words endpoints
+BACKEND_ROLE = os.environ.get("BACKEND_ROLE", "all")
+SERVE_TAGGING = BACKEND_ROLE in ["all", "tagger"]
+SERVE_VISUALIZATION = BACKEND_ROLE in ["all", "viz"]
+
+# the tagger, corpus and render pool are loaded in the background on startup, or on first use
+tagger = None
+corpus = None
+render_pool = None
+concordancer = None
+corpus_generation = 0 # bumped whenever a reload swaps the corpus
+load_errors = {}
+tagger_lock = threading.Lock()
+corpus_lock = threading.Lock()
+reload_lock = threading.Lock()
+CORPUS_WATCH_INTERVAL = float(os.environ.get("CORPUS_WATCH_INTERVAL", 60))
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+def get_tagger():
+    global tagger
+    if tagger is None:
+        with tagger_lock:
+            if tagger is None:
+                from flair.models import SequenceTagger
+                from flair.data import Sentence
+                with metrics.stage("tagger_load"):
+                    loaded = SequenceTagger.load('benevanoff/spanglish-upos')
+                with metrics.stage("tagger_warmup"):
+                    loaded.predict(Sentence("warm up the model")) # the first inference pays for lazy initialization
+                tagger = loaded
+    return tagger
+
+def get_render_pool():
+    global corpus, render_pool
+    if render_pool is None:
+        with corpus_lock:
+            if render_pool is None:
+                with metrics.stage("corpus_load"):
+                    corpus = Corpus('transcriptions', snapshot_path=os.environ.get("CORPUS_SNAPSHOT", "transcriptions.snapshot"), workers=int(os.environ.get("CORPUS_LOAD_WORKERS", os.cpu_count() or 1)))
+                render_pool = make_render_pool(corpus)
+    return render_pool
+
+def make_render_pool(corpus: Corpus):
+    return RenderPool(corpus, workers=RENDER_WORKERS, max_queue=int(os.environ.get("RENDER_QUEUE_LIMIT", 4 * max(RENDER_WORKERS, 1))), timeout=float(os.environ.get("RENDER_TIMEOUT", 120)))
+
+def reload_corpus():
+    """
+    Re-parse the transcripts that were added or changed on disk and swap in the new corpus with a fresh render pool.
+    Charts already queued finish on the old corpus, cached charts are dropped. Returns the changes found
+    """
+    global corpus, render_pool, corpus_generation
+    with reload_lock:
+        get_render_pool()
+        changes = corpus.changes()
+        if not any(changes.values()):
+            return changes
+        with metrics.stage("corpus_reload"):
+            new_corpus = corpus.reload()
+            new_render_pool = make_render_pool(new_corpus)
+        with corpus_lock:
+            old_render_pool = render_pool
+            corpus, render_pool = new_corpus, new_render_pool
+            corpus_generation += 1
+            chart_cache.clear()
+        old_render_pool.shutdown(cancel=False)
+        return changes
+
+async def watch_corpus(interval: float):
+    """
+    Poll the transcriptions folder for changes every interval seconds
+    """
+    while True:
+        await asyncio.sleep(interval)
+        if render_pool is None:
+            continue # still loading
+        try:
+            await run_in_threadpool(reload_corpus)
+        except Exception as e:
+            load_errors["reload"] = repr(e)
+
+def load_in_background(name: str, load):
+    try:
+        load()
+    except Exception as e:
+        load_errors[name] = repr(e)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop = asyncio.get_running_loop()
+    if SERVE_VISUALIZATION:
+        loop.run_in_executor(None, load_in_background, "corpus", get_render_pool)
+    if SERVE_TAGGING:
+        loop.run_in_executor(None, load_in_background, "tagger", get_tagger)
+    watcher = None
+    if SERVE_VISUALIZATION and CORPUS_WATCH_INTERVAL > 0:
+        watcher = asyncio.create_task(watch_corpus(CORPUS_WATCH_INTERVAL))
+    yield
+    if watcher is not None:
+        watcher.cancel()
+    # forget the stopped pools so that the app can be started again, eg by another TestClient
+    global corpus, render_pool, concordancer, tag_batcher
+    with corpus_lock:
+        if render_pool is not None:
+            render_pool.shutdown()
+        corpus, render_pool, concordancer = None, None, None
+    tag_batcher.shutdown()
+    tag_batcher = make_tag_batcher()
+
+app = FastAPI(lifespan=lifespan)
+tagging = APIRouter()
+visualization = APIRouter()
 
 # CORS configuration
 origins = [
@@ -24,21 +140,55 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-tagger = SequenceTagger.load('benevanoff/spanglish-upos')
-corpus = Corpus('transcriptions')
-visualizer = Visualizer(corpus)
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    """
+    Record request latency per endpoint, and with SERVER_TIMING=1 report the request's stages in a Server-Timing header
+    """
+    timings = []
+    metrics.request_timings.set(timings)
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    route = request.scope.get("route")
+    path = route.path if route is not None else "other"
+    metrics.REQUEST_SECONDS.observe(path, elapsed)
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = metrics.server_timing(timings + [("total", elapsed)])
+    return response
+
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+chart_cache = ChartCache(int(os.environ.get("CHART_CACHE_BYTES", 256 * 1024 * 1024)))
+CHART_MAX_AGE = int(os.environ.get("CHART_MAX_AGE", 60))
 
 class WordsRequest(BaseModel):
     words: str
 
+class WordsBatchRequest(BaseModel):
+    sentences: List[str]
+
 class CorpusVizRequest(BaseModel):
     groups: List[int]
     target_language: Optional[str]
     part_of_speech_filter: Optional[List[str]]
     N_most_frequent: Optional[int]
 
+class VizBatchRequest(CorpusVizRequest):
+    charts: List[str]
+
+class ConcordanceRequest(BaseModel):
+    pattern: str
+    groups: Optional[List[int]] = None
+    target_language: Optional[str] = None
+    offset: int = 0
+    limit: int = 100
+    context: int = 5
+
 def preprocess_viz_req(viz_request):
-    print(viz_request.groups, viz_request.target_language, viz_request.N_most_frequent)
+    if viz_request.N_most_frequent is not None and viz_request.N_most_frequent < 0:
+        raise HTTPException(status_code=400, detail="N_most_frequent must not be negative")
     viz_request.target_language = None if viz_request.target_language == "both" else viz_request.target_language
     viz_request.N_most_frequent = None if viz_request.N_most_frequent == 0 else viz_request.N_most_frequent
     return viz_request
@@ -47,36 +197,257 @@ def preprocess_viz_req(viz_request):
 def read_root():
     return {"message": "Hello, World!"}
 
+@app.get("/metrics")
+def read_metrics():
+    """
+    Latency histograms, cache, queue and memory stats in the Prometheus text format
+    """
+    cache = chart_cache.stats()
+    values = {
+        "backend_chart_cache_entries": ("gauge", "Charts in the chart cache", cache["entries"]),
+        "backend_chart_cache_bytes": ("gauge", "Size of the cached charts", cache["bytes"]),
+        "backend_chart_cache_hits_total": ("counter", "Chart cache hits", cache["hits"]),
+        "backend_chart_cache_misses_total": ("counter", "Chart cache misses", cache["misses"]),
+        "backend_chart_cache_evictions_total": ("counter", "Charts evicted from the chart cache", cache["evictions"]),
+        "backend_chart_cache_hit_ratio": ("gauge", "Chart cache hits per lookup", cache["hit_rate"]),
+        "backend_render_queue_depth": ("gauge", "Charts being rendered or waiting for a render worker", 0 if render_pool is None else render_pool.pending),
+        "backend_tag_queue_depth": ("gauge", "Sentences waiting for the next tagging batch", len(tag_batcher.pending)),
+        "backend_tag_batches_total": ("counter", "Tagger invocations", tag_batcher.batches),
+        "backend_tagged_sentences_total": ("counter", "Sentences tagged", tag_batcher.sentences),
+        "process_resident_memory_bytes": ("gauge", "Resident memory of the server process", metrics.resident_memory_bytes())
+    }
+    lines = metrics.STAGE_SECONDS.render() + metrics.REQUEST_SECONDS.render() + metrics.render_values(values)
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.get("/ready")
+def read_ready():
+    """
+    Readiness, unlike / this only succeeds once everything this process serves is loaded
+    """
+    status = {"role": BACKEND_ROLE}
+    if SERVE_TAGGING:
+        status["tagger"] = tagger is not None
+    if SERVE_VISUALIZATION:
+        status["corpus"] = render_pool is not None
+    ready = all(status[x] for x in ["tagger", "corpus"] if x in status)
+    if load_errors:
+        status["errors"] = load_errors
+    status["ready"] = ready
+    return JSONResponse(status, status_code=200 if ready else 503)
+
+def tag_sentences(sentences: list):
+    """
+    Tag many sentences with a single model invocation, returning one tag_sentence style result per sentence
+    """
+    from flair.data import Sentence
+    model = get_tagger()
+    flair_sentences = [Sentence(sentence) for sentence in sentences]
+    with metrics.stage("tag"):
+        model.predict(flair_sentences, mini_batch_size=TAG_MINI_BATCH_SIZE)
+    return [[{"token_text":tok.text, "token_tag": tok.tag} for tok in flair_sentence] for flair_sentence in flair_sentences]
+
 def tag_sentence(sentence: list):
     """
     Take an input list of words and return a list of dictionaries
     with they keys "token_text" and "token_tag"
     """
-    flair_sentence = Sentence(sentence)
-    tagger.predict(flair_sentence)
-    return [{"token_text":tok.text, "token_tag": tok.tag} for tok in flair_sentence]
+    return tag_sentences([sentence])[0]
+
+TAG_MINI_BATCH_SIZE = int(os.environ.get("TAG_MINI_BATCH_SIZE", 32))
+def make_tag_batcher():
+    return TagBatcher(tag_sentences, max_batch=int(os.environ.get("TAG_MAX_BATCH", 64)), max_wait=float(os.environ.get("TAG_MAX_WAIT_MS", 5)) / 1000)
+
+tag_batcher = make_tag_batcher()
+
+@tagging.post("/words")
+async def tag_words(request: Request, words_request: WordsRequest):
+    return await tag_batcher.tag(words_request.words.split(" "))
+
+@tagging.post("/words_batch")
+async def tag_words_batch(request: Request, words_request: WordsBatchRequest):
+    return await tag_batcher.tag_many([sentence.split(" ") for sentence in words_request.sentences])
+
+async def render(method: str, **kwargs):
+    """
+    Await Visualizer.<method>(**kwargs) in the render pool, translating a full queue or a timeout to 503/504
+    """
+    try:
+        pool = render_pool or await run_in_threadpool(get_render_pool)
+        return await pool.run(method, **kwargs)
+    except RenderPoolSaturated:
+        raise HTTPException(status_code=503, detail="Too many charts are being rendered, try again shortly", headers={"Retry-After": "1"})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Rendering the chart timed out")
+
+def check_format(format: str):
+    if format not in ["png", "data"]:
+        raise HTTPException(status_code=400, detail=f"Unknown format {format}, expected png or data")
+
+# the charts that depend on N_most_frequent, the others share one cache entry whatever N is
+N_MOST_FREQUENT_KINDS = ["barchart", "code_switching"]
 
-@app.post("/words")
-def tag_words(request: Request, words_request: WordsRequest):
-    words = words_request.words
-    return tag_sentence(words_request.words.split(" "))
+def chart_key(kind: str, viz_request: CorpusVizRequest, format: str="png"):
+    N_most_frequent = viz_request.N_most_frequent if kind in N_MOST_FREQUENT_KINDS else None
+    return ChartCache.make_key(kind if format == "png" else f"{kind}_data", viz_request.groups, viz_request.target_language, viz_request.part_of_speech_filter, N_most_frequent)
 
-@app.post("/viz_barchart")
-async def corpus_viz(request: Request, viz_request: CorpusVizRequest):
+async def chart_summaries(kinds: list, viz_request: CorpusVizRequest):
+    """
+    The JSON encoded data behind the charts, {kind: json}
+    """
+    summaries = await render("chart_summaries", kinds=kinds, groups=viz_request.groups, target_lang=viz_request.target_language, POS_filter=viz_request.part_of_speech_filter, top_N_most_frequent=viz_request.N_most_frequent)
+    return {kind: json.dumps(summaries[kind], separators=(",", ":")) for kind in kinds}
+
+def cache_put(key, payload, generation: int):
+    """
+    Cache a chart unless the corpus was reloaded while it was rendered, returns (etag, payload) either way
+    """
+    if generation != corpus_generation:
+        return ChartCache.make_etag(payload), payload
+    return chart_cache.put(key, payload)
+
+async def cached_chart(kind: str, request: Request, response: Response, viz_request: CorpusVizRequest, format: str, method: str, **kwargs):
+    """
+    Serve a chart from chart_cache, rendering Visualizer.<method>(**kwargs) in the render pool on a miss.
+    With format "data" the chart's aggregated data is served as JSON instead of a base64 png.
+    Clients that send back the ETag get a 304.
+    """
+    check_format(format)
+    key = chart_key(kind, viz_request, format)
+    generation = corpus_generation
+    entry = chart_cache.get(key)
+    if entry is None:
+        if format == "png":
+            entry = cache_put(key, await render(method, **kwargs), generation)
+        else:
+            entry = cache_put(key, (await chart_summaries([kind], viz_request))[kind], generation)
+    etag, chart = entry
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={CHART_MAX_AGE}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    if format == "data":
+        return Response(chart, media_type="application/json", headers=headers)
+    response.headers.update(headers)
+    return chart
+
+@visualization.post("/viz_barchart")
+async def corpus_viz(request: Request, response: Response, viz_request: CorpusVizRequest, format: str = "png"):
     viz_request = preprocess_viz_req(viz_request)
-    return visualizer.word_freq_barchart_group(groups=viz_request.groups, target_lang=viz_request.target_language, top_N_most_frequent=viz_request.N_most_frequent, POS_filter=viz_request.part_of_speech_filter)
+    return await cached_chart("barchart", request, response, viz_request, format, "word_freq_barchart_group", groups=viz_request.groups, target_lang=viz_request.target_language, top_N_most_frequent=viz_request.N_most_frequent, POS_filter=viz_request.part_of_speech_filter)
 
-@app.post("/viz_mtld_boxplot")
-async def corpus_viz_mtld_boxplot(request: Request, viz_request: CorpusVizRequest):
+@visualization.post("/viz_mtld_boxplot")
+async def corpus_viz_mtld_boxplot(request: Request, response: Response, viz_request: CorpusVizRequest, format: str = "png"):
     viz_request = preprocess_viz_req(viz_request)
-    return visualizer.mtld_boxplot(target_lang=viz_request.target_language, POS_filter=viz_request.part_of_speech_filter, group_filter=viz_request.groups)
+    return await cached_chart("mtld_boxplot", request, response, viz_request, format, "mtld_boxplot", target_lang=viz_request.target_language, POS_filter=viz_request.part_of_speech_filter, group_filter=viz_request.groups)
 
-@app.post("/viz_mattr_boxplot")
-async def corpus_viz_mattr_boxplot(request: Request, viz_request: CorpusVizRequest):
+@visualization.post("/viz_mattr_boxplot")
+async def corpus_viz_mattr_boxplot(request: Request, response: Response, viz_request: CorpusVizRequest, format: str = "png"):
     viz_request = preprocess_viz_req(viz_request)
-    return visualizer.mattr_boxplot(target_lang=viz_request.target_language, POS_filter=viz_request.part_of_speech_filter, group_filter=viz_request.groups)
+    return await cached_chart("mattr_boxplot", request, response, viz_request, format, "mattr_boxplot", target_lang=viz_request.target_language, POS_filter=viz_request.part_of_speech_filter, group_filter=viz_request.groups)
 
-@app.post("/viz_word_cloud")
-async def corpus_viz_word_cloud(request: Request, viz_request: CorpusVizRequest):
+@visualization.post("/viz_word_cloud")
+async def corpus_viz_word_cloud(request: Request, response: Response, viz_request: CorpusVizRequest, format: str = "png"):
     viz_request = preprocess_viz_req(viz_request)
-    return visualizer.gen_word_cloud(group_filter=viz_request.groups, target_lang_filter=viz_request.target_language, POS_filter=viz_request.part_of_speech_filter)
\ No newline at end of file
+    return await cached_chart("word_cloud", request, response, viz_request, format, "gen_word_cloud", group_filter=viz_request.groups, target_lang_filter=viz_request.target_language, POS_filter=viz_request.part_of_speech_filter)
+
+@visualization.post("/viz_batch")
+async def corpus_viz_batch(viz_request: VizBatchRequest, format: str = "png"):
+    """
+    Several charts for the same filters in one request, eg {..., "charts": ["barchart", "word_cloud"]} -> {"barchart": ..., "word_cloud": ...}
+    The corpus is filtered once for all of them and the charts are rendered in parallel
+    """
+    check_format(format)
+    viz_request = preprocess_viz_req(viz_request)
+    kinds = list(dict.fromkeys(viz_request.charts))
+    unknown = [kind for kind in kinds if kind not in Visualizer.CHART_KINDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown charts {unknown}, expected some of {Visualizer.CHART_KINDS}")
+    keys = {kind: chart_key(kind, viz_request, format) for kind in kinds}
+    generation = corpus_generation
+    charts = {}
+    for kind in kinds:
+        entry = chart_cache.get(keys[kind])
+        if entry is not None:
+            charts[kind] = entry[1]
+    missing = [kind for kind in kinds if kind not in charts]
+    if missing and format == "png":
+        data = await render("chart_data", kinds=missing, groups=viz_request.groups, target_lang=viz_request.target_language, POS_filter=viz_request.part_of_speech_filter, top_N_most_frequent=viz_request.N_most_frequent)
+        rendered = await asyncio.gather(*[render("render_chart", kind=kind, data=data[kind]) for kind in missing])
+        for kind, chart in zip(missing, rendered):
+            charts[kind] = cache_put(keys[kind], chart, generation)[1]
+    elif missing:
+        summaries = await chart_summaries(missing, viz_request)
+        for kind in missing:
+            charts[kind] = cache_put(keys[kind], summaries[kind], generation)[1]
+    if format == "data":
+        return Response("{" + ",".join(f"{json.dumps(kind)}:{charts[kind]}" for kind in kinds) + "}", media_type="application/json")
+    return {kind: charts[kind] for kind in kinds}
+
+@visualization.post("/code_switching")
+async def code_switching(request: Request, viz_request: CorpusVizRequest):
+    """
+    Code switching statistics per group as JSON: switch rates, switch directions, parts of speech around the switch points
+    and distances between switches. part_of_speech_filter keeps the switches into those parts of speech and N_most_frequent
+    limits the POS boundaries reported
+    """
+    viz_request = preprocess_viz_req(viz_request)
+    key = chart_key("code_switching", viz_request, "data")
+    generation = corpus_generation
+    entry = chart_cache.get(key)
+    if entry is None:
+        data = await render("code_switching_data", groups=viz_request.groups, target_lang=viz_request.target_language, POS_filter=viz_request.part_of_speech_filter, top_N_most_frequent=viz_request.N_most_frequent)
+        entry = cache_put(key, json.dumps(data, separators=(",", ":")), generation)
+    etag, payload = entry
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={CHART_MAX_AGE}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(payload, media_type="application/json", headers=headers)
+
+CONCORDANCE_MAX_LIMIT = int(os.environ.get("CONCORDANCE_MAX_LIMIT", 1000))
+
+def get_concordancer():
+    global concordancer
+    get_render_pool()
+    current = corpus
+    if concordancer is None or concordancer.corpus is not current:
+        concordancer = Concordancer(current)
+    return concordancer
+
+@visualization.post("/concordance")
+async def concordance(concordance_request: ConcordanceRequest):
+    """
+    Keyword in context lines of the matches of a word.POS.lang pattern, eg {"pattern": "a.DET *.NOUN", "groups": [500]},
+    streamed as one JSON object per line. The total number of matches is in the X-Total-Count header
+    """
+    if concordance_request.offset < 0 or not 0 < concordance_request.limit <= CONCORDANCE_MAX_LIMIT or concordance_request.context < 0:
+        raise HTTPException(status_code=400, detail=f"Expected offset >= 0, 0 < limit <= {CONCORDANCE_MAX_LIMIT} and context >= 0")
+    main_lang = None if concordance_request.target_language == "both" else concordance_request.target_language
+    searcher = await run_in_threadpool(get_concordancer)
+    try:
+        with metrics.stage("concordance"):
+            total, lines = await run_in_threadpool(searcher.concordance, concordance_request.pattern, concordance_request.groups, main_lang, concordance_request.offset, concordance_request.limit, concordance_request.context)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse((json.dumps(line, ensure_ascii=False) + "\n" for line in lines), media_type="application/x-ndjson", headers={"X-Total-Count": str(total)})
+
+@visualization.post("/admin/reload")
+async def admin_reload(request: Request):
+    """
+    Pick up added, changed and removed transcripts without a restart. The ADMIN_TOKEN environment variable must be set and
+    sent in an X-Admin-Token header, without it the endpoint is disabled (the folder is still polled, see CORPUS_WATCH_INTERVAL)
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Reloading is disabled, set ADMIN_TOKEN to enable it")
+    if not secrets.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    changes = await run_in_threadpool(reload_corpus)
+    return {**changes, "transcripts": len(corpus.transcripts), "generation": corpus_generation}
+
+@visualization.get("/viz_cache")
+def viz_cache_stats():
+    return chart_cache.stats()
+
+
+if SERVE_TAGGING:
+    app.include_router(tagging)
+if SERVE_VISUALIZATION:
+    app.include_router(visualization)
@@ -0,0 +1,117 @@
+import os, time, threading, contextvars
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Histogram:
+    '''
+    Prometheus style cumulative histogram with a single label, eg stage="render"
+    '''
+    def __init__(self, name: str, help: str, label: str, buckets: tuple=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.series = {} # label value -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def count(self, label_value: str):
+        with self.lock:
+            series = self.series.get(label_value)
+            return 0 if series is None else series[-2]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for label_value, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="+Inf"}} {series[-2]}')
+                lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {series[-2]}')
+                lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {series[-1]}')
+        return lines
+
+STAGE_SECONDS = Histogram("backend_stage_seconds", "Time spent in each stage of loading, tagging and charting", "stage")
+REQUEST_SECONDS = Histogram("backend_request_seconds", "Time to answer a request, per endpoint", "path")
+
+# stage timings of the call running in this thread, see collect_stages
+_local = threading.local()
+# stage timings of the request handled by the current asyncio task, for its Server-Timing header
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+@contextmanager
+def stage(name: str):
+    '''
+    Time the block as the given stage. Inside collect_stages the timing is handed back to the caller
+    (eg to cross a process boundary), otherwise it is recorded right away
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        collected = getattr(_local, 'timings', None)
+        if collected is not None:
+            collected.append((name, elapsed))
+        else:
+            record([(name, elapsed)])
+
+@contextmanager
+def collect_stages():
+    '''
+    Collect the stages timed by this thread into a list of (stage, seconds) instead of recording them
+    '''
+    previous = getattr(_local, 'timings', None)
+    _local.timings = []
+    try:
+        yield _local.timings
+    finally:
+        _local.timings = previous
+
+def record(timings: list):
+    '''
+    Record (stage, seconds) pairs, also adding them to the current request's Server-Timing
+    '''
+    current = request_timings.get()
+    for name, seconds in timings:
+        STAGE_SECONDS.observe(name, seconds)
+        if current is not None:
+            current.append((name, seconds))
+
+def server_timing(timings: list):
+    '''
+    Server-Timing header value, durations in milliseconds. Repeated stages are added up
+    '''
+    totals = {}
+    for name, seconds in timings:
+        totals[name] = totals.get(name, 0) + seconds
+    return ", ".join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in totals.items())
+
+def resident_memory_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource # no procfs, fall back to the peak instead
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def render_values(values: dict):
+    '''
+    Prometheus text lines of {name: (type, help, value)}, type being gauge or counter
+    '''
+    lines = []
+    for name, (metric_type, help, value) in values.items():
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} {metric_type}', f'{name} {value}']
+    return lines
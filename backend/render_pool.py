@@ -0,0 +1,78 @@
+import asyncio, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from corpus_tool import Visualizer
+from metrics import stage, collect_stages, record
+
+class RenderPoolSaturated(Exception):
+    pass
+
+# the Visualizer of a worker process, set up once by _init_worker
+_worker_visualizer = None
+
+def _init_worker(corpus):
+    global _worker_visualizer
+    _worker_visualizer = Visualizer(corpus)
+
+def _run_in_worker(method: str, kwargs: dict):
+    with collect_stages() as timings: # the worker's stage timings travel back with the result
+        return getattr(_worker_visualizer, method)(**kwargs), timings
+
+class RenderPool:
+    '''
+    Runs Visualizer aggregation and rendering off the event loop.
+    With workers > 0 every call goes to a pool of processes that each hold a read-only copy of the corpus and their own
+    pyplot state, so heavy charts use all cores and never block other requests. With workers == 0 calls run in a thread
+    of this process, one at a time since pyplot is not thread safe.
+    At most max_queue calls may be in flight, further calls raise RenderPoolSaturated.
+    '''
+    def __init__(self, corpus, workers: int, max_queue: int, timeout: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.visualizer = Visualizer(corpus)
+        self.pyplot_lock = threading.Lock()
+        if workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(corpus,))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+
+    def _run_locally(self, method: str, kwargs: dict):
+        with self.pyplot_lock, collect_stages() as timings:
+            return getattr(self.visualizer, method)(**kwargs), timings
+
+    def _finished(self, future):
+        with self.pending_lock:
+            self.pending -= 1
+
+    async def run(self, method: str, **kwargs):
+        '''
+        Await Visualizer.<method>(**kwargs). Raises RenderPoolSaturated when the queue is full and
+        asyncio.TimeoutError when the call takes longer than the timeout.
+        '''
+        with self.pending_lock:
+            if self.pending >= self.max_queue:
+                raise RenderPoolSaturated(f'{self.pending} renders already queued')
+            self.pending += 1
+        try:
+            if self.workers > 0:
+                future = self.executor.submit(_run_in_worker, method, kwargs)
+            else:
+                future = self.executor.submit(self._run_locally, method, kwargs)
+        except Exception:
+            self._finished(None)
+            raise
+        # a call stays pending until it really ends, the worker keeps rendering after a timeout
+        future.add_done_callback(self._finished)
+        with stage("render_pool"): # queueing and transfers included
+            # on timeout the caller gets an error right away, a call that did not start yet is cancelled
+            result, timings = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        record(timings)
+        return result
+
+    def shutdown(self, cancel: bool=True):
+        '''
+        Stop the workers, with cancel=False the calls already queued are rendered first
+        '''
+        self.executor.shutdown(wait=False, cancel_futures=cancel)
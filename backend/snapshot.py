@@ -0,0 +1,92 @@
+import os, sys, hashlib, pickle
+
+# bump whenever the attributes stored on a parsed Transcript change so stale snapshots get rebuilt
+SNAPSHOT_VERSION = 5
+
+def file_digest(path: str):
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+class CorpusSnapshot:
+    '''
+    On-disk cache of parsed transcripts so the backend does not have to re-parse every .cha file on startup.
+    Each entry is keyed by the file's path, size, mtime and content hash. When the size and mtime still
+    match the entry is trusted as is, otherwise the content hash decides whether the file really changed
+    (eg it was only touched or copied into a fresh container).
+    The file is only read on first use and every transcript is pickled on its own, so a reload only unpickles
+    the transcripts it asks for.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = None # file path -> (size, mtime_ns, digest, pickled transcript), read on first use
+        self.dirty = False
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                version, entries = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError, TypeError):
+            return {} # missing or unreadable snapshot, everything gets parsed again
+        return entries if version == SNAPSHOT_VERSION else {}
+
+    def get(self, file_path: str):
+        '''
+        Returns the cached transcript for the file, or None if it has to be parsed (or was removed)
+        '''
+        entry = self.entries.get(file_path)
+        if entry is None:
+            return None
+        size, mtime_ns, digest, payload = entry
+        try:
+            stat = os.stat(file_path)
+            if stat.st_size == size and stat.st_mtime_ns != mtime_ns and file_digest(file_path) == digest:
+                self.entries[file_path] = (size, stat.st_mtime_ns, digest, payload)
+                self.dirty = True
+            elif stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                return None
+        except FileNotFoundError:
+            del self.entries[file_path]
+            self.dirty = True
+            return None
+        try:
+            return pickle.loads(payload)
+        except (EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError, TypeError):
+            return None
+
+    def put(self, file_path: str, transcript):
+        try:
+            stat = os.stat(file_path)
+            digest = file_digest(file_path)
+        except FileNotFoundError:
+            return # removed since it was parsed
+        self.entries[file_path] = (stat.st_size, stat.st_mtime_ns, digest, pickle.dumps(transcript, protocol=pickle.HIGHEST_PROTOCOL))
+        self.dirty = True
+
+    def retain(self, file_paths: list):
+        '''
+        Drop entries for files that are no longer part of the corpus
+        '''
+        keep = set(file_paths)
+        for file_path in list(self.entries):
+            if file_path not in keep:
+                del self.entries[file_path]
+                self.dirty = True
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp{os.getpid()}'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((SNAPSHOT_VERSION, self.entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path) # atomic so a concurrently starting replica never reads a partial file
+        self.dirty = False
+
+if __name__ == "__main__":
+    # prebuild the snapshot, eg: python snapshot.py transcriptions transcriptions.snapshot
+    from corpus_tool import Corpus
+    corpus = Corpus(sys.argv[1], snapshot_path=sys.argv[2])
+    print(f'{len(corpus.transcripts)} transcripts written to {sys.argv[2]}')
@@ -0,0 +1,70 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+class TagBatcher:
+    '''
+    Dynamic micro-batching in front of the tagger.
+    Concurrent requests are collected for up to max_wait seconds, or until max_batch sentences are waiting, and then
+    tagged with a single call to tag_batch (a function taking a list of token lists and returning one result per list).
+    Batches run one at a time on a dedicated thread, so sentences arriving while the model is busy form the next batch.
+    '''
+    def __init__(self, tag_batch, max_batch: int=64, max_wait: float=0.005):
+        self.tag_batch = tag_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = [] # (tokens, future) waiting for the next batch
+        self.flush_handle = None
+        self.running = set() # batch tasks, referenced until they finish so they are not garbage collected
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tagger")
+        self.batches = 0
+        self.sentences = 0
+
+    async def tag(self, tokens: list):
+        '''
+        Tag one sentence, given as a list of words
+        '''
+        return (await self.tag_many([tokens]))[0]
+
+    async def tag_many(self, sentences: list):
+        '''
+        Tag many sentences, they may share a batch with other requests
+        '''
+        loop = asyncio.get_running_loop()
+        futures = []
+        for tokens in sentences:
+            future = loop.create_future()
+            self.pending.append((tokens, future))
+            futures.append(future)
+            if len(self.pending) >= self.max_batch:
+                self._flush()
+        if self.pending and self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.max_wait, self._flush)
+        return await asyncio.gather(*futures)
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run(self, batch: list):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.tag_batch, [tokens for tokens, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.sentences += len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done(): # the request may have been cancelled in the meantime
+                future.set_result(result)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
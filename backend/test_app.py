@@ -1,6 +1,7 @@
+import json
 from fastapi.testclient import TestClient
 from main import tag_sentence
-from main import app
+from main import app, chart_key, CorpusVizRequest
 
 def test_tag_sentence():
     result = tag_sentence("This is a test")
@@ -26,4 +27,82 @@ def test_post_words_route():
     assert result[2]['token_text'] == 'a'
     assert result [2]['token_tag'] == 'DET'
     assert result[3]['token_text'] == 'test'
-    assert result [3]['token_tag'] == 'NOUN'
\ No newline at end of file
+    assert result [3]['token_tag'] == 'NOUN'
+
+def test_post_words_batch_route():
+    result = TestClient(app).post("/words_batch", json={"sentences": ["This is a test", "a test"]})
+    assert result.status_code == 200
+    result = result.json()
+    assert len(result) == 2
+    assert [tok['token_tag'] for tok in result[0]] == ['PRON', 'AUX', 'DET', 'NOUN']
+    assert [tok['token_text'] for tok in result[1]] == ['a', 'test']
+
+def test_post_viz_batch_route():
+    with TestClient(app) as client:
+        request = {"groups": [100], "target_language": "eng", "part_of_speech_filter": None, "N_most_frequent": 0}
+        result = client.post("/viz_batch", json={**request, "charts": ["mtld_boxplot", "mattr_boxplot", "mtld_boxplot"]})
+        assert result.status_code == 200
+        result = result.json()
+        assert list(result) == ["mtld_boxplot", "mattr_boxplot"]
+        assert result["mtld_boxplot"] == client.post("/viz_mtld_boxplot", json=request).json()
+        assert client.post("/viz_batch", json={**request, "charts": ["pie"]}).status_code == 400
+
+def test_post_viz_data_format():
+    with TestClient(app) as client:
+        request = {"groups": [100], "target_language": "both", "part_of_speech_filter": None, "N_most_frequent": 5}
+        result = client.post("/viz_barchart?format=data", json=request)
+        assert result.status_code == 200
+        assert len(result.json()["words"]) == 5
+        result = client.post("/viz_batch?format=data", json={**request, "charts": ["barchart", "mattr_boxplot"]})
+        assert result.status_code == 200
+        assert list(result.json()) == ["barchart", "mattr_boxplot"]
+        assert client.post("/viz_barchart?format=svg", json=request).status_code == 400
+        assert client.post("/viz_barchart", json={**request, "N_most_frequent": -1}).status_code == 400
+
+def test_get_metrics():
+    with TestClient(app) as client:
+        client.post("/viz_mattr_boxplot", json={"groups": [100], "target_language": "both", "part_of_speech_filter": None, "N_most_frequent": 0})
+        result = client.get("/metrics")
+        assert result.status_code == 200
+        assert 'backend_stage_seconds_count{stage="aggregate"}' in result.text
+        assert 'backend_request_seconds_count{path="/viz_mattr_boxplot"}' in result.text
+        assert "backend_render_queue_depth 0" in result.text
+
+def test_post_admin_reload_without_changes(monkeypatch):
+    with TestClient(app) as client:
+        assert client.post("/admin/reload").status_code == 403 # disabled without ADMIN_TOKEN
+        monkeypatch.setattr("main.ADMIN_TOKEN", "secret")
+        assert client.post("/admin/reload", headers={"X-Admin-Token": "wrong"}).status_code == 403
+        result = client.post("/admin/reload", headers={"X-Admin-Token": "secret"})
+        assert result.status_code == 200
+        result = result.json()
+        assert (result["added"], result["changed"], result["removed"]) == ([], [], [])
+        assert result["transcripts"] > 0
+
+def test_post_concordance_route():
+    with TestClient(app) as client:
+        result = client.post("/concordance", json={"pattern": "a.DET *.NOUN", "groups": [500], "limit": 3})
+        assert result.status_code == 200
+        assert result.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in result.text.splitlines()]
+        assert len(lines) == min(3, int(result.headers["x-total-count"]))
+        assert all(line["tokens"][0] == "a.DET.eng" and line["participant_id"] // 100 == 5 for line in lines)
+        assert client.post("/concordance", json={"pattern": ""}).status_code == 400
+        assert client.post("/concordance", json={"pattern": "DET", "limit": 0}).status_code == 400
+
+def test_post_code_switching_route():
+    with TestClient(app) as client:
+        request = {"groups": [100, 500], "target_language": "both", "part_of_speech_filter": None, "N_most_frequent": 3}
+        result = client.post("/code_switching", json=request)
+        assert result.status_code == 200
+        result_json = result.json()
+        assert list(result_json) == ["100", "500"]
+        assert len(result_json["500"]["boundaries"]) == 3
+        assert sum(result_json["500"]["directions"].values()) == result_json["500"]["switches"]
+        assert client.post("/code_switching", json=request, headers={"If-None-Match": result.headers["etag"]}).status_code == 304
+
+def test_chart_key_only_keeps_N_for_the_barchart():
+    requests = [CorpusVizRequest(groups=[100], target_language=None, part_of_speech_filter=None, N_most_frequent=n) for n in [5, 10]]
+    assert chart_key("mtld_boxplot", requests[0]) == chart_key("mtld_boxplot", requests[1])
+    assert chart_key("word_cloud", requests[0], "data") == chart_key("word_cloud", requests[1], "data")
+    assert chart_key("barchart", requests[0]) != chart_key("barchart", requests[1])
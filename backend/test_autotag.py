@@ -0,0 +1,42 @@
+import os, json
+from autotag import autotag, find_untagged_files, tagged_path, CHECKPOINT_NAME
+from benchmark import generate_corpus
+from corpus_tool import Corpus
+
+def fake_tag_batch(sentences):
+    return [[(word, "NOUN") for word in sentence.split()] for sentence in sentences]
+
+def test_autotag_writes_pos_tiers(tmp_path):
+    data_dir, out_dir = str(tmp_path / "data"), str(tmp_path / "out")
+    generate_corpus(data_dir, scale=0.05)
+    files = find_untagged_files(data_dir)
+    assert autotag(data_dir, out_dir, workers=0, tag_batch=fake_tag_batch) == len(files)
+    with open(os.path.join(out_dir, tagged_path(files[0]))) as f:
+        lines = f.read().split("\n")
+    for i, line in enumerate(lines):
+        if line.startswith("%pos: "):
+            assert lines[i - 1].startswith("*PAR:\t") or lines[i - 1].startswith("\t") # right after its utterance
+            assert all(token.endswith(".NOUN") for token in line.split(" ")[1:])
+    assert "%pos tags were generated using the benevanoff/spanglish-upos model" in lines[-1]
+    corpus = Corpus(out_dir)
+    assert len(corpus.transcripts) == len(files)
+
+def test_autotag_resumes_from_checkpoint(tmp_path):
+    data_dir = str(tmp_path)
+    generate_corpus(data_dir, scale=0.05)
+    files = find_untagged_files(data_dir)
+    tagged = []
+    def counting_tag_batch(sentences):
+        tagged.append(len(sentences))
+        return fake_tag_batch(sentences)
+    autotag(data_dir, workers=0, batch_size=1, tag_batch=counting_tag_batch)
+    assert len(tagged) == len(files) # batch_size=1 tags a file at a time
+    with open(os.path.join(data_dir, CHECKPOINT_NAME)) as f:
+        assert sorted(json.load(f)["files"]) == files
+    # an interrupted run left one tagged file behind, and a transcript was edited since
+    os.remove(os.path.join(data_dir, tagged_path(files[0])))
+    with open(os.path.join(data_dir, files[1]), "a") as f:
+        f.write("\n")
+    assert autotag(data_dir, workers=0, tag_batch=fake_tag_batch) == 2
+    assert autotag(data_dir, workers=0, tag_batch=fake_tag_batch) == 0
+    assert autotag(data_dir, workers=0, tag_batch=fake_tag_batch, model="other") == len(files)
@@ -0,0 +1,25 @@
+import os
+from corpus_tool import Corpus
+from benchmark import generate_corpus, benchmark_corpus
+
+def test_generated_corpus_parses(tmp_path):
+    assert generate_corpus(str(tmp_path), scale=0.1) == 42
+    assert len(os.listdir(tmp_path)) == 14
+    corpus = Corpus(str(tmp_path))
+    assert len(corpus.transcripts) == 21
+    assert sorted(set(int(t.participant_id) // 100 for t in corpus.transcripts)) == [1, 2, 3, 4, 5, 6, 7]
+    for transcript in corpus.transcripts:
+        assert transcript.secondary_lang in ["eng", "spa"]
+        assert len(transcript.utterances) >= 15
+    store = corpus.token_store
+    assert store.lang_counts().keys() == {"eng", "spa"}
+    # some tokens are code switched away from their transcript's main language
+    assert (store.lang != store.main_lang[store.transcript]).any()
+    with open(corpus.transcripts[0].filename) as f:
+        assert "\n\t" in f.read() # wrapped continuation lines
+
+def test_benchmark_corpus(tmp_path):
+    generate_corpus(str(tmp_path), scale=0.05)
+    results = benchmark_corpus(str(tmp_path), repeat=1)
+    assert len(results["corpus_load"]) == 1
+    assert all(seconds[0] > 0 for seconds in results.values())
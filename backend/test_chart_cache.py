@@ -0,0 +1,25 @@
+from chart_cache import ChartCache
+
+def test_key_ignores_list_order():
+    assert ChartCache.make_key("barchart", [200, 100], "eng", ["VERB", "NOUN"], 400) == ChartCache.make_key("barchart", [100, 200], "eng", ["NOUN", "VERB"], 400)
+    assert ChartCache.make_key("barchart", [100], None, None, None) != ChartCache.make_key("barchart", [100], None, [], None)
+
+def test_lru_eviction_under_byte_budget():
+    cache = ChartCache(max_bytes=10)
+    cache.put("a", "aaaa")
+    cache.put("b", "bbbb")
+    assert cache.get("a") is not None # a is now the most recently used
+    cache.put("c", "cccc")
+    assert cache.get("b") is None
+    assert cache.get("a")[1] == "aaaa"
+    assert cache.get("c")[1] == "cccc"
+    stats = cache.stats()
+    assert stats['bytes'] == 8 and stats['evictions'] == 1
+    assert stats['hits'] == 3 and stats['misses'] == 1
+
+def test_clear():
+    cache = ChartCache(max_bytes=1000)
+    cache.put("k", "chart")
+    cache.clear()
+    assert cache.get("k") is None
+    assert cache.stats()['bytes'] == 0
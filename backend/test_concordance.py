@@ -0,0 +1,52 @@
+from corpus_tool import Corpus
+from concordance import Concordancer, Term, parse_pattern
+
+corpus = Corpus('transcriptions')
+concordancer = Concordancer(corpus)
+
+def test_parse_pattern():
+    tags = corpus.token_store.parts_of_speech
+    assert parse_pattern("DET NOUN", tags) == [Term(None, ["DET"], None), Term(None, ["NOUN"], None)]
+    assert parse_pattern("a.DET *.NOUN.eng el|la *", tags) == [Term(["a"], ["DET"], None), Term(None, ["NOUN"], ["eng"]), Term(["el", "la"], None, None), Term(None, None, None)]
+    for pattern in ["", "a.DET.eng.x"]:
+        try:
+            parse_pattern(pattern, tags)
+            assert False, pattern
+        except ValueError:
+            pass
+
+def _matches_by_scan(terms: list, groups: list=None):
+    def matches(term, token):
+        return all(allowed is None or part in allowed for part, allowed in zip(token.split("."), term))
+    result = []
+    for transcript in corpus.transcripts:
+        if groups and transcript.participant_id // 100 * 100 not in groups:
+            continue
+        for i, utterance in enumerate(transcript.utterances):
+            tokens = utterance['tokens']
+            for position in range(len(tokens) - len(terms) + 1):
+                if all(matches(term, tokens[position + j]) for j, term in enumerate(terms)):
+                    result.append((transcript.participant_id, i, position))
+    return result
+
+def test_concordance_matches_scan():
+    for pattern, groups in [("lo.PRON", None), ("ADP DET|PRON NOUN", [100, 500]), ("*.*.eng *.*.spa", None), ("el|la *", [300])]:
+        expected = _matches_by_scan(parse_pattern(pattern, corpus.token_store.parts_of_speech), groups)
+        total, lines = concordancer.concordance(pattern, groups, limit=len(expected) + 1)
+        assert total == len(expected)
+        assert [(line["participant_id"], line["utterance"], line["position"]) for line in lines] == expected
+
+def test_concordance_kwic_lines():
+    total, lines = concordancer.concordance("the.DET *.NOUN", offset=3, limit=2, context=2)
+    lines = list(lines)
+    assert len(lines) == 2 and total > 5
+    transcript = [t for t in corpus.transcripts if t.filename.endswith(lines[0]["transcript"])][0]
+    utterance = transcript.utterances[lines[0]["utterance"]]
+    words = [token.split(".")[0] for token in utterance['tokens']]
+    position = lines[0]["position"]
+    assert lines[0]["tokens"] == utterance['tokens'][position:position + 2]
+    assert lines[0]["match"] == " ".join(words[position:position + 2])
+    assert lines[0]["left"] == " ".join(words[max(0, position - 2):position])
+    assert lines[0]["right"] == " ".join(words[position + 2:position + 4])
+    assert lines[0]["time_start"] == int(utterance['time_start'])
+    assert concordancer.concordance("zzz")[0] == 0
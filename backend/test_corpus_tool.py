@@ -0,0 +1,279 @@
+import numpy as np
+from corpus_tool import Corpus, CorpusView, Visualizer, boxplot_stats
+from token_store import top_n
+
+corpus = Corpus('transcriptions')
+
+def test_token_store_matches_utterances():
+    store = corpus.token_store
+    tokens = [token for transcript in corpus.transcripts for utterance in transcript.utterances for token in utterance['tokens']]
+    assert len(store) == len(tokens)
+    rebuilt = [f'{store.words[w]}.{store.parts_of_speech[p]}.{store.langs[l]}' for w, p, l in zip(store.word, store.pos, store.lang)]
+    assert rebuilt == tokens
+    assert store.n_transcripts == len(corpus.transcripts)
+
+def test_types_tokens_counts():
+    transcript = corpus.transcripts[0]
+    expected = {"eng": {}, "spa": {}}
+    for utterance in transcript.utterances:
+        for token in utterance['tokens']:
+            word, pos, lang = token.split(".")
+            expected[lang][f'{word}.{pos}'] = expected[lang].get(f'{word}.{pos}', 0) + 1
+    assert transcript.types_tokens == expected
+
+def test_select_transcripts_by_group_and_lang():
+    store = corpus.token_store
+    selected = store.select_transcripts([100, 500], "spa")
+    expected = [t.main_lang == "spa" and t.participant_id // 100 in [1, 5] for t in corpus.transcripts]
+    assert selected.tolist() == expected
+
+def test_snapshot_only_reparses_changed_files(tmp_path, monkeypatch):
+    import os, shutil, corpus_tool
+    group_dir = tmp_path / "Tagged Transcriptions (group 100)"
+    group_dir.mkdir()
+    for name in ["103_english.cha", "103_spanish.cha"]:
+        shutil.copy(f"transcriptions/Tagged Transcriptions (group 100)/{name}", group_dir / name)
+    snapshot_path = str(tmp_path / "corpus.snapshot")
+    first = Corpus(str(tmp_path), snapshot_path=snapshot_path)
+    assert os.path.exists(snapshot_path)
+
+    parsed = []
+    original_init = corpus_tool.Transcript.__init__
+    def counting_init(self, cha_file_path):
+        parsed.append(cha_file_path)
+        original_init(self, cha_file_path)
+    monkeypatch.setattr(corpus_tool.Transcript, "__init__", counting_init)
+
+    second = Corpus(str(tmp_path), snapshot_path=snapshot_path)
+    assert parsed == []
+    assert [t.utterances for t in second.transcripts] == [t.utterances for t in first.transcripts]
+
+    with open(group_dir / "103_english.cha", "a", encoding="utf-8") as f:
+        f.write("*PAR:\tthe end . 999999_1000000\n%pos: the.DET end.NOUN\n")
+    third = Corpus(str(tmp_path), snapshot_path=snapshot_path)
+    assert parsed == [f"{tmp_path}/Tagged Transcriptions (group 100)/103_english.cha"]
+    assert len(third.token_store) == len(first.token_store) + 2
+
+def test_reload_only_reads_the_snapshot_when_files_changed(tmp_path, monkeypatch):
+    import os, shutil, snapshot
+    group_dir = tmp_path / "Tagged Transcriptions (group 100)"
+    group_dir.mkdir()
+    for name in ["103_english.cha", "103_spanish.cha"]:
+        shutil.copy(f"transcriptions/Tagged Transcriptions (group 100)/{name}", group_dir / name)
+    snapshot_path = str(tmp_path / "corpus.snapshot")
+    first = Corpus(str(tmp_path), snapshot_path=snapshot_path)
+    loads = []
+    original_load = snapshot.CorpusSnapshot._load
+    monkeypatch.setattr(snapshot.CorpusSnapshot, "_load", lambda self: loads.append(1) or original_load(self))
+    assert len(first.reload().transcripts) == 2
+    assert loads == []
+
+    os.remove(group_dir / "103_spanish.cha")
+    second = first.reload()
+    assert [t.filename for t in second.transcripts] == [str(group_dir / "103_english.cha")]
+    assert loads == [1]
+    cached = snapshot.CorpusSnapshot(snapshot_path)
+    assert list(cached.entries) == [str(group_dir / "103_english.cha")]
+    os.remove(group_dir / "103_english.cha")
+    assert cached.get(str(group_dir / "103_english.cha")) is None # removed after the folder was listed
+
+def test_parallel_load_matches_serial():
+    parallel = Corpus('transcriptions', workers=2, chunksize=8)
+    assert [t.filename for t in parallel.transcripts] == [t.filename for t in corpus.transcripts]
+    assert [t.utterances for t in parallel.transcripts] == [t.utterances for t in corpus.transcripts]
+    assert (parallel.token_store.word == corpus.token_store.word).all()
+
+def test_index_lookup_matches_mask():
+    store = corpus.token_store
+    for words, pos, lang in [(['la', 'el'], 'DET', 'spa'), (['the'], None, None), (['lo', 'la'], ['PRON', 'DET'], None)]:
+        expected = np.flatnonzero(store.mask(words=words, POS=pos, lang=lang))
+        assert corpus.index.lookup(words, pos, lang).tolist() == expected.tolist()
+        assert corpus.index.count(words, pos, lang) == len(expected)
+    postings = corpus.occurrences(['la'], 'DET', 'spa', groups=[500])
+    assert len(postings) > 0
+    for posting in postings:
+        transcript = corpus.transcripts[posting['transcript']]
+        assert transcript.participant_id // 100 == 5
+        first_utterance = np.flatnonzero(corpus.token_store.utt_transcript == posting['transcript'])[0]
+        token = transcript.utterances[posting['utterance'] - first_utterance]['tokens'][posting['position']]
+        assert token == 'la.DET.spa'
+
+def test_top_words_ranks_by_frequency():
+    visualizer = Visualizer(corpus)
+    top = visualizer.top_words([100, 300], "eng", 25, ["NOUN", "VERB"])
+    expected = {}
+    for transcript in corpus.transcripts:
+        if transcript.main_lang != "eng" or transcript.participant_id // 100 not in [1, 3]:
+            continue
+        for utterance in transcript.utterances:
+            for token in utterance['tokens']:
+                word, pos, lang = token.split(".")
+                if pos in ["NOUN", "VERB"]:
+                    expected[word] = expected.get(word, 0) + 1
+    totals = [eng + other for word, eng, other in top]
+    assert len(top) == 25
+    assert totals == sorted(totals, reverse=True)
+    assert totals == sorted(expected.values(), reverse=True)[:25]
+    assert all(expected[word] == eng + other for word, eng, other in top)
+
+def test_top_n():
+    counts = np.array([3, 0, 5, 3, 1])
+    assert top_n(counts, 2).tolist() == [2, 0]
+    assert top_n(counts, 10).tolist() == [2, 0, 3, 4]
+    assert top_n(counts, 0).tolist() == top_n(counts, -1).tolist() == []
+
+def test_lexical_diversity_table(tmp_path):
+    table = corpus.lexical_diversity_table(str(tmp_path / "diversity.csv"))
+    assert len(table) == len(corpus.transcripts)
+    assert table.dtype.names[1:] == tuple(corpus.transcripts[0].measure_lexical_diversity())
+    for row, transcript in zip(table, corpus.transcripts):
+        report = transcript.measure_lexical_diversity()
+        assert row['participant_id'] == transcript.participant_id
+        assert all(row[stat] == value for stat, value in report.items())
+    report = corpus.transcripts[0].measure_lexical_diversity()
+    assert report['total_types'] == report['english_types'] + report['spanish_types']
+    assert report['total_content_tokens'] + report['total_functional_tokens'] == report['total_tokens']
+    lines = (tmp_path / "diversity.csv").read_text().splitlines()
+    assert lines[0].startswith("participant_id,total_types,total_tokens") and len(lines) == len(table) + 1
+
+def test_chart_data_shares_one_view():
+    visualizer = Visualizer(corpus)
+    data = visualizer.chart_data(Visualizer.CHART_KINDS, [100, 200], "eng", ['NOUN', 'VERB'], 20)
+    view = CorpusView(corpus, [100, 200], "eng", ['NOUN', 'VERB'])
+    assert data["barchart"] == visualizer.barchart_data(view, 20)
+    assert data["mtld_boxplot"] == visualizer.diversity_data(view, "mtld")
+    assert data["mattr_boxplot"] == visualizer.diversity_data(view, "mattr")
+    assert data["word_cloud"] == visualizer.word_cloud_data(view)
+    assert len(data["barchart"][0]) == 40
+    assert all(len(group) == 0 for group in data["mtld_boxplot"][2:])
+
+def test_boxplot_stats_match_matplotlib():
+    from matplotlib.cbook import boxplot_stats as matplotlib_boxplot_stats
+    data = Visualizer(corpus).chart_data(["mtld_boxplot"])["mtld_boxplot"] + [[1.0, 2.0, 2.5, 3.0, 40.0], [5.0]]
+    for values in data:
+        expected = matplotlib_boxplot_stats(values)[0]
+        stats = boxplot_stats(values)
+        assert stats['median'] == expected['med']
+        assert (stats['q1'], stats['q3']) == (expected['q1'], expected['q3'])
+        assert (stats['whislo'], stats['whishi']) == (expected['whislo'], expected['whishi'])
+        assert stats['fliers'] == list(expected['fliers'])
+    assert boxplot_stats([]) is None
+
+def test_chart_summaries():
+    visualizer = Visualizer(corpus)
+    summaries = visualizer.chart_summaries(Visualizer.CHART_KINDS, [100], None, None, 10)
+    top_words = visualizer.top_words([100], None, 10)
+    assert summaries["barchart"]["words"] == [word for word, _, _ in top_words]
+    assert summaries["barchart"]["eng"] == [eng for _, eng, _ in top_words]
+    assert summaries["mtld_boxplot"]["100"]["n"] == len(visualizer.chart_data(["mtld_boxplot"], [100])["mtld_boxplot"][0])
+    assert summaries["mattr_boxplot"]["200"] is None
+    assert list(summaries["word_cloud"].items())[0] == (top_words[0][0], top_words[0][1] + top_words[0][2])
+
+def test_reload_reuses_unchanged_transcripts(tmp_path):
+    import os, shutil
+    group_dir = tmp_path / "Tagged Transcriptions (group 100)"
+    group_dir.mkdir()
+    for name in ["103_english.cha", "103_spanish.cha", "104_english.cha"]:
+        shutil.copy(f"transcriptions/Tagged Transcriptions (group 100)/{name}", group_dir / name)
+    first = Corpus(str(tmp_path))
+    assert first.changes() == {'added': [], 'changed': [], 'removed': []}
+
+    with open(group_dir / "103_english.cha", "a", encoding="utf-8") as f:
+        f.write("*PAR:\tthe zebra . 999999_1000000\n%pos: the.DET zebra.NOUN\n")
+    os.remove(group_dir / "104_english.cha")
+    shutil.copy("transcriptions/Tagged Transcriptions (group 200)/206_english.cha", group_dir / "206_english.cha")
+    changes = first.changes()
+    assert changes == {
+        'added': [f"{tmp_path}/Tagged Transcriptions (group 100)/206_english.cha"],
+        'changed': [f"{tmp_path}/Tagged Transcriptions (group 100)/103_english.cha"],
+        'removed': [f"{tmp_path}/Tagged Transcriptions (group 100)/104_english.cha"]
+    }
+
+    second = first.reload()
+    assert second.changes() == {'added': [], 'changed': [], 'removed': []}
+    by_file = {t.filename: t for t in second.transcripts}
+    old_by_file = {t.filename: t for t in first.transcripts}
+    spanish = f"{tmp_path}/Tagged Transcriptions (group 100)/103_spanish.cha"
+    english = f"{tmp_path}/Tagged Transcriptions (group 100)/103_english.cha"
+    assert by_file[spanish] is old_by_file[spanish]
+    assert by_file[english] is not old_by_file[english]
+    assert len(by_file[english].utterances) == len(old_by_file[english].utterances) + 1
+    assert sorted(set(int(x) for x in second.token_store.participant_id)) == [103, 206]
+    assert (first.index.count(["zebra"]), second.index.count(["zebra"])) == (0, 1)
+    # the old corpus is left as it was
+    assert len(first.transcripts) == 3
+
+def test_clitic_index_reads_both_csv_formats(tmp_path):
+    legacy = tmp_path / "legacy.csv"
+    legacy.write_text("508, lo\n508, la\n705, lo\n")
+    structured = tmp_path / "clitics.csv"
+    structured.write_text("participant_id,file,utterance,clitic,token\n508,a.cha,3,lo,cómelo\n508,a.cha,7,la,dala\n705,b.cha,0,lo,tómalo\n")
+    assert corpus.clitic_index(str(legacy)) == corpus.clitic_index(str(structured)) == {508: {"lo": 1, "la": 1}, 705: {"lo": 1}}
+
+def test_clitic_boxplots_count_per_participant(tmp_path):
+    spanish = sorted(set(t.participant_id for t in corpus.transcripts if t.main_lang == "spa"))
+    clitics = tmp_path / "clitics.csv"
+    clitics.write_text(f"{spanish[0]}, lo\n{spanish[0]}, le\n")
+    result = Visualizer(corpus).gen_clitic_boxplots(outfile=str(tmp_path / "clitics.png"), clitics_path=str(clitics))
+    counts = [count for group in result["data"] for count in group]
+    assert len(counts) == len(spanish) # one box entry per participant
+    assert sorted(counts)[-1] == 2 and sum(counts) == 2
+
+def test_word_boxplots_match_compare_word_groups(tmp_path):
+    visualizer = Visualizer(corpus)
+    result = visualizer.gen_word_boxplots(['el', 'la'], "DET", "spa", outfile=str(tmp_path / "boxplot.png"))
+    screen = visualizer.compare_word_groups([(['el', 'la'], "DET"), (['y'], "CCONJ")], "spa")
+    assert np.isclose(result["ANOVA"].pvalue, screen["anova"].pvalue[0])
+    assert result["means"] == screen["descriptives"]["mean"][:, 0].tolist()
+
+def test_dispersion_data_counts_every_occurrence():
+    visualizer = Visualizer(corpus)
+    data = visualizer.dispersion_data(['el', 'la'], "500", "spa", "DET")
+    store = corpus.token_store
+    selected = store.select_transcripts([500], "spa")
+    assert len(data) == 101
+    assert sum(data) == int(selected[store.transcript[corpus.index.lookup(['el', 'la'], "DET")]].sum())
+
+def test_dispersion_histograms_of_many_series():
+    visualizer = Visualizer(corpus)
+    series = [(['el', 'la'], "DET", "spa"), ("the", "DET", "eng"), (['lobo'], None, "spa")]
+    histograms = visualizer.dispersion_histograms(series, ["100", "500"])
+    assert histograms.shape == (3, 2, 101)
+    for s, (words, POS, lang) in enumerate(series):
+        for g, group in enumerate(["100", "500"]):
+            assert histograms[s, g].tolist() == visualizer.dispersion_data(words, group, lang, POS)
+    # a string is one word, not every word it contains
+    assert (histograms[1] == visualizer.dispersion_histograms([(['the'], "DET", "eng")], [100, 500])[0]).all()
+    coarse = visualizer.dispersion_histograms(series, [100, 500], bins=10)
+    assert coarse.shape == (3, 2, 10) and (coarse.sum(axis=2) == histograms.sum(axis=2)).all()
+    _, chart = visualizer.gen_dispersion_grid(series, [100, 500], bins=10)
+    assert chart
+
+def test_switch_points_match_token_languages():
+    store = corpus.token_store
+    expected = [row for row in range(1, len(store)) if store.lang[row] != store.lang[row - 1] and store.transcript[row] == store.transcript[row - 1]]
+    assert corpus.switch_points.tolist() == expected
+    transcript = corpus.transcripts[0]
+    assert len(transcript.switch_points) == len(corpus.switch_points[store.transcript[corpus.switch_points] == 0])
+
+def test_code_switch_test():
+    transcript = corpus.transcripts[0]
+    is_code_switched = transcript._code_switch_test("*PAR:\tthe wolf@s se comió a la abuela .")
+    assert is_code_switched("wolf") and is_code_switched("olf")
+    assert not is_code_switched("the") and not is_code_switched("abuela")
+    assert transcript._code_switch_test("*PAR:\t[- eng] the wolf .")("the")
+
+def test_code_switching_data():
+    store = corpus.token_store
+    data = Visualizer(corpus).code_switching_data([500], POS_filter=["NOUN"])
+    switches = corpus.switch_points[store.group[store.transcript[corpus.switch_points]] == 500]
+    switches = switches[store.pos[switches] == store.parts_of_speech.get("NOUN")]
+    assert list(data) == [500]
+    assert data[500]["switches"] == sum(data[500]["directions"].values()) == len(switches)
+    assert data[500]["pos_after"] == {"NOUN": len(switches)}
+    assert sum(count for _, _, count in data[500]["boundaries"]) == len(switches)
+
+def test_string_word_is_matched_exactly():
+    visualizer = Visualizer(corpus)
+    counts, _ = visualizer.word_count_matrix([("the", None), (["the"], None)], "eng")
+    assert (counts[:, 0] == counts[:, 1]).all()
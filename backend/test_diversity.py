@@ -0,0 +1,35 @@
+import random
+from lexical_diversity import lex_div as ld
+from corpus_tool import Corpus
+import diversity
+
+corpus = Corpus('transcriptions')
+
+def test_matches_lexical_diversity_on_random_texts():
+    rng = random.Random(0)
+    for _ in range(500):
+        words = [rng.randint(0, rng.randint(1, 60)) for _ in range(rng.randint(0, 300))]
+        assert round(diversity.mattr(words), 3) == round(ld.mattr(words), 3)
+        assert round(diversity.mattr(words, 5), 3) == round(ld.mattr(words, 5), 3)
+        assert round(diversity.mtld(words), 3) == round(ld.mtld(words), 3)
+
+def test_matches_lexical_diversity_on_transcripts():
+    for transcript in corpus.transcripts:
+        for lang in [None, "eng", "spa"]:
+            for POS in [None, ['NOUN', 'VERB', 'ADJ', 'ADV']]:
+                tokens = [token.split(".") for utterance in transcript.utterances for token in utterance['tokens']]
+                words = [word for word, part_of_speech, token_lang in tokens
+                         if (lang is None or token_lang == lang) and (POS is None or part_of_speech in POS)]
+                assert transcript.calc_mattr(transcript.utterances, lang, POS) == round(ld.mattr(words), 3)
+                assert transcript.calc_mtld(transcript.utterances, lang, POS) == round(ld.mtld(words), 3)
+
+def test_memo():
+    transcript = corpus.transcripts[0]
+    transcript.diversity_memo.clear()
+    first = transcript.calc_mtld(transcript.utterances, "eng", ['VERB', 'NOUN'])
+    assert transcript.diversity_memo == {('mtld', "eng", ('NOUN', 'VERB')): first}
+    assert transcript.calc_mtld(transcript.utterances, "eng", ['NOUN', 'VERB']) == first
+    assert len(transcript.diversity_memo) == 1
+    # utterance subsets are not memoized
+    transcript.calc_mattr(transcript.utterances[:3])
+    assert len(transcript.diversity_memo) == 1
@@ -0,0 +1,54 @@
+from corpus_tool import Corpus
+from extract_enclitic import extract, spanish_utterances, write_clitics
+
+corpus = Corpus('transcriptions')
+
+def fake_extract_batch(texts):
+    return [[[word, word[-2:]] for word in text.split(" ") if word.endswith("lo") and len(word) > 4] for text in texts]
+
+def test_extract_caches_utterances(tmp_path):
+    cache = str(tmp_path / "cache.json")
+    batches = []
+    def counting_extract_batch(texts):
+        batches.append(len(texts))
+        return fake_extract_batch(texts)
+    rows = extract(corpus, cache, batch_size=100, extract_batch=counting_extract_batch)
+    assert rows and all(clitic == "lo" and token.endswith("lo") for _, _, _, clitic, token in rows)
+    texts = set(text for transcript in corpus.transcripts for _, text in spanish_utterances(transcript))
+    assert sum(batches) == len(texts) and max(batches) == 100
+    # a re-run only tokenizes what is not cached yet
+    batches.clear()
+    assert extract(corpus, cache, extract_batch=counting_extract_batch) == rows
+    assert batches == []
+    write_clitics(rows, str(tmp_path / "clitics.csv"))
+    index = corpus.clitic_index(str(tmp_path / "clitics.csv"))
+    assert sum(index[rows[0][0]].values()) == sum(1 for row in rows if row[0] == rows[0][0])
+
+class FakePipeline:
+    '''
+    Splits the document into one sentence per line break, and "cómelo" like words into word + lo
+    '''
+    def tokenize(self, document):
+        sentences, offset = [], 0
+        for line in document.split("\n"):
+            tokens = []
+            for word in line.split(" "):
+                token = {'text': word, 'dspan': (offset, offset + len(word))}
+                if word.endswith("lo") and len(word) > 4:
+                    token['expanded'] = [{'text': word[:-2]}, {'text': "lo"}]
+                tokens.append(token)
+                offset += len(word) + 1
+            sentences.append({'tokens': tokens})
+        return {'sentences': sentences}
+
+def test_extract_clitics_maps_tokens_to_utterances(monkeypatch):
+    import extract_enclitic
+    monkeypatch.setattr(extract_enclitic, "_pipeline", FakePipeline())
+    texts = ["y cómelo", "nada", "dámelo y tómalo"]
+    assert extract_enclitic.extract_clitics(texts) == [[["cómelo", "lo"]], [], [["dámelo", "lo"], ["tómalo", "lo"]]]
+
+def test_write_clitics_quotes_commas(tmp_path):
+    from corpus_tool import load_clitics
+    rows = [(509, "Tagged Transcriptions (group 500)/509, take 2.cha", 3, "lo", "cómelo"), (509, "509.cha", 4, "la", "dila")]
+    write_clitics(rows, str(tmp_path / "clitics.csv"))
+    assert load_clitics(str(tmp_path / "clitics.csv")) == {509: {"lo": 1, "la": 1}}
@@ -0,0 +1,40 @@
+import numpy as np
+from scipy.stats import f_oneway, ttest_ind, false_discovery_control
+import group_stats
+
+rng = np.random.default_rng(0)
+sizes = [12, 9, 15, 6]
+X = rng.poisson(3, size=(sum(sizes), 20)).astype(float)
+labels = np.repeat([100, 200, 500, 600], sizes)
+samples = [X[labels == group] for group in [100, 200, 500, 600]]
+
+def test_anova_matches_scipy():
+    result = group_stats.anova(X, labels)
+    expected = f_oneway(*samples)
+    assert np.allclose(result.statistic, expected.statistic) and np.allclose(result.pvalue, expected.pvalue)
+    assert np.isnan(group_stats.anova([1.0, 2.0, 3.0], [1, 1, 2], [1, 2, 3]).pvalue).all() # empty group
+
+def test_pairwise_ttests_match_scipy():
+    for equal_var in [True, False]:
+        pairs, result = group_stats.pairwise_ttests(X, labels, equal_var=equal_var)
+        assert pairs == [(100, 200), (100, 500), (100, 600), (200, 500), (200, 600), (500, 600)]
+        for p, (i, j) in enumerate([(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)]):
+            expected = ttest_ind(samples[i], samples[j], equal_var=equal_var)
+            assert np.allclose(result.statistic[p], expected.statistic) and np.allclose(result.pvalue[p], expected.pvalue)
+
+def test_adjust_pvalues():
+    p = rng.uniform(size=30) ** 3
+    assert np.allclose(group_stats.adjust_pvalues(p, 'fdr_bh'), false_discovery_control(p))
+    assert np.allclose(group_stats.adjust_pvalues(p, 'bonferroni'), np.minimum(1, p * 30))
+    holm = group_stats.adjust_pvalues(p, 'holm')
+    order = np.argsort(p)
+    assert np.allclose(holm[order], np.minimum(1, np.maximum.accumulate(p[order] * np.arange(30, 0, -1))))
+    per_column = group_stats.adjust_pvalues(np.stack([p, p[::-1]], axis=1), 'holm', axis=0)
+    assert np.allclose(per_column[:, 0], holm) and np.allclose(per_column[:, 1], holm[::-1])
+
+def test_resampling_agrees_with_the_tests():
+    result = group_stats.compare_groups(X, labels, permutations=4000, bootstrap_samples=2000, seed=1)
+    assert np.abs(result['permutation_anova_pvalues'] - result['anova'].pvalue).max() < 0.1
+    assert np.abs(result['permutation_ttest_pvalues'] - result['ttests'].pvalue).max() < 0.15
+    means = result['descriptives']['mean']
+    assert ((result['bootstrap']['mean_low'] <= means) & (means <= result['bootstrap']['mean_high'])).all()
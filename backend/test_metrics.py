@@ -0,0 +1,30 @@
+import metrics
+from metrics import Histogram, stage, collect_stages, record, server_timing
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_seconds", "test", "stage", buckets=(0.1, 1))
+    for value in [0.05, 0.5, 5]:
+        histogram.observe("render", value)
+    lines = histogram.render()
+    assert 'test_seconds_bucket{stage="render",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="render",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="render",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{stage="render"} 5.55' in lines
+    assert histogram.count("render") == 3 and histogram.count("filter") == 0
+
+def test_collected_stages_are_recorded_by_the_caller():
+    before = metrics.STAGE_SECONDS.count("test_stage")
+    with collect_stages() as timings:
+        with stage("test_stage"):
+            pass
+    assert [name for name, _ in timings] == ["test_stage"]
+    assert metrics.STAGE_SECONDS.count("test_stage") == before
+    request_timings = []
+    token = metrics.request_timings.set(request_timings)
+    record(timings)
+    metrics.request_timings.reset(token)
+    assert metrics.STAGE_SECONDS.count("test_stage") == before + 1
+    assert request_timings == timings
+
+def test_server_timing():
+    assert server_timing([("png", 0.25), ("base64", 0.001), ("png", 0.25)]) == "png;dur=500.0, base64;dur=1.0"
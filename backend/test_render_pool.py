@@ -0,0 +1,37 @@
+import time, asyncio, threading
+import pytest
+from corpus_tool import Corpus, Visualizer
+from render_pool import RenderPool, RenderPoolSaturated
+
+corpus = Corpus('transcriptions')
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_render_pool_matches_visualizer(workers):
+    pool = RenderPool(corpus, workers=workers, max_queue=4, timeout=60)
+    try:
+        result = asyncio.run(pool.run("top_words", groups=[100], target_lang="eng", top_N_most_frequent=10))
+    finally:
+        pool.shutdown()
+    assert result == Visualizer(corpus).top_words([100], "eng", 10)
+
+def test_render_pool_rejects_when_saturated():
+    pool = RenderPool(corpus, workers=0, max_queue=0, timeout=60)
+    with pytest.raises(RenderPoolSaturated):
+        asyncio.run(pool.run("top_words", groups=[100]))
+
+def test_timed_out_render_stays_pending_until_it_ends():
+    pool = RenderPool(corpus, workers=0, max_queue=1, timeout=0.05)
+    finish = threading.Event()
+    pool.visualizer.slow_chart = lambda: finish.wait(5)
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(pool.run("slow_chart"))
+        assert pool.pending == 1
+        with pytest.raises(RenderPoolSaturated):
+            asyncio.run(pool.run("top_words", groups=[100]))
+        finish.set()
+        time.sleep(0.2)
+        assert pool.pending == 0
+    finally:
+        finish.set()
+        pool.shutdown()
@@ -0,0 +1,39 @@
+import asyncio
+from tag_batcher import TagBatcher
+
+def test_concurrent_requests_share_a_batch():
+    calls = []
+    def tag_batch(sentences):
+        calls.append(len(sentences))
+        return [[word.upper() for word in sentence] for sentence in sentences]
+    batcher = TagBatcher(tag_batch, max_batch=8, max_wait=0.05)
+    async def main():
+        return await asyncio.gather(*[batcher.tag(["a", str(i)]) for i in range(5)], batcher.tag_many([["b"], ["c"]]))
+    results = asyncio.run(main())
+    batcher.shutdown()
+    assert calls == [7]
+    assert results[:5] == [["A", str(i)] for i in range(5)]
+    assert results[5] == [["B"], ["C"]]
+
+def test_full_batch_flushes_without_waiting():
+    calls = []
+    def tag_batch(sentences):
+        calls.append(len(sentences))
+        return sentences
+    batcher = TagBatcher(tag_batch, max_batch=2, max_wait=60)
+    async def main():
+        return await asyncio.wait_for(batcher.tag_many([["a"], ["b"], ["c"], ["d"]]), 5)
+    assert asyncio.run(main()) == [["a"], ["b"], ["c"], ["d"]]
+    batcher.shutdown()
+    assert calls == [2, 2]
+    assert batcher.running == set() # finished batch tasks are released
+
+def test_errors_reach_every_request():
+    def tag_batch(sentences):
+        raise RuntimeError("model failed")
+    batcher = TagBatcher(tag_batch, max_batch=4, max_wait=0.01)
+    async def main():
+        return await asyncio.gather(batcher.tag(["a"]), batcher.tag(["b"]), return_exceptions=True)
+    results = asyncio.run(main())
+    batcher.shutdown()
+    assert all(isinstance(r, RuntimeError) for r in results)
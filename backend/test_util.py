@@ -0,0 +1,62 @@
+import re
+from util import iter_cha_records, get_cha_files_in_dir, parse_utterances_from_cha, preprocess_sentence_from_cha, preprocess_sentences_from_cha, preprocess_cha_file
+
+CHA_TEXT = (
+    "@Languages:\tspa,eng\n"
+    "@Participants:\tPAR 103 Speaker\n"
+    "*PAR:\t&-um cuando ella estaba caminando <por>\n"
+    "\t[//] &-uh (.) like@s para ir a la casa . 46590_67713\n"
+    "%pos: cuando.SCONJ ella.PRON estaba.AUX caminando.VERB por.ADP like.CCONJ para.ADP ir.VERB a.ADP la.DET casa.NOUN\n"
+    "*PAR:\ty luego . 67713_70000\n"
+)
+
+def test_iter_cha_records(tmp_path):
+    cha_file = tmp_path / "103_spanish.cha"
+    cha_file.write_bytes(CHA_TEXT.replace("\n", "\r\n").encode("utf-8"))
+    for use_mmap in [False, True]:
+        records = list(iter_cha_records(str(cha_file), use_mmap))
+        assert [record.kind for record in records] == ["header", "header", "utterance", "pos", "utterance"]
+        assert records[2].text == CHA_TEXT.splitlines(keepends=True)[2] + CHA_TEXT.splitlines(keepends=True)[3]
+        assert records[2].timestamp == "46590_67713"
+        assert records[4].timestamp == "67713_70000"
+
+def reference_preprocess_sentence_from_cha(line):
+    # the regex loop implementation preprocess_sentence_from_cha replaced
+    if line[0] == "@":
+        return
+    try:
+        original_text = line.split("*PAR:\t")[1]
+        preprocessed_text = re.sub(r'<.*?>\s*\[e\]', '', original_text)
+        if re.search(r"(\([.]+\))", preprocessed_text):
+            text = ""
+            for part in re.split(r"(\([.]+\))", original_text):
+                if not re.search(r"(\([.]+\))", part):
+                    text += part[:-1]
+            preprocessed_text = text
+        while parentheses := re.search(r"\(.+?\)", preprocessed_text):
+            preprocessed_text = preprocessed_text[0:parentheses.start()] + preprocessed_text[parentheses.start()+1:parentheses.end()-1] + preprocessed_text[parentheses.end():]
+        while parentheses := re.search(r"\<.+?\>", preprocessed_text):
+            preprocessed_text = preprocessed_text[0:parentheses.start()] + preprocessed_text[parentheses.start()+1:parentheses.end()-1] + preprocessed_text[parentheses.end():]
+        for pattern in [r'&-\w+', r'&=\w+', r'\[[^\]]*\]\s?', r'@s', r'\+"/', r'\+"']:
+            preprocessed_text = re.sub(pattern, '', preprocessed_text)
+        return preprocessed_text.split(".")[0].split("?")[0]
+    except:
+        pass
+
+def test_preprocess_sentence_matches_reference_on_corpus():
+    for cha_file in get_cha_files_in_dir('transcriptions'):
+        utterances = parse_utterances_from_cha(cha_file)
+        assert preprocess_sentences_from_cha(utterances) == [reference_preprocess_sentence_from_cha(line) for line in utterances]
+
+def test_preprocess_sentence_edge_cases():
+    for line in ["*PAR:\t((a)) ()) (b\n) <x <y> [e] z> . 1_2", "*PAR:\t<a> \n [e] <b> [e] (..) c (.) d . 1_2",
+                 "*PAR:\t&&-uh=coughs ++\"/\" a@s [: b] [*] c? 1_2", "no participant marker", "@Begin\n"]:
+        assert preprocess_sentence_from_cha(line) == reference_preprocess_sentence_from_cha(line)
+    assert preprocess_sentence_from_cha("*PAR:\tla niña (.) tiene una <ros(ada)> [///] rojo [: roja][*] . 2495_17001") == "la niña tiene una rosada rojo "
+
+def test_preprocess_cha_file(tmp_path):
+    cha_file = tmp_path / "103_spanish.cha"
+    cha_file.write_text(CHA_TEXT, encoding="utf-8")
+    result = preprocess_cha_file(str(cha_file))
+    assert [utterance for utterance, _ in result] == [CHA_TEXT.splitlines(keepends=True)[2] + CHA_TEXT.splitlines(keepends=True)[3], CHA_TEXT.splitlines(keepends=True)[5]]
+    assert [text for _, text in result] == [preprocess_sentence_from_cha(utterance) for utterance, _ in result]
@@ -0,0 +1,371 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+class Vocabulary:
+    '''
+    Interns strings to dense integer ids so token attributes can be held in NumPy arrays
+    '''
+    def __init__(self, items: list=None):
+        self.items = []
+        self.ids = {}
+        self._array = None
+        for item in items or []:
+            self.intern(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, item_id: int):
+        return self.items[item_id]
+
+    def __contains__(self, item):
+        return item in self.ids
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getstate__(self):
+        return self.items
+
+    def __setstate__(self, items):
+        self.__init__(items)
+
+    def intern(self, item: str):
+        item_id = self.ids.get(item)
+        if item_id is None:
+            item_id = len(self.items)
+            self.ids[item] = item_id
+            self.items.append(item)
+            self._array = None
+        return item_id
+
+    def get(self, item: str, default: int=-1):
+        return self.ids.get(item, default)
+
+    def ids_of(self, items: list):
+        '''
+        Returns the ids of the given items, silently skipping items that were never interned
+        '''
+        return np.array([self.ids[x] for x in items if x in self.ids], dtype=np.int32)
+
+    def as_array(self):
+        if self._array is None:
+            self._array = np.array(self.items, dtype=object)
+        return self._array
+
+class TokenStore:
+    '''
+    Columnar store of the tokens of one or more transcripts.
+    Token level arrays: word, pos, lang (vocabulary ids), utterance (row in the utterance arrays), position (index within the utterance)
+    Utterance level arrays: utt_start, utt_end (timestamps in ms), utt_transcript (row in the transcript arrays)
+    Transcript level arrays: participant_id, group, main_lang (lang vocabulary id), duration, offsets (first token of each transcript)
+    '''
+    def __init__(self):
+        self.words = Vocabulary()
+        self.parts_of_speech = Vocabulary()
+        self.langs = Vocabulary()
+        self.word = np.zeros(0, dtype=np.int32)
+        self.pos = np.zeros(0, dtype=np.int32)
+        self.lang = np.zeros(0, dtype=np.int32)
+        self.utterance = np.zeros(0, dtype=np.int32)
+        self.position = np.zeros(0, dtype=np.int32)
+        self.utt_start = np.zeros(0, dtype=np.int64)
+        self.utt_end = np.zeros(0, dtype=np.int64)
+        self.utt_transcript = np.zeros(0, dtype=np.int32)
+        self.participant_id = np.zeros(0, dtype=np.int64)
+        self.main_lang = np.zeros(0, dtype=np.int32)
+        self.duration = np.zeros(0, dtype=np.int64)
+        self._finalize()
+
+    @classmethod
+    def from_utterances(cls, utterances: list, participant_id: int=0, main_lang: str=None, duration: int=None):
+        '''
+        Build a single transcript store from utterance dicts whose tokens are "word.POS.lang" strings
+        '''
+        store = cls()
+        word, pos, lang, utterance, position = [], [], [], [], []
+        for utt_idx, utt in enumerate(utterances):
+            for token_idx, token in enumerate(utt['tokens']):
+                parts = token.split(".")
+                word.append(store.words.intern(parts[0]))
+                pos.append(store.parts_of_speech.intern(parts[1]))
+                lang.append(store.langs.intern(parts[2]))
+                utterance.append(utt_idx)
+                position.append(token_idx)
+        store.word = np.array(word, dtype=np.int32)
+        store.pos = np.array(pos, dtype=np.int32)
+        store.lang = np.array(lang, dtype=np.int32)
+        store.utterance = np.array(utterance, dtype=np.int32)
+        store.position = np.array(position, dtype=np.int32)
+        store.utt_start = np.array([int(x['time_start']) for x in utterances], dtype=np.int64)
+        store.utt_end = np.array([int(x['time_end']) for x in utterances], dtype=np.int64)
+        store.utt_transcript = np.zeros(len(utterances), dtype=np.int32)
+        if duration is None:
+            duration = int(store.utt_end[-1]) if len(utterances) > 0 else 0
+        store.participant_id = np.array([participant_id], dtype=np.int64)
+        store.main_lang = np.array([store.langs.intern(str(main_lang))], dtype=np.int32)
+        store.duration = np.array([duration], dtype=np.int64)
+        store._finalize()
+        return store
+
+    @classmethod
+    def from_transcript(cls, transcript):
+        return cls.from_utterances(transcript.utterances, transcript.participant_id, transcript.main_lang, transcript.duration)
+
+    @classmethod
+    def merge(cls, stores: list):
+        '''
+        Concatenate stores into one, re-interning their vocabularies into shared ones.
+        Only the vocabularies are walked in Python, the token arrays are remapped with fancy indexing.
+        '''
+        merged = cls()
+        columns = {name: [] for name in ['word', 'pos', 'lang', 'utterance', 'position', 'utt_start', 'utt_end', 'utt_transcript', 'participant_id', 'main_lang', 'duration']}
+        utt_offset = 0
+        transcript_offset = 0
+        for store in stores:
+            word_map = np.array([merged.words.intern(x) for x in store.words], dtype=np.int32)
+            pos_map = np.array([merged.parts_of_speech.intern(x) for x in store.parts_of_speech], dtype=np.int32)
+            lang_map = np.array([merged.langs.intern(x) for x in store.langs], dtype=np.int32)
+            columns['word'].append(word_map[store.word] if len(store.word) else store.word)
+            columns['pos'].append(pos_map[store.pos] if len(store.pos) else store.pos)
+            columns['lang'].append(lang_map[store.lang] if len(store.lang) else store.lang)
+            columns['utterance'].append(store.utterance + utt_offset)
+            columns['position'].append(store.position)
+            columns['utt_start'].append(store.utt_start)
+            columns['utt_end'].append(store.utt_end)
+            columns['utt_transcript'].append(store.utt_transcript + transcript_offset)
+            columns['participant_id'].append(store.participant_id)
+            columns['main_lang'].append(lang_map[store.main_lang])
+            columns['duration'].append(store.duration)
+            utt_offset += store.n_utterances
+            transcript_offset += store.n_transcripts
+        for name, arrays in columns.items():
+            if arrays:
+                setattr(merged, name, np.concatenate(arrays).astype(getattr(merged, name).dtype, copy=False))
+        merged._finalize()
+        return merged
+
+    def _finalize(self):
+        '''
+        Derive the lookup arrays that are implied by the stored columns
+        '''
+        self.transcript = self.utt_transcript[self.utterance] if len(self.utterance) else np.zeros(0, dtype=np.int32)
+        self.group = (self.participant_id // 100) * 100
+        self.offsets = np.searchsorted(self.transcript, np.arange(self.n_transcripts + 1))
+        self._utt_time_percent = None
+
+    def __len__(self):
+        return len(self.word)
+
+    @property
+    def n_utterances(self):
+        return len(self.utt_start)
+
+    @property
+    def n_transcripts(self):
+        return len(self.participant_id)
+
+    def select_transcripts(self, groups: list=None, main_lang: str=None):
+        '''
+        Boolean mask over transcripts.
+        A transcript is in a group when its participant id is within [group, group + 100), eg id 543 is in group 500
+        '''
+        selected = np.ones(self.n_transcripts, dtype=bool)
+        if groups:
+            in_group = np.zeros(self.n_transcripts, dtype=bool)
+            for group in groups:
+                if group:
+                    id_diff = self.participant_id - int(group)
+                    in_group |= (id_diff >= 0) & (id_diff < 100)
+            selected &= in_group
+        if main_lang:
+            selected &= self.main_lang == self.langs.get(main_lang)
+        return selected
+
+    def mask(self, transcripts=None, words: list=None, POS: list=None, lang: str=None):
+        '''
+        Boolean mask over tokens. Every given filter must match:
+            - transcripts: boolean mask over transcripts (see select_transcripts)
+            - words: list of words (or an array of word ids)
+            - POS: list of part of speech tags, or a single tag
+            - lang: language tag of the token
+        '''
+        selected = np.ones(len(self), dtype=bool)
+        if transcripts is not None:
+            selected &= transcripts[self.transcript]
+        if words is not None:
+            word_ids = words if isinstance(words, np.ndarray) else self.words.ids_of(words)
+            selected &= np.isin(self.word, word_ids)
+        if POS is not None:
+            selected &= np.isin(self.pos, self.parts_of_speech.ids_of([POS] if isinstance(POS, str) else POS))
+        if lang is not None:
+            selected &= self.lang == self.langs.get(lang)
+        return selected
+
+    def word_strings(self, mask=None):
+        '''
+        The words of the selected tokens, in corpus order
+        '''
+        word = self.word if mask is None else self.word[mask]
+        return self.words.as_array()[word].tolist()
+
+    def count_by_transcript(self, mask=None):
+        '''
+        Token counts per transcript, mask can be a boolean mask or an array of token rows
+        '''
+        transcript = self.transcript if mask is None else self.transcript[mask]
+        return np.bincount(transcript, minlength=self.n_transcripts)
+
+    def count_by_word(self, mask=None):
+        word = self.word if mask is None else self.word[mask]
+        return np.bincount(word, minlength=len(self.words))
+
+    def lang_counts(self, mask=None):
+        lang = self.lang if mask is None else self.lang[mask]
+        counts = np.bincount(lang, minlength=len(self.langs))
+        return {self.langs[i]: int(count) for i, count in enumerate(counts) if count > 0}
+
+    def switch_points(self):
+        '''
+        Token rows whose language differs from the previous token of the same transcript, ie the first token of every
+        code switch. A switch at position 0 of an utterance happened between utterances.
+        '''
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int32)
+        switched = (self.lang[1:] != self.lang[:-1]) & (self.transcript[1:] == self.transcript[:-1])
+        return (np.flatnonzero(switched) + 1).astype(np.int32)
+
+    def utterance_time_fraction(self):
+        '''
+        The midpoint of each utterance as a fraction of its transcript's duration
+        '''
+        mid_time = (self.utt_start + self.utt_end) / 2
+        return mid_time / self.duration[self.utt_transcript]
+
+    def utterance_time_percent(self):
+        '''
+        The midpoint of each utterance as a whole percentage of its transcript's duration.
+        Computed once with Python's round(), np.round disagrees with it on some halfway cases.
+        '''
+        if self._utt_time_percent is None:
+            fraction = self.utterance_time_fraction()
+            self._utt_time_percent = np.array([int(round(x, 2) * 100) for x in fraction.tolist()], dtype=np.int64)
+        return self._utt_time_percent
+
+class TokenIndex:
+    '''
+    Inverted index from (word, POS, lang) to the tokens carrying them in a TokenStore.
+    Every key owns a contiguous run of `postings` (token rows sorted by key, then by corpus order) so a lookup
+    costs in proportion to the number of matching keys and hits instead of the size of the corpus.
+    '''
+    def __init__(self, store: TokenStore):
+        self.store = store
+        self.n_pos = max(len(store.parts_of_speech), 1)
+        self.n_langs = max(len(store.langs), 1)
+        keys = (store.word.astype(np.int64) * self.n_pos + store.pos) * self.n_langs + store.lang
+        self.postings = np.argsort(keys, kind="stable").astype(np.int64)
+        self.keys, self.starts = np.unique(keys[self.postings], return_index=True)
+        self.ends = np.append(self.starts[1:], len(self.postings)).astype(np.int64)
+        # keys are sorted by word first, so each word's keys are a contiguous run too
+        self.word_starts = np.searchsorted(self.keys // (self.n_pos * self.n_langs), np.arange(len(store.words) + 1))
+
+    def _key_rows(self, words=None, POS=None, lang=None):
+        store = self.store
+        if words is None:
+            key_rows = np.arange(len(self.keys))
+        else:
+            word_ids = words if isinstance(words, np.ndarray) else store.words.ids_of(words)
+            key_rows = np.concatenate([np.arange(self.word_starts[w], self.word_starts[w + 1]) for w in word_ids] + [np.zeros(0, dtype=np.int64)])
+        if POS is not None:
+            pos_ids = store.parts_of_speech.ids_of([POS] if isinstance(POS, str) else POS)
+            key_rows = key_rows[np.isin((self.keys[key_rows] // self.n_langs) % self.n_pos, pos_ids)]
+        if lang is not None:
+            key_rows = key_rows[self.keys[key_rows] % self.n_langs == store.langs.get(lang)]
+        return key_rows
+
+    def lookup(self, words=None, POS=None, lang=None, ordered: bool=True):
+        '''
+        Token rows (in corpus order) of every token matching all the given filters:
+            - words: list of words (or an array of word ids)
+            - POS: list of part of speech tags, or a single tag
+            - lang: language tag of the token
+        With ordered=False the rows are only ordered within each key, which saves a sort when the caller filters them first
+        '''
+        runs = [self.postings[self.starts[k]:self.ends[k]] for k in self._key_rows(words, POS, lang)]
+        if not runs:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.concatenate(runs)
+        return np.sort(rows) if ordered and len(runs) > 1 else rows
+
+    def count(self, words=None, POS=None, lang=None):
+        key_rows = self._key_rows(words, POS, lang)
+        return int((self.ends[key_rows] - self.starts[key_rows]).sum())
+
+    def postings_of(self, rows):
+        '''
+        Structured array of (transcript, utterance, position, time) for the given token rows, where time is the
+        midpoint of the utterance in ms
+        '''
+        store = self.store
+        result = np.zeros(len(rows), dtype=[('transcript', np.int32), ('utterance', np.int32), ('position', np.int32), ('time', np.float64)])
+        result['transcript'] = store.transcript[rows]
+        result['utterance'] = store.utterance[rows]
+        result['position'] = store.position[rows]
+        result['time'] = (store.utt_start[result['utterance']] + store.utt_end[result['utterance']]) / 2
+        return result
+
+class GroupFrequencies:
+    '''
+    Sparse token counts with one row per (group, main language of the transcript, token language, POS) and one
+    column per word, built once so frequency views only have to sum the rows matching a request.
+    Groups are the hundreds of the participant ids, eg participant 543 is counted in group 500.
+    '''
+    def __init__(self, store: TokenStore):
+        self.store = store
+        self.groups = np.unique(store.group)
+        n_langs, n_pos = max(len(store.langs), 1), max(len(store.parts_of_speech), 1)
+        self.shape = (len(self.groups), n_langs, n_langs, n_pos)
+        group_idx = np.searchsorted(self.groups, store.group)[store.transcript]
+        rows = ((group_idx * n_langs + store.main_lang[store.transcript]) * n_langs + store.lang) * n_pos + store.pos
+        # duplicate (row, word) entries are summed when the COO input is converted
+        self.matrix = csr_matrix((np.ones(len(store), dtype=np.int64), (rows, store.word)), shape=(int(np.prod(self.shape)), len(store.words)))
+
+    def _axis_mask(self, size: int, ids):
+        if ids is None:
+            return np.ones(size, dtype=bool)
+        mask = np.zeros(size, dtype=bool)
+        ids = np.asarray(ids, dtype=np.int64)
+        mask[ids[(ids >= 0) & (ids < size)]] = True
+        return mask
+
+    def counts(self, groups: list=None, main_lang: str=None, lang: str=None, POS: list=None):
+        '''
+        Token count of every word (indexed by word id) summed over the selected groups, transcript main language,
+        token language and parts of speech. None selects everything along that axis.
+        '''
+        store = self.store
+        group_ids = None if not groups else np.flatnonzero(np.isin(self.groups, [int(g) // 100 * 100 for g in groups if g]))
+        pos_ids = None if POS is None else store.parts_of_speech.ids_of([POS] if isinstance(POS, str) else POS)
+        selected = (self._axis_mask(self.shape[0], group_ids)[:, None, None, None]
+                    & self._axis_mask(self.shape[1], None if not main_lang else [store.langs.get(main_lang)])[None, :, None, None]
+                    & self._axis_mask(self.shape[2], None if lang is None else [store.langs.get(lang)])[None, None, :, None]
+                    & self._axis_mask(self.shape[3], pos_ids)[None, None, None, :])
+        rows = np.flatnonzero(selected.ravel())
+        if len(rows) == 0:
+            return np.zeros(self.matrix.shape[1], dtype=np.int64)
+        return np.asarray(self.matrix[rows].sum(axis=0)).ravel()
+
+def top_n(counts, n: int):
+    '''
+    Ids of the n largest non zero counts, most frequent first and ties broken by id.
+    Uses a partial sort so only the selected ids get fully sorted.
+    '''
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.flatnonzero(counts)
+    if len(candidates) > n:
+        threshold = counts[candidates[np.argpartition(-counts[candidates], n - 1)[:n]]].min()
+        above = candidates[counts[candidates] > threshold]
+        ties = candidates[counts[candidates] == threshold][:n - len(above)]
+        candidates = np.concatenate([above, ties])
+    return candidates[np.lexsort((candidates, -counts[candidates]))]
@@ -1,5 +1,12 @@
 #from flair.data import Sentence
-import re, os
+import re, os, mmap, bisect
+from collections import namedtuple
+
+TIMESTAMP_PATTERN = re.compile(r'[0-9]+_[0-9]+')
+
+# kind is one of "header" (@ lines), "utterance" (*PAR: lines with their continuation lines joined),
+# "pos" (%pos tiers) or "other"; timestamp is the "start_end" string of an utterance, otherwise None
+ChaRecord = namedtuple('ChaRecord', ['kind', 'text', 'timestamp'])
 
 def get_cha_files_in_dir(directory):
     result = []
@@ -14,43 +21,166 @@ def get_cha_files_in_dir(directory):
             result.append(obj_absolute_path)
     return result
 
+def iter_cha_lines(filepath: str, use_mmap: bool=False):
+    """
+    Yields the lines of a .cha file, reading it exactly once.
+    With use_mmap the file is memory mapped and decoded line by line instead of going through a buffered text stream,
+    line endings are normalized to \n either way.
+    """
+    if not use_mmap:
+        with open(filepath, 'r', encoding='utf-8', errors="ignore") as cha_file:
+            yield from cha_file
+        return
+    with open(filepath, 'rb') as cha_file:
+        if os.fstat(cha_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(cha_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for raw_line in iter(mapped.readline, b''):
+                line = raw_line.decode('utf-8', errors="ignore")
+                if '\r' not in line:
+                    yield line
+                    continue
+                # a lone \r is a line break for universal newlines too
+                parts = line.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+                yield from [part + '\n' for part in parts[:-1]]
+                if parts[-1]:
+                    yield parts[-1]
+
+def iter_cha_records(filepath: str, use_mmap: bool=False):
+    """
+    Single pass, line oriented parser for .cha files.
+    Inputs:
+        - filepath: path to a .cha file
+        - use_mmap: (optional) memory map the file instead of reading it through a text stream
+    Outputs:
+        A generator of ChaRecord tuples in file order. CLAN forces a new line on long utterances, so the lines
+        following a *PAR: line are joined onto it until the "start_end" timestamp that ends every utterance is found.
+    """
+    par_line = None
+    for line in iter_cha_lines(filepath, use_mmap):
+        if par_line is not None:
+            par_line += line
+            timestamp = TIMESTAMP_PATTERN.search(line)
+            if timestamp:
+                yield ChaRecord("utterance", par_line, timestamp.group(0))
+                par_line = None
+        elif "%pos:" in line:
+            yield ChaRecord("pos", line, None)
+        elif "*PAR:" in line:
+            timestamp = TIMESTAMP_PATTERN.search(line)
+            if timestamp:
+                yield ChaRecord("utterance", line, timestamp.group(0))
+            else:
+                par_line = line
+        elif line[:1] == "@":
+            yield ChaRecord("header", line, None)
+        else:
+            yield ChaRecord("other", line, None)
+    if par_line is not None:
+        yield ChaRecord("utterance", par_line, None) # the file ended before the utterance's timestamp
+
+EXCLUDED_END_PATTERN = re.compile(r'>\s*\[e\]')
+PAUSE_PATTERN = re.compile(r'(\([.]+\))')
+# applied one after the other, a later pattern may match text joined by removing an earlier one
+CODE_PATTERNS = [re.compile(pattern) for pattern in [r'&-\w+', r'&=\w+', r'\[[^\]]*\]\s?', r'@s', r'\+"/', r'\+"']]
+
+def _remove_excluded(text: str):
+    '''
+    Same as re.sub(r'<.*?>\\s*\\[e\\]', '', text) without rescanning the rest of the line for every < that has no [e]
+    '''
+    if "<" not in text:
+        return text
+    ends = [(match.start(), match.end()) for match in EXCLUDED_END_PATTERN.finditer(text)]
+    ends_at = [start for start, _ in ends]
+    newlines = [i for i, char in enumerate(text) if char == "\n"]
+    result = []
+    kept = 0 # text before kept is final
+    open_at = text.find("<")
+    while open_at != -1:
+        # the first > followed by [e] after the <, it must be on the same line
+        end = bisect.bisect_right(ends_at, open_at)
+        line_end = newlines[bisect.bisect_right(newlines, open_at)] if newlines and newlines[-1] > open_at else len(text)
+        if end < len(ends) and ends_at[end] < line_end:
+            result.append(text[kept:open_at])
+            kept = ends[end][1]
+            open_at = text.find("<", kept)
+        else:
+            open_at = text.find("<", open_at + 1)
+    result.append(text[kept:])
+    return "".join(result)
+
+def _unwrap_pairs(text: str, opening: str, closing: str):
+    '''
+    Drops the delimiters of every opening...closing pair with at least one character in between, the way
+    repeatedly removing the first match of eg "\\(.+?\\)" would, but in a single pass over each line
+    '''
+    if opening not in text:
+        return text
+    return "\n".join(_unwrap_line_pairs(line, opening, closing) for line in text.split("\n"))
+
+def _unwrap_line_pairs(line: str, opening: str, closing: str):
+    closings = [i for i, char in enumerate(line) if char == closing]
+    dropped = set() # closing delimiters already paired with an earlier opening one
+    result = []
+    start = 0 # everything before start is final
+    next_closing = 0
+    while True:
+        open_at = line.find(opening, start)
+        if open_at == -1:
+            break
+        # the pair needs a character in between, which may itself be a closing delimiter
+        inner = open_at + 1
+        while inner in dropped:
+            inner += 1
+        while next_closing < len(closings) and (closings[next_closing] <= inner or closings[next_closing] in dropped):
+            next_closing += 1
+        if inner >= len(line) or next_closing == len(closings):
+            break # no later opening delimiter can be paired either
+        result.extend(char for i, char in enumerate(line[start:open_at], start) if i not in dropped)
+        dropped.add(closings[next_closing])
+        next_closing += 1
+        start = open_at + 1
+    result.extend(char for i, char in enumerate(line[start:], start) if i not in dropped)
+    return "".join(result)
+
 def preprocess_sentence_from_cha(line):
+    '''
+    Turn a *PAR: utterance into plain text for the tagger, None for anything else
+    '''
     if line[0] == "@": # comments start with @ in .cha
         return
-    else:
-        try:
-            original_text = line.split("*PAR:\t")[1] # our project spec denotes each utterance begins with *PAR:
-            preprocessed_text = original_text
-            #preprocess out excluded material denoted as <> [e]
-            preprocessed_text = re.sub(r'<.*?>\s*\[e\]', '', preprocessed_text)
-            # preprocess out pause markers
-            if re.search("(\([.]+\))", preprocessed_text):
-                text = ""
-                for part in re.split("(\([.]+\))", original_text):
-                    if not re.search("(\([.]+\))", part):
-                        text += part[:-1] # [:-1] to strip off extra space from regex splot
-                preprocessed_text = text
-            # remove parentheses that fill in incomplete words since the model wasn't trained on this formatting
-            while parentheses := re.search("\(.+?\)", preprocessed_text):
-                preprocessed_text = preprocessed_text[0:parentheses.start()] + preprocessed_text[parentheses.start()+1:parentheses.end()-1] + preprocessed_text[parentheses.end():]
-            while parentheses := re.search("\<.+?\>", preprocessed_text):
-                preprocessed_text = preprocessed_text[0:parentheses.start()] + preprocessed_text[parentheses.start()+1:parentheses.end()-1] + preprocessed_text[parentheses.end():]
-            # preprocess out coded items like &-uh and &=coughs
-            preprocessed_text = re.sub(r'&-\w+', '', preprocessed_text)
-            preprocessed_text = re.sub(r'&=\w+', '', preprocessed_text)
-            # preprocess out anything inside brackets []
-            preprocessed_text = re.sub(r'\[[^\]]*\]\s?', '', preprocessed_text)
-            # preprocess out @s tags that are sometimes added to code switched text
-            preprocessed_text = re.sub(r'@s', '', preprocessed_text)
-            # preprocess out quotes symbols
-            preprocessed_text = re.sub(r'\+"/', '', preprocessed_text)
-            preprocessed_text = re.sub(r'\+"', '', preprocessed_text)
-            # finally, use punctuation to hint removal of timestamps
-            preprocessed_text = preprocessed_text.split(".")[0]
-            preprocessed_text = preprocessed_text.split("?")[0]
-            return preprocessed_text
-        except:
-            pass # print("failed to parse", line)
+    if "*PAR:\t" not in line: # our project spec denotes each utterance begins with *PAR:
+        return
+    original_text = line.split("*PAR:\t")[1]
+    #preprocess out excluded material denoted as <> [e]
+    preprocessed_text = _remove_excluded(original_text)
+    # preprocess out pause markers
+    if PAUSE_PATTERN.search(preprocessed_text):
+        # note this starts over from the original text
+        preprocessed_text = "".join(part[:-1] for part in PAUSE_PATTERN.split(original_text)[::2]) # [:-1] to strip off extra space from regex split
+    # remove parentheses that fill in incomplete words since the model wasn't trained on this formatting
+    preprocessed_text = _unwrap_pairs(preprocessed_text, "(", ")")
+    preprocessed_text = _unwrap_pairs(preprocessed_text, "<", ">")
+    # preprocess out coded items like &-uh and &=coughs, anything inside brackets [], @s tags that are sometimes added to code switched text and quotes symbols
+    for pattern in CODE_PATTERNS:
+        preprocessed_text = pattern.sub('', preprocessed_text)
+    # finally, use punctuation to hint removal of timestamps
+    preprocessed_text = preprocessed_text.split(".")[0]
+    preprocessed_text = preprocessed_text.split("?")[0]
+    return preprocessed_text
+
+def preprocess_sentences_from_cha(lines: list):
+    '''
+    preprocess_sentence_from_cha of every line, eg of parse_utterances_from_cha's output
+    '''
+    return [preprocess_sentence_from_cha(line) for line in lines]
+
+def preprocess_cha_file(input_filename):
+    '''
+    Returns (utterance, preprocessed text) of every *PAR: utterance in the file
+    '''
+    utterances = [utterance for utterance in parse_utterances_from_cha(input_filename) if utterance[0] != "@"]
+    return list(zip(utterances, preprocess_sentences_from_cha(utterances)))
 
 def parse_utterances_from_cha(input_filename):
     utterances = []
@@ -1,69 +1,182 @@
-import sys
-sys.path.append("../backend")
-from corpus_tool import Corpus, Transcript, Visualizer
+'''
+Reproduces the figures and statistical analyses of the thesis, eg:
+    python reproduce_paper.py /Users/Ben/Documents/transcriptions --workers 4
+Every figure is a task drawn from data computed from the corpus: the dispersion histograms and the per participant
+counts behind the boxplots. That data is computed once per version of the corpus and kept in .reproduce_cache, along with
+a snapshot of the parsed transcripts so only edited files are parsed again. A figure is only drawn again when its data
+or parameters changed (or the image is missing), and the figures that have to be drawn are rendered in parallel.
+'''
+import os, sys, json, pickle, hashlib, argparse
+from concurrent.futures import ProcessPoolExecutor
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, "..", "backend"))
+from corpus_tool import Corpus, Visualizer, BOXPLOT_GROUPS, boxplot_all_groups, boxplot_results
+from snapshot import file_digest
+from util import get_cha_files_in_dir
 
-if __name__ == "__main__":
-    try:
-        corpus_dir = sys.argv[1]
-    except:
-        print("Must provide transcriptions folder path as parameter, eg: python reproduce_paper.py /Users/Ben/Documents/transcriptions")
+# bump when the way the data or the figures are computed changes, so everything is rebuilt
+CACHE_VERSION = 1
+CACHE_DIR = os.path.join(HERE, ".reproduce_cache")
+CLITICS_PATH = os.path.join(HERE, "clitics.csv")
+GROUPS = ["100", "200", "300", "400", "500", "600", "700"]
+
+# (words, language, POS, color, file name) of the determiner dispersion charts, drawn for every group
+DISPERSIONS = [
+    (["un", "una", "unas", "unos"], "spa", "DET", "blue", "det_{group}_spa_un_unos_una_unas.png"),
+    (["el", "la", "los", "las"], "spa", "DET", "red", "det_{group}_spa_el_los_la_las.png"),
+    (["a"], "eng", "DET", "blue", "det_{group}_eng_a.png"),
+    (["the"], "eng", "DET", "red", "det_{group}_eng_the.png")
+]
+# (name, words, POS, language, image, description, extra statistics printed) of the word boxplots
+WORD_BOXPLOTS = [
+    ("def_eng", ['the'], "DET", "eng", "imgs/determiners/boxplot_the_DET.png", "English definite article (the)", []),
+    ("indef_eng", ['a'], "DET", "eng", "imgs/determiners/boxplot_a_DET.png", "English indefinite article (a)", []),
+    ("def_spa", ['el', 'los', 'las', 'la'], "DET", "spa", "imgs/determiners/el_los_las_la_DET_boxplot.png", "Spanish definite article (el/los/la/las)", []),
+    ("indef_spa", ['un', 'unos', 'una', 'unas'], "DET", "spa", "imgs/determiners/un_unos_una_unas_DET_boxplot.png", "Spanish indefinite article (un/unos/una/unas)", []),
+    ("obj_pron", ['lo', 'los', 'las', 'la', 'le', 'les'], "PRON", "spa", "imgs/pronouns/le_les_lo_los_las_la_PRON_boxplot.png", "3rd person object pronouns (lo/los/la/las)", ["means"])
+]
+# (name, with_non_clitic_pronoun, image, description) of the clitic boxplots
+CLITIC_BOXPLOTS = [
+    ("clitics", False, "imgs/clitics/clitics.png", "clitics (lo/los/la/las/le/les)"),
+    ("clitics_w_pronouns", True, "imgs/clitics/clitics_w_pronouns.png", "clitics and 3rd person pronouns (lo/los/la/las/le/les)")
+]
+
+def corpus_fingerprint(corpus_dir: str):
+    '''
+    Hash of the contents of the tagged transcripts and of clitics.csv
+    '''
+    files = sorted(file for file in get_cha_files_in_dir(corpus_dir) if "Tagged Transcriptions" in file)
+    digest = hashlib.blake2b(str(CACHE_VERSION).encode(), digest_size=16)
+    for file in files + [CLITICS_PATH]:
+        digest.update(os.path.relpath(file, corpus_dir).encode())
+        digest.update(file_digest(file).encode())
+    return digest.hexdigest()
 
-    corpus = Corpus(corpus_dir)
+def compute_data(corpus_dir: str):
+    '''
+    Everything the figures and statistics are drawn from, computed from a single load of the corpus
+    '''
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    corpus = Corpus(corpus_dir, snapshot_path=os.path.join(CACHE_DIR, "corpus.snapshot"))
     viz = Visualizer(corpus)
-    for group in ["100", "200", "300", "400", "500", "600", "700"]:    
-        viz.gen_dispersion(["un", "una", "unas", "unos"], group, "spa", "DET", "blue", f"imgs/determiners_time/det_{group}_spa_un_unos_una_unas.png")
-        viz.gen_dispersion(["el", "la", "los", "las"], group, "spa","DET", "red", f"imgs/determiners_time/det_{group}_spa_el_los_la_las.png")
-        viz.gen_dispersion(["a"], group, "eng", "DET", "blue", f"imgs/determiners_time/det_{group}_eng_a.png")
-        viz.gen_dispersion(["the"], group, "eng", "DET", "red", f"imgs/determiners_time/det_{group}_eng_the.png")
+    data = {"dispersions": {}, "word_boxplots": {}, "clitic_boxplots": {}}
+    histograms = viz.dispersion_histograms([(words, pos, lang) for words, lang, pos, _, _ in DISPERSIONS], GROUPS)
+    for s, (_, _, _, _, name) in enumerate(DISPERSIONS):
+        for g, group in enumerate(GROUPS):
+            data["dispersions"][name.format(group=group)] = histograms[s, g].tolist()
+    # the counts of every boxplot of a language come from one pass over the participants
+    for lang in ["eng", "spa"]:
+        boxplots = [boxplot for boxplot in WORD_BOXPLOTS if boxplot[3] == lang]
+        counts, transcript_groups = viz.word_count_matrix([(words, pos) for _, words, pos, _, _, _, _ in boxplots], lang)
+        for column, boxplot in enumerate(boxplots):
+            data["word_boxplots"][boxplot[0]] = [counts[transcript_groups == group, column].tolist() for group in BOXPLOT_GROUPS[lang]]
+    for name, with_non_clitic_pronoun, _, _ in CLITIC_BOXPLOTS:
+        data["clitic_boxplots"][name] = viz.clitic_boxplot_data(with_non_clitic_pronoun, CLITICS_PATH)
+    return data
 
-    def_eng_res = viz.gen_word_boxplots(['the'], "DET", "eng", "imgs/determiners/boxplot_the_DET.png")
-    print("Writing English definite article (the) boxplot to imgs/determiners/boxplot_the_DET.png")
-    print("F-Statistic =", def_eng_res["ANOVA"].statistic, "p =", def_eng_res["ANOVA"].pvalue)
-    print("Signifcant T-tests:", def_eng_res["significant_t-tests"])
-    print("")
+def load_data(corpus_dir: str, force: bool=False):
+    '''
+    The data of compute_data, from the cache when the corpus did not change since it was computed
+    '''
+    fingerprint = corpus_fingerprint(corpus_dir)
+    cache_path = os.path.join(CACHE_DIR, "data.pickle")
+    if not force:
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_fingerprint, data = pickle.load(f)
+            if cached_fingerprint == fingerprint:
+                return data
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            pass
+    print("Corpus changed since the last run, counting again")
+    data = compute_data(corpus_dir)
+    with open(cache_path + ".tmp", 'wb') as f:
+        pickle.dump((fingerprint, data), f)
+    os.replace(cache_path + ".tmp", cache_path)
+    return data
 
-    indef_eng_res = viz.gen_word_boxplots(['a'], "DET", "eng", "imgs/determiners/boxplot_a_DET.png")
-    print("Writing English indefinite article (a) boxplot to imgs/determiners/boxplot_a_DET.png")
-    print("F-Statistic =", indef_eng_res["ANOVA"].statistic, "p =", indef_eng_res["ANOVA"].pvalue)
-    print("Signifcant T-tests:", indef_eng_res["significant_t-tests"])
-    print("")
+def figure_tasks(data: dict):
+    '''
+    (image, renderer, arguments) of every figure
+    '''
+    tasks = []
+    for words, lang, pos, color, name in DISPERSIONS:
+        for group in GROUPS:
+            file_name = name.format(group=group)
+            tasks.append((f"imgs/determiners_time/{file_name}", "dispersion", (data["dispersions"][file_name], color)))
+    for name, _, _, lang, image, _, _ in WORD_BOXPLOTS:
+        tasks.append((image, "boxplot", (boxplot_all_groups(data["word_boxplots"][name], BOXPLOT_GROUPS[lang]),)))
+    for name, _, image, _ in CLITIC_BOXPLOTS:
+        tasks.append((image, "boxplot", (boxplot_all_groups(data["clitic_boxplots"][name], BOXPLOT_GROUPS["spa"]),)))
+    return tasks
 
-    def_spa_res = viz.gen_word_boxplots(['el', 'los', 'las', 'la'], "DET", "spa", "imgs/determiners/el_los_las_la_DET_boxplot.png")
-    print("Writing Spanish definite article (el/los/la/las) boxplot to imgs/determiners/el_los_las_la_DET_boxplot.png")
-    print("F-Statistic =", def_spa_res["ANOVA"].statistic, "p =", def_spa_res["ANOVA"].pvalue)
-    print("Signifcant T-tests:", def_spa_res["significant_t-tests"])
-    print("")
+def task_key(renderer: str, arguments: tuple):
+    return hashlib.blake2b(json.dumps([CACHE_VERSION, renderer, arguments]).encode(), digest_size=16).hexdigest()
 
-    indef_spa_res = viz.gen_word_boxplots(['un', 'unos', 'una', 'unas'], "DET", "spa", "imgs/determiners/un_unos_una_unas_DET_boxplot.png")
-    print("Writing Spanish indefinite article (un/unos/una/unas) boxplot to imgs/determiners/un_unos_una_unas_DET_boxplot.png")
-    print("F-Statistic =", indef_spa_res["ANOVA"].statistic, "p =", indef_spa_res["ANOVA"].pvalue)
-    print("Signifcant T-tests:", indef_spa_res["significant_t-tests"])
-    print("")
+def render(image: str, renderer: str, arguments: tuple):
+    viz = Visualizer(None) # drawing from data does not need the corpus
+    path = os.path.join(HERE, image)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if renderer == "dispersion":
+        counts, color = arguments
+        viz.render_barchart_vertical(range(len(counts)), counts, [color for x in range(len(counts))], path)
+    else:
+        viz.render_boxplot(arguments[0], outfile=path)
+    return image
 
-    obj_pron_res = viz.gen_word_boxplots(['lo', 'los', 'las', 'la', 'le', 'les'], "PRON", "spa", "imgs/pronouns/le_les_lo_los_las_la_PRON_boxplot.png")
-    print("Writing 3rd person object pronouns (lo/los/la/las) boxplot to imgs/pronouns/le_les_lo_los_las_la_PRON_boxplot.png")
-    print("F-Statistic =", obj_pron_res["ANOVA"].statistic, "p =", obj_pron_res["ANOVA"].pvalue)
-    print("Means: ", obj_pron_res["means"])
-    print("Signifcant T-tests:", obj_pron_res["significant_t-tests"])
-    print("")
+def render_figures(data: dict, workers: int=1, force: bool=False):
+    '''
+    Draw the figures whose data or parameters changed since they were last drawn, returns how many were drawn
+    '''
+    manifest_path = os.path.join(CACHE_DIR, "figures.json")
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f) # image -> key of the task that drew it
+    except (OSError, ValueError):
+        manifest = {}
+    todo = [(image, renderer, arguments) for image, renderer, arguments in figure_tasks(data)
+            if force or manifest.get(image) != task_key(renderer, arguments) or not os.path.exists(os.path.join(HERE, image))]
+    keys = {image: task_key(renderer, arguments) for image, renderer, arguments in todo}
+    print(f"Drawing {len(todo)} figures")
+    if workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            drawn = list(executor.map(render, *zip(*todo)))
+    else:
+        drawn = [render(*task) for task in todo]
+    for image in drawn:
+        manifest[image] = keys[image]
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return len(drawn)
+
+def print_statistics(data: dict):
+    for name, _, _, lang, image, description, extra in WORD_BOXPLOTS:
+        res = boxplot_results(data["word_boxplots"][name], BOXPLOT_GROUPS[lang])
+        print(f"Writing {description} boxplot to {image}")
+        print("F-Statistic =", res["ANOVA"].statistic, "p =", res["ANOVA"].pvalue)
+        if "means" in extra:
+            print("Means: ", res["means"])
+        print("Signifcant T-tests:", res["significant_t-tests"])
+        print("")
+    for name, _, image, description in CLITIC_BOXPLOTS:
+        res = boxplot_results(data["clitic_boxplots"][name], BOXPLOT_GROUPS["spa"], detailed=True)
+        print(f"Writing {description} boxplot to {image}")
+        print("F-Statistic =", res["ANOVA"].statistic, "p =", res["ANOVA"].pvalue)
+        print("Means: ", res["means"])
+        print("Medians: ", res["medians"])
+        print("Ranges: ", res["ranges"])
+        print("IQRs:", res['IQRs'])
+        print("Standard Deviations:", res["standard_deviations"])
+        print("Signifcant T-tests:", res["significant_t-tests"])
+        print("")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reproduce the figures and statistics of the thesis")
+    parser.add_argument("corpus_dir", help="transcriptions folder, eg /Users/Ben/Documents/transcriptions")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes drawing the figures")
+    parser.add_argument("--force", action="store_true", help="ignore the cache and rebuild everything")
+    args = parser.parse_args()
 
-    clitics_res = viz.gen_clitic_boxplots(False, outfile="imgs/clitics/clitics.png")
-    print("Writing clitics (lo/los/la/las/le/les) boxplot to imgs/clitics/clitics.png")
-    print("F-Statistic =", clitics_res["ANOVA"].statistic, "p =", clitics_res["ANOVA"].pvalue)
-    print("Means: ", clitics_res["means"])
-    print("Medians: ", clitics_res["medians"])
-    print("Ranges: ", clitics_res["ranges"])
-    print("IQRs:", clitics_res['IQRs'])
-    print("Standard Deviations:", clitics_res["standard_deviations"])
-    print("Signifcant T-tests:", clitics_res["significant_t-tests"])
-    print("")
-    
-    clitics_w_pronouns_res = viz.gen_clitic_boxplots(True, outfile="imgs/clitics/clitics_w_pronouns.png")
-    print("Writing clitics and 3rd person pronouns (lo/los/la/las/le/les) boxplot to imgs/clitics/clitics_w_pronouns.png")
-    print("F-Statistic =", clitics_w_pronouns_res["ANOVA"].statistic, "p =", clitics_w_pronouns_res["ANOVA"].pvalue)
-    print("Means: ", clitics_w_pronouns_res["means"])
-    print("Medians: ", clitics_w_pronouns_res["medians"])
-    print("Ranges: ", clitics_w_pronouns_res["ranges"])
-    print("IQRs:", clitics_w_pronouns_res['IQRs'])
-    print("Standard Deviations:", clitics_w_pronouns_res["standard_deviations"])
-    print("Signifcant T-tests:", clitics_res["significant_t-tests"])
\ No newline at end of file
+    data = load_data(args.corpus_dir, args.force)
+    render_figures(data, args.workers, args.force)
+    print_statistics(data)